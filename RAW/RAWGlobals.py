@@ -65,5 +65,15 @@ global usepyFAI
 global usepyFAI_integration
 usepyFAI_integration = False
 
+# Radial averaging backend: 'weave', 'numpy', 'csr' or 'python'. None picks the
+# compiled extension if available, otherwise the vectorized numpy version.
+global ravg_backend
+ravg_backend = None
+
+# Memory-map the pixel data of uncompressed TIFF, EDF and .npy images instead
+# of decoding them (see SASFileIO.mapImage).
+global mmap_images
+mmap_images = True
+
 global version
 version = '1.2.2'
@@ -33,7 +33,7 @@ import os, sys, copy
 RAW_DIR = os.path.dirname(os.path.abspath(__file__))
 if RAW_DIR not in sys.path:
     sys.path.append(RAW_DIR)
-import RAWGlobals, SASFileIO
+import RAWGlobals, SASFileIO, SASImage
 
 
 CURR_ID = []
@@ -41,6 +41,10 @@ def NewId():
     CURR_ID.append(len(CURR_ID))
     return CURR_ID[-1]
 
+# Settings the cached radial average geometry depends on
+GEOMETRY_KEYS = ('Xcenter', 'Ycenter', 'MaskDimension', 'Masks',
+                 'BeamStopMask', 'ReadOutNoiseMask')
+
 
 class RawGuiSettings:
     '''
@@ -89,6 +93,9 @@ class RawGuiSettings:
 
                             #CORRECTIONS
                             'DoSolidAngleCorrection' : [True, NewId(), 'bool'],
+                            'DoPolarizationCorrection' : [False, NewId(), 'bool'],
+                            'PolarizationFactor'       : [0.0,   NewId(), 'float'],
+                            'PixelLevelCorrection'     : [False, NewId(), 'bool'],  # Apply the corrections per pixel during the radial average
 
 
                             #CENTER / BINNING
@@ -101,6 +108,15 @@ class RawGuiSettings:
                             'EndPoint'   : [0,     NewId(), 'int'],
                             'ImageDim'   : [[1024,1024]],
 
+                            # Pixel splitting does no zinger removal (ZingerRemovalRadAvg is ignored) and runs on one thread
+                            'PixelSplitting'             : [False, NewId(), 'bool'],
+                            'PixelSplittingOversampling' : [4,     NewId(), 'int'],
+                            'PixelSplittingBinWidth'     : [1.0,   NewId(), 'float'],
+
+                            'IntegrationThreads'         : [1,     NewId(), 'int'],
+                            'MaskCacheDir'               : [None,  NewId(), 'text'],  # None uses SASMaskCache.DEFAULT_CACHE_DIR
+                            'BeamStopMaskGrow'           : [0,     NewId(), 'int'],   # Pixels the beamstop mask is grown (< 0 shrunk) by
+
                             #MASKING
                             'SampleFile'              : [None, NewId(), 'text'],
                             'BackgroundSASM'          : [None, NewId(), 'text'],
@@ -170,7 +186,7 @@ class RawGuiSettings:
                             'IFTAlgoChoice'      : [['BIFT']],
 
                             #ARTIFACT REMOVAL:
-                            'ZingerRemovalRadAvg'    : [False, NewId(), 'bool'],
+                            'ZingerRemovalRadAvg'    : [False, NewId(), 'bool'],  # Not done with PixelSplitting
                             'ZingerRemovalRadAvgStd' : [4.0,     NewId(), 'float'],
 
                             'ZingerRemoval'     : [False, NewId(), 'bool'],
@@ -340,6 +356,9 @@ class RawGuiSettings:
     def set(self, key, value):
         self._params[key][0] = value
 
+        if key in GEOMETRY_KEYS:
+            SASImage.clearRadialAverageGeometryCache()
+
     def getId(self, key):
         return self._params[key][1]
 
@@ -389,6 +408,8 @@ def loadSettings(raw_settings, loadpath):
     # main_frame = wx.FindWindowByName('MainFrame')
     # main_frame.queueTaskInWorkerThread('recreate_all_masks', None)
 
+    SASImage.clearRadialAverageGeometryCache()
+
     postProcess(raw_settings)
 
     return True
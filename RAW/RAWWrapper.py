@@ -3,7 +3,9 @@ from __future__ import print_function
 import os
 import sys
 import copy
-import glob
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
@@ -15,6 +17,9 @@ import SASM
 import SASFileIO
 import SASImage
 import SASExceptions
+import SASMaskCache
+import SASPixelStats
+import SASWorkerPool
 
 from RAWUtils import findATSASDirectory, ErrorPrinter
 from RAWAnalysisWrapper import RAWAnalysisSimulator
@@ -58,39 +63,138 @@ class RAWSimulator():
     #    self._stdout.close()
 
     def _createMasks(self, overwrite_cached=False):
-        """Create mask from mask objects."""
+        """Create mask from mask objects.
+
+        Mask matrices are looked up in the shared mask cache by a hash of the
+        mask objects and the mask dimension, and only created if not cached.
+        """
         print('Please wait while creating masks...', file=self._stdout)
         mask_dict = self._raw_settings.get('Masks')
         img_dim = self._raw_settings.get('MaskDimension')
 
-        cfg_path = self._raw_settings.get('CurrentCfg')
-        cfg_name, _ = os.path.splitext(cfg_path)
-
-        # mask path: /where/is/the/cfgfile/cfgname-BeamStopMask.npy
-        cached_path = glob.glob('{0}-{1}'.format(cfg_name, '*Mask*.npy'))
-        cached_masks = {
-            os.path.splitext(mask_path.split('-')[-1])[0]: mask_path
-            for mask_path in cached_path
-        }
+        mask_cache = SASMaskCache.MaskCache(self._raw_settings.get('MaskCacheDir'))
 
         for each_key in mask_dict.keys():
             # each_key: 'TransparentBSMask', 'BeamStopMask', 'ReadOutNoiseMask'
             # mask_dict[key] = [mask_matrix, mask_object]
             masks = mask_dict[each_key][1]
             if masks is not None:
-                if each_key in cached_masks:
-                    mask_img = np.load(cached_masks[each_key])
-                else:
+                cache_key = SASMaskCache.getMaskKey(img_dim, masks)
+
+                mask_img = None
+                if not overwrite_cached:
+                    mask_img = mask_cache.load(cache_key, tuple(img_dim))
+                if mask_img is None:
                     mask_img = SASImage.createMaskMatrix(img_dim, masks)
+                    mask_cache.save(cache_key, mask_img)
+
+                if each_key == 'BeamStopMask':
+                    mask_img = SASImage.growMaskMatrix(
+                        mask_img, self._raw_settings.get('BeamStopMaskGrow'),
+                        mask_cache)
+
                 mask_param = mask_dict[each_key]
                 self._raw_settings.set(each_key, mask_img)
                 mask_param[0] = mask_img
                 mask_param[1] = masks
 
-                if overwrite_cached:
-                    np.save('{0}-{1}'.format(cfg_name, each_key), mask_img)
-                elif each_key not in cached_masks:
-                    np.save('{0}-{1}'.format(cfg_name, each_key), mask_img)
+        if self._raw_settings.get('PixelSplitting'):
+            self._createPixelSplittingWeights()
+
+    def growMask(self, mask_key, pixels):
+        """Grow (or with negative pixels shrink) the masked area of a created
+        mask matrix, e.g. to pad the beamstop mask by a few pixels.
+
+        Parameters
+        ----------
+        mask_key : str
+            'BeamStopMask', 'ReadOutNoiseMask' or 'TransparentBSMask'.
+        pixels : int
+            Number of pixels to grow the masked area by.
+        """
+        mask_param = self._raw_settings.get('Masks')[mask_key]
+        if mask_param[0] is None:
+            return
+        mask_cache = SASMaskCache.MaskCache(self._raw_settings.get('MaskCacheDir'))
+        mask_img = SASImage.growMaskMatrix(mask_param[0], pixels, mask_cache)
+        mask_param[0] = mask_img
+        self._raw_settings.set(mask_key, mask_img)
+
+    def createBadPixelMask(self, filename_list, sensitivity=6.0,
+                           saturation=None, flag_zero=True):
+        """Find hot, dead and saturated pixels in dark or flat frames and add
+        them to the beamstop mask.
+
+        The frames are streamed through running per-pixel statistics, so
+        only one frame is in memory at a time. The bad pixels are added as
+        a SASImage.PixelMask to the BeamStopMask objects, replacing the one
+        of an earlier call, and the masks are recreated (through
+        createMaskMatrix and the mask cache).
+
+        Parameters
+        ----------
+        filename_list : list of str
+            Image files with the frames.
+        sensitivity, saturation, flag_zero
+            See SASPixelStats.findBadPixels.
+
+        Returns
+        -------
+        numpy.ndarray
+            Boolean mask, False for the bad pixels.
+        """
+        print('Please wait while finding bad pixels...', file=self._stdout)
+        img_fmt = self._raw_settings.get('ImageFormat')
+
+        def frames():
+            for each_filename in filename_list:
+                loaded_data, _ = SASFileIO.loadImage(each_filename, img_fmt)
+                for img in loaded_data:
+                    yield img
+
+        stats = SASPixelStats.PixelStatistics().addFrames(frames())
+        good_mask = SASPixelStats.findBadPixels(stats, sensitivity,
+                                                saturation, flag_zero)
+
+        mask_param = self._raw_settings.get('Masks')['BeamStopMask']
+        masks = list(mask_param[1]) if mask_param[1] is not None else []
+        masks = [each for each in masks
+                 if not isinstance(each, SASImage.PixelMask)]
+        img_dim = tuple(self._raw_settings.get('MaskDimension'))
+        if masks and img_dim != good_mask.shape:
+            raise SASExceptions.MaskSizeError(
+                'Frames are {}, but the masks are {}.'.format(
+                    good_mask.shape, img_dim))
+        masks.append(SASImage.PixelMask(
+            SASPixelStats.badPixelCoordinates(good_mask), len(masks),
+            good_mask.shape))
+        mask_param[1] = masks
+        self._raw_settings.set('MaskDimension', list(good_mask.shape))
+
+        self._createMasks()
+
+        print('Found {} bad pixels in {} frames.'.format(
+            int((~good_mask).sum()), stats.count), file=self._stdout)
+
+        return good_mask
+
+    def _createPixelSplittingWeights(self):
+        """Build (or load) the pixel splitting weights for the beamstop mask,
+        stored in the mask cache so repeat runs only load them."""
+        masks = self._raw_settings.get('Masks')
+        img_dim = self._raw_settings.get('MaskDimension')
+
+        # Same center transformation as SASFileIO.loadImageFile
+        x_c = self._raw_settings.get('Xcenter')
+        y_c = img_dim[0] - self._raw_settings.get('Ycenter')
+
+        geometry = SASImage.getRadialAverageGeometry(
+            img_dim, x_c, y_c, masks['BeamStopMask'][0],
+            masks['ReadOutNoiseMask'][0])
+        geometry.getSplitMatrix(
+            self._raw_settings.get('PixelSplittingOversampling'),
+            self._raw_settings.get('PixelSplittingBinWidth'),
+            SASFileIO.getPixelSplittingCache(self._raw_settings))
 
     def get_raw_settings(self):
         return self._raw_settings
@@ -198,19 +302,57 @@ class RAWSimulator():
         # wavelength = self._raw_settings.get('WaveLength')
         # sasm.calibrateQ(sd_distance, pixel_size, wavelength)
 
-    def loadSASMs(self, filename_list):
-        """Load image or dat files."""
+    def loadSASMs(self, filename_list, prefetch=4, io_threads=2, workers=0):
+        """Load image or dat files.
+
+        Files are read ahead (images decoded and headers parsed) on
+        io_threads threads, up to prefetch files ahead of the one being
+        integrated, so reading and integration overlap. With workers, the
+        files are read and integrated on a pool of that many processes
+        instead (see SASWorkerPool). The curves are returned in the order
+        of filename_list.
+
+        Parameters
+        ----------
+        filename_list : list of str
+            Files to load.
+        prefetch : int
+            Number of files read ahead. 0 reads every file just before it
+            is integrated, on the calling thread.
+        io_threads : int
+            Number of threads reading files.
+        workers : int
+            Number of worker processes, 0 to load in this process.
+
+        Returns
+        -------
+        list of SASM objects
+        """
         print('Please wait while loading files...', file=self._stdout)
         sasm_list = []
         do_auto_save = self._raw_settings.get('AutoSaveOnImageFiles')
 
+        if workers and not SASWorkerPool.use_shared_memory:
+            print('Shared memory is not available, loading in one process.',
+                  file=self._stdout)
+            workers = 0
+
+        # The pool is started before loading, so problems starting it
+        # are raised here and not for the first file
+        if workers:
+            worker_pool = self._createWorkerPool(workers)
+            loaders = self._poolFileLoaders(worker_pool, filename_list)
+        else:
+            worker_pool = None
+            loaders = self._threadFileLoaders(filename_list, prefetch,
+                                              io_threads)
+
         try:
-            for each_filename in filename_list:
-                # file_ext = os.path.splitext(each_filename)[1]
-                sasm, img = SASFileIO.loadFile(each_filename,
-                                               self._raw_settings)
+            for each_filename, load in loaders:
+                # Errors loading the file are raised here, in file order
+                sasm, is_image = load()
 
-                if img is not None:
+                if is_image:
                     # qrange = sasm.getQrange()
                     start_point = self._raw_settings.get('StartPoint')
                     end_point = self._raw_settings.get('EndPoint')
@@ -267,9 +409,87 @@ class RAWSimulator():
                 'Mask information was not found in header',
                 file=self._stdout)
             raise error
+        finally:
+            loaders.close()
+            if worker_pool is not None:
+                worker_pool.close()
 
         return sasm_list
 
+    def _threadFileLoaders(self, filename_list, prefetch, io_threads):
+        """Yields every filename with a function loading it (returning the
+        SASM(s) and whether it is an image), with the next files being read
+        on a thread pool."""
+        if prefetch > 0:
+            io_pool = ThreadPoolExecutor(max(1, io_threads))
+        else:
+            io_pool = None
+        pending = deque()
+        filenames = iter(filename_list)
+
+        def readAhead(count):
+            for each_filename in itertools.islice(filenames, count):
+                if io_pool is not None:
+                    preloaded = io_pool.submit(SASFileIO.preloadFile,
+                                               each_filename,
+                                               self._raw_settings)
+                else:
+                    preloaded = None
+                pending.append((each_filename, preloaded))
+
+        def loader(each_filename, preloaded):
+            def load():
+                if preloaded is not None:
+                    sasm, img = SASFileIO.loadFile(
+                        each_filename, self._raw_settings,
+                        preloaded=preloaded.result())
+                else:
+                    sasm, img = SASFileIO.loadFile(each_filename,
+                                                   self._raw_settings)
+                return sasm, img is not None
+            return load
+
+        try:
+            readAhead(max(1, prefetch))
+            while pending:
+                each_filename, preloaded = pending.popleft()
+                readAhead(1)
+                yield each_filename, loader(each_filename, preloaded)
+        finally:
+            if io_pool is not None:
+                for _, preloaded in pending:
+                    preloaded.cancel()
+                io_pool.shutdown(wait=False)
+
+    def _createWorkerPool(self, workers):
+        """Starts a SASWorkerPool with workers processes. The flatfield and
+        dark images are loaded (and cached for the pool) first, so a bad
+        one is reported by its own filename."""
+        corrections = (('NormFlatfieldEnabled', 'NormFlatfieldFile',
+                        SASFileIO.getFlatfield),
+                       ('DarkCorrEnabled', 'DarkCorrFilename',
+                        SASFileIO.getDarkImage))
+
+        for enabled, filename_key, load in corrections:
+            filename = self._raw_settings.get(filename_key)
+
+            if self._raw_settings.get(enabled) and filename is not None:
+                try:
+                    load(self._raw_settings)
+                except (SASExceptions.UnrecognizedDataFormat,
+                        SASExceptions.WrongImageFormat) as error:
+                    self.error_printer.showDataFormatError(
+                        os.path.split(filename)[1])
+                    raise error
+
+        return SASWorkerPool.WorkerPool(self._raw_settings, workers)
+
+    def _poolFileLoaders(self, worker_pool, filename_list):
+        """As _threadFileLoaders, loading the files on worker_pool."""
+        results = worker_pool.imap(filename_list)
+        for each_filename in filename_list:
+            yield each_filename, lambda: next(results)
+
     def loadIFTMs(self, filename_list):
         """Load GNOM .ift/.out files."""
         print('Please wait while loading files...', file=self._stdout)
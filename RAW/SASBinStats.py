@@ -0,0 +1,136 @@
+"""
+#******************************************************************************
+# This file is part of RAW.
+#
+#    RAW is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    RAW is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with RAW.  If not, see <http://www.gnu.org/licenses/>.
+#
+#******************************************************************************
+
+Robust statistics (median, MAD, sigma clipped mean) of binned pixel values,
+calculated for all bins at once.
+
+All functions take the pixel values grouped by bin and the bin offsets, so
+the values of bin i are values[offsets[i]:offsets[i+1]] (see
+SASImage.RadialAverageGeometry.getBinnedPixelIndex). Empty bins give nan.
+"""
+from __future__ import print_function, division
+
+import numpy as np
+
+
+def binIds(offsets):
+    ''' Bin number of every value for the given bin offsets '''
+
+    return np.repeat(np.arange(len(offsets)-1), np.diff(offsets))
+
+def sortWithinBins(values, offsets):
+    ''' Sorts the values of every bin, keeping the bins in place '''
+
+    ids = binIds(offsets)
+
+    return values[np.lexsort((values, ids))]
+
+def binnedMedian(values, offsets, is_sorted = False):
+    ''' Median of every bin. Set is_sorted if the values are already sorted
+    within the bins (sortWithinBins). '''
+
+    if not is_sorted:
+        values = sortWithinBins(values, offsets)
+
+    n = np.diff(offsets)
+    filled = n > 0
+
+    median = np.full(len(n), np.nan)
+
+    start = offsets[:-1][filled]
+    low = start + (n[filled]-1) // 2
+    high = start + n[filled] // 2
+
+    median[filled] = (values[low] + values[high]) / 2.0
+
+    return median
+
+def binnedMAD(values, offsets, median = None):
+    ''' Median absolute deviation from the median of every bin '''
+
+    if median is None:
+        median = binnedMedian(values, offsets)
+
+    deviation = np.abs(values - median[binIds(offsets)])
+
+    return binnedMedian(deviation, offsets)
+
+def binnedSigmaClip(values, offsets, sensitivity = 4.0, max_iter = 5, median = None):
+    ''' Iterative sigma clipping of every bin. Values further than
+    sensitivity standard deviations from the bin median are rejected and
+    the standard deviation is recalculated from the remaining values, until
+    nothing changes or max_iter iterations are done.
+
+    The first pass uses the robust standard deviation, 1.4826 * MAD (or
+    1.2533 times the mean absolute deviation for bins with a MAD of 0), so
+    an outlier can't hide by inflating the threshold of its own bin. With
+    the plain standard deviation a single outlier in a bin of n values is
+    at most n/sqrt(n-1) standard deviations from the median and is never
+    rejected in small bins.
+
+    Returns the mean and the error of the mean (std / sqrt(N)) of the kept
+    values, and the number of kept values, for every bin.
+    '''
+
+    ids = binIds(offsets)
+    n_bins = len(offsets)-1
+
+    if median is None:
+        median = binnedMedian(values, offsets)
+
+    deviation = np.abs(values - median[ids])
+
+    sigma = 1.4826 * binnedMAD(values, offsets, median)
+
+    no_mad = sigma == 0
+    if np.any(no_mad):
+        count = np.bincount(ids, minlength = n_bins)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            mean_deviation = np.bincount(ids, weights = deviation, minlength = n_bins) / count
+        sigma[no_mad] = 1.2533 * mean_deviation[no_mad]
+
+    keep = deviation <= sensitivity * sigma[ids]
+
+    for iteration in range(max_iter):
+        mean, std, count = _keptMeanStd(values, ids, keep, n_bins)
+
+        new_keep = deviation <= sensitivity * std[ids]
+
+        if np.array_equal(new_keep, keep):
+            break
+
+        keep = new_keep
+    else:
+        mean, std, count = _keptMeanStd(values, ids, keep, n_bins)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        err = std / np.sqrt(count)
+
+    return mean, err, count
+
+def _keptMeanStd(values, ids, keep, n_bins):
+    weights = keep.astype(np.float64)
+
+    count = np.bincount(ids, weights = weights, minlength = n_bins)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        mean = np.bincount(ids, weights = values * weights, minlength = n_bins) / count
+        variance = np.bincount(ids, weights = weights * (values - mean[ids])**2, minlength = n_bins) / count
+
+    return mean, np.sqrt(variance), count
@@ -24,7 +24,7 @@ Created on Jul 11, 2010
 from __future__ import print_function, division
 
 import os, sys
-from math import pi, asin, tan, atan, cos
+from math import pi, asin, tan, atan
 import numpy as np
 
 RAW_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -89,13 +89,152 @@ def calcSolidAngleCorrection(sasm, sd_distance, pixel_size):
 
     '''
 
-    q_list = sasm.q
-    iac = np.ones(len(q_list))
+    return calcSolidAngleFactor(calcTwoTheta(sd_distance, pixel_size, sasm.q))
 
-    for idx in range(0,len(iac)):
-        iac[idx] = np.power( cos( 2 * calcTheta(sd_distance, pixel_size, q_list[idx]) ),3 )    #cos^3(2*theta)
+def calcTwoTheta(sd_distance, pixel_size, q_length_pixels):
+    '''
+     Vectorized 2*theta (same as 2*calcTheta) for an array of q-vector
+     lengths in pixels, of any shape.
+    '''
+
+    q_length_pixels = np.asarray(q_length_pixels, dtype = np.float64)
+
+    return np.arctan((q_length_pixels * pixel_size) / sd_distance)
+
+def calcSolidAngleFactor(two_theta):
+    ''' Relative solid angle of a pixel, cos^3(2*theta) '''
+
+    return np.cos(two_theta)**3
+
+def calcPolarizationFactor(two_theta, polarization, chi = None):
+    '''
+     Polarization factor (1 + cos^2(2theta) - p*cos(2chi)*sin^2(2theta)) / 2,
+     where p is the polarization (-1 to 1, 0 is unpolarized, 1 is fully
+     polarized along the detector x axis) and chi the azimuthal angle from
+     the detector x axis. Without chi the average over the azimuthal angle
+     is returned, which is what applies to radially averaged bins.
+    '''
+
+    cos2 = np.cos(two_theta)**2
+
+    if chi is None:
+        return 0.5 * (1 + cos2)
+
+    return 0.5 * (1 + cos2 - polarization * np.cos(2 * chi) * (1 - cos2))
+
+class DetectorCorrection():
+    '''
+     Solid angle and (optionally) polarization correction factors of a
+     detector geometry. The intensities are divided by the factors.
+     The arrays only depend on the setup, so they are calculated once and
+     kept here (use getDetectorCorrection to get a cached one).
+
+     sd_distance :   Sample-Detector distance
+     pixel_size :    Detector Pixel Size in millimeters
+     wavelength :    Wavelength
+     img_dim :       (ylen, xlen) of the image
+     x_cin, y_cin :  Center coordinate in the image (Pixels), as passed to radialAverage
+     solid_angle :   Include the solid angle correction
+     polarization :  Polarization for the polarization correction, or None for no polarization correction
+    '''
+
+    def __init__(self, sd_distance, pixel_size, wavelength, img_dim, x_cin, y_cin,
+                 solid_angle = True, polarization = None):
+
+        self.sd_distance = sd_distance
+        self.pixel_size = pixel_size
+        self.wavelength = wavelength
+        self.img_dim = (int(img_dim[0]), int(img_dim[1]))
+        self.x_cin = x_cin
+        self.y_cin = y_cin
+        self.solid_angle = solid_angle
+        self.polarization = polarization
+
+        self._pixel_factors = None
+        self._pixel_correction = None
+        self._bin_factors = None
+        self._q_factors = None
+
+    def getBinFactors(self, n_bins):
+        ''' Correction factors of the radial average bins 0..n_bins-1 (q in pixels) '''
+
+        if self._bin_factors is None or len(self._bin_factors) < n_bins:
+            two_theta = calcTwoTheta(self.sd_distance, self.pixel_size, np.arange(n_bins))
+            self._bin_factors = self._factors(two_theta)
+
+        return self._bin_factors[:n_bins]
+
+    def getFactors(self, q):
+        '''
+         Correction factors of the radial average bins at q (in pixels).
+         On the integer pixel grid the cached bin factors are used, otherwise
+         (e.g. pixel splitting with another bin width) they are calculated
+         for q, and kept for the next curve with the same q.
+        '''
+
+        q = np.asarray(q, dtype = np.float64)
+
+        if np.array_equal(q, np.arange(len(q))):
+            return self.getBinFactors(len(q))
+
+        if self._q_factors is None or not np.array_equal(self._q_factors[0], q):
+            two_theta = calcTwoTheta(self.sd_distance, self.pixel_size, q)
+            self._q_factors = (q.copy(), self._factors(two_theta))
+
+        return self._q_factors[1]
+
+    def getPixelFactors(self):
+        ''' Correction factor of every pixel of the image '''
+
+        if self._pixel_factors is None:
+            ylen, xlen = self.img_dim
+
+            rel_x = np.arange(xlen, dtype = np.float64) - self.x_cin
+            rel_y = np.arange(ylen, dtype = np.float64)[:, np.newaxis] - self.y_cin
+
+            two_theta = calcTwoTheta(self.sd_distance, self.pixel_size, np.sqrt(rel_x**2 + rel_y**2))
+            chi = np.arctan2(rel_y, rel_x)
+
+            self._pixel_factors = self._factors(two_theta, chi)
+
+        return self._pixel_factors
+
+    def getPixelCorrection(self):
+        ''' Reciprocal of the pixel factors, to multiply the image with '''
+
+        if self._pixel_correction is None:
+            self._pixel_correction = 1.0 / self.getPixelFactors()
+
+        return self._pixel_correction
+
+    def _factors(self, two_theta, chi = None):
+        factors = np.ones(np.shape(two_theta), dtype = np.float64)
+
+        if self.solid_angle:
+            factors = factors * calcSolidAngleFactor(two_theta)
+
+        if self.polarization is not None:
+            factors = factors * calcPolarizationFactor(two_theta, self.polarization, chi)
+
+        return factors
+
+_detector_correction_cache = {}
+_DETECTOR_CORRECTION_CACHE_SIZE = 4
+
+def getDetectorCorrection(sd_distance, pixel_size, wavelength, img_dim, x_cin, y_cin,
+                          solid_angle = True, polarization = None):
+    ''' Returns the cached DetectorCorrection for the geometry, creating it if needed '''
+
+    key = (sd_distance, pixel_size, wavelength, (int(img_dim[0]), int(img_dim[1])),
+           x_cin, y_cin, solid_angle, polarization)
+
+    if key not in _detector_correction_cache:
+        if len(_detector_correction_cache) >= _DETECTOR_CORRECTION_CACHE_SIZE:
+            _detector_correction_cache.clear()
+
+        _detector_correction_cache[key] = DetectorCorrection(*key)
 
-    return iac
+    return _detector_correction_cache[key]
 
 def calcDistanceFromAgBeh(first_ring_dist, pixel_size, wavelength):
     ''' Calculates sample detector distance from the rings
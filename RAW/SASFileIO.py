@@ -31,14 +31,15 @@ except ImportError:
     print('RAW WARNING: hdf5plugin not present, Eiger hdf5 images will not load.')
     use_eiger = False
 
-import os, sys, re, time, binascii, struct, json, copy
+import os, sys, re, time, binascii, struct, json, copy, itertools, threading, bisect
 import numpy as np
 from xml.dom import minidom
+from concurrent.futures import ThreadPoolExecutor
 
 RAW_DIR = os.path.dirname(os.path.abspath(__file__))
 if RAW_DIR not in sys.path:
     sys.path.append(RAW_DIR)
-import RAWGlobals, SASImage, SASM, SASExceptions
+import RAWGlobals, SASImage, SASM, SASExceptions, SASMaskCache
 import SASMarHeaderReader #Attempting to remove the reliance on compiled packages. Switchin Mar345 reading to fabio.
 
 try:
@@ -96,10 +97,15 @@ except Exception as error:
 #     print('ERROR Loading NeXus Library!')
 
 def createSASMFromImage(img_array, parameters = {}, x_c = None, y_c = None, mask = None,
-                        readout_noise_mask = None, tbs_mask = None, dezingering = 0, dezing_sensitivity = 4):
+                        readout_noise_mask = None, tbs_mask = None, dezingering = 0, dezing_sensitivity = 4,
+                        oversampling = 0, bin_width = 1.0, split_cache = None, threads = 1, correction = None):
     '''
         Load measurement. Loads an image file, does pre-processing:
         masking, radial average and returns a measurement object
+
+        oversampling > 0 turns on pixel splitting, see SASImage.radialAverageSplit
+        threads > 1 integrates the image in row blocks on a thread pool
+        correction holds per-pixel correction factors applied in the radial average
     '''
     if mask is not None:
         if mask.shape != img_array.shape:
@@ -117,14 +123,20 @@ def createSASMFromImage(img_array, parameters = {}, x_c = None, y_c = None, mask
                             ' create a new mask or remove the old to make this plot.')
 
     try:
-        [i_raw, q_raw, err_raw, qmatrix] = SASImage.radialAverage(img_array, x_c, y_c, mask, readout_noise_mask, dezingering, dezing_sensitivity)
+        [i_raw, q_raw, err_raw, qmatrix] = SASImage.radialAverage(img_array, x_c, y_c, mask, readout_noise_mask, dezingering, dezing_sensitivity,
+                                                                  oversampling = oversampling, bin_width = bin_width,
+                                                                  split_cache = split_cache, threads = threads,
+                                                                  correction = correction)
     except IndexError as msg:
         print('Center coordinates too large: ' + str(msg))
 
         x_c = int(img_array.shape[1]/2)
         y_c = int(img_array.shape[0]/2)
 
-        [i_raw, q_raw, err_raw, qmatrix] = SASImage.radialAverage(img_array, x_c, y_c, mask, readout_noise_mask, dezingering, dezing_sensitivity)
+        [i_raw, q_raw, err_raw, qmatrix] = SASImage.radialAverage(img_array, x_c, y_c, mask, readout_noise_mask, dezingering, dezing_sensitivity,
+                                                                  oversampling = oversampling, bin_width = bin_width,
+                                                                  split_cache = split_cache, threads = threads,
+                                                                  correction = correction)
 
         #wx.CallAfter(wx.MessageBox, "The center coordinates are too large for this image, used image center instead.",
         # "Center coordinates does not fit image", wx.OK | wx.ICON_ERROR)
@@ -139,6 +151,96 @@ def createSASMFromImage(img_array, parameters = {}, x_c = None, y_c = None, mask
 
     return sasm
 
+def createSASMsFromImageStack(images, parameters_list, geometry = None, x_c = None, y_c = None, mask = None,
+                              readout_noise_mask = None, tbs_mask = None, dezingering = 0, dezing_sensitivity = 4,
+                              correction = None):
+    '''
+        Radial averages a stack of images with the same geometry in one pass
+        (see SASImage.radialAverageStack) and returns a measurement object for
+        each, together with the roi_counter values for tbs_mask (None if
+        there is no tbs_mask).
+
+        images can be a 3D array or an iterator of 2D images, parameters_list
+        holds the parameters for every image. correction holds per-pixel
+        correction factors applied to every frame.
+    '''
+
+    images = iter(images)
+
+    try:
+        first_img = next(images)
+    except StopIteration:
+        return [], None
+
+    for each_mask, name in [(mask, 'Beamstop mask'), (readout_noise_mask, 'Readout-noise mask'),
+                            (tbs_mask, 'ROI Counter mask')]:
+        if each_mask is not None and each_mask.shape != first_img.shape:
+            raise SASExceptions.MaskSizeError(name + ' is the wrong size. Please' +
+                            ' create a new mask or remove the old to make this plot.')
+
+    if geometry is None:
+        geometry = SASImage.getRadialAverageGeometry(first_img.shape, x_c, y_c, mask, readout_noise_mask)
+
+        center = geometry.center_pixel
+
+        if center is not None and (center[0] >= first_img.shape[0] or center[1] >= first_img.shape[1]):
+            print('Center coordinates too large: ' + str(geometry.center_pixel))
+
+            x_c = int(first_img.shape[1]/2)
+            y_c = int(first_img.shape[0]/2)
+
+            geometry = SASImage.getRadialAverageGeometry(first_img.shape, x_c, y_c, mask, readout_noise_mask)
+
+    if tbs_mask is not None:
+        roi_index = np.flatnonzero(tbs_mask==1)
+        roi_counters = []
+    else:
+        roi_counters = None
+
+    # The roi counters are taken while the frames go past, so an iterator is only read once
+    def stackFrames():
+        for img in itertools.chain([first_img], images):
+            if roi_counters is not None:
+                roi_counters.append(np.ravel(img)[roi_index].sum())
+            yield img
+
+    profiles = SASImage.radialAverageStack(stackFrames(), x_c, y_c, geometry = geometry,
+                                           dezingering = dezingering, dezing_sensitivity = dezing_sensitivity,
+                                           correction = correction)
+
+    sasm_list = []
+
+    for i, (i_raw, q_raw, err_raw) in enumerate(profiles):
+        parameters = parameters_list[i]
+
+        if roi_counters is not None:
+            parameters['counters']['roi_counter'] = roi_counters[i]
+
+        sasm_list.append(SASM.SASM(i_raw, q_raw, np.nan_to_num(err_raw), parameters))
+
+    return sasm_list, roi_counters
+
+def getPixelSplittingCache(raw_settings):
+    ''' Pixel splitting weights are cached with the masks, in MaskCacheDir
+    (see SASMaskCache), under a key made from the mask and geometry. '''
+
+    return SASMaskCache.MaskCache(raw_settings.get('MaskCacheDir'))
+
+def getPixelCorrection(raw_settings, img_dim, x_c, y_c, img_hdr = None, file_hdr = None):
+    ''' Per-pixel solid angle/polarization correction factors for the radial
+    average if PixelLevelCorrection is set, otherwise None (the correction
+    is then done on the bins in SASImage.calibrateAndNormalize). '''
+
+    if not raw_settings.get('PixelLevelCorrection'):
+        return None
+
+    correction = SASImage.getDetectorCorrection(raw_settings, img_dim, x_c, y_c, img_hdr, file_hdr)
+
+    if correction is None:
+        return None
+
+    return correction.getPixelCorrection()
+
 def loadMask(filename):
     ''' Loads a mask  '''
 
@@ -262,7 +364,203 @@ def parseTiffTags(filename):
 
     return tag_dict
 
+_EDF_DATA_TYPES = {'UnsignedByte'         : 'u1',
+                   'SignedByte'           : 'i1',
+                   'UnsignedShort'        : 'u2',
+                   'UnsignedShortInteger' : 'u2',
+                   'SignedShort'          : 'i2',
+                   'UnsignedInteger'      : 'u4',
+                   'UnsignedLong'         : 'u4',
+                   'SignedInteger'        : 'i4',
+                   'SignedLong'           : 'i4',
+                   'FloatValue'           : 'f4',
+                   'Float'                : 'f4',
+                   'FloatIEEE32'          : 'f4',
+                   'DoubleValue'          : 'f8',
+                   'Double'               : 'f8',
+                   'DoubleIEEE64'         : 'f8'}
+
+_TIFF_SAMPLE_FORMATS = {1 : 'u', 2 : 'i', 3 : 'f'}
+
+def mapImage(filename):
+    ''' Memory maps the pixel data of a single frame, uncompressed TIFF,
+    EDF or .npy file, so nothing is decoded or copied until the pixels are
+    used. Returns a 2D array, or None if the file can't be mapped (other
+    format, compressed, several frames, ...) and has to be loaded the
+    normal way. The map is copy-on-write, so the array can be changed in
+    place like a loaded one without touching the file. Only the pixels are
+    mapped, headers are parsed by the loaders as before. '''
+
+    if not RAWGlobals.mmap_images:
+        return None
+
+    try:
+        with open(filename, 'rb') as f:
+            magic = f.read(6)
+
+        if magic[:4] in (b'II*\x00', b'MM\x00*'):
+            return mapTiffImage(filename)
+        elif magic == b'\x93NUMPY':
+            img = np.load(filename, mmap_mode = 'c')
+            return img if img.ndim == 2 else None
+        elif magic.lstrip()[:1] == b'{':
+            mapped = mapEdfImage(filename)
+            return mapped[0] if mapped is not None else None
+
+    except (IOError, OSError, ValueError, KeyError, struct.error):
+        # Not a format that can be mapped, the loader reads it the normal way
+        pass
+
+    return None
+
+def _readTiffIFD(f, symbol):
+    ''' Reads the short and long valued tags of the first image file
+    directory, returns them and the offset of the next directory '''
+
+    f.seek(4)
+    ifd_offset = struct.unpack(symbol + 'L', f.read(4))[0]
+
+    f.seek(ifd_offset)
+    num_entries = struct.unpack(symbol + 'H', f.read(2))[0]
+    entries = f.read(12 * num_entries)
+    next_ifd = struct.unpack(symbol + 'L', f.read(4))[0]
+
+    tags = {}
+
+    for i in range(num_entries):
+        entry = entries[12*i : 12*(i+1)]
+        tag, tag_type, count = struct.unpack(symbol + 'HHL', entry[:8])
+
+        if tag_type == 3:
+            fmt, size = 'H', 2
+        elif tag_type == 4:
+            fmt, size = 'L', 4
+        else:
+            continue
+
+        if count * size <= 4:
+            values = struct.unpack(symbol + fmt * count, entry[8 : 8 + count*size])
+        else:
+            f.seek(struct.unpack(symbol + 'L', entry[8:])[0])
+            values = struct.unpack(symbol + fmt * count, f.read(count * size))
+
+        tags[tag] = values
+
+    return tags, next_ifd
+
+def mapTiffImage(filename):
+    ''' Memory maps an uncompressed, single frame, single channel TIFF
+    whose strips are stored back to back. Returns None otherwise. '''
+
+    with open(filename, 'rb') as f:
+        symbol = '<' if f.read(2) == b'II' else '>'
+        tags, next_ifd = _readTiffIFD(f, symbol)
+
+    width = tags[256][0]
+    height = tags[257][0]
+    bits = tags.get(258, (1,))[0]
+    compression = tags.get(259, (1,))[0]
+    samples = tags.get(277, (1,))[0]
+    sample_format = tags.get(339, (1,))[0]
+
+    if (next_ifd != 0 or compression != 1 or samples != 1 or 322 in tags
+        or bits not in (8, 16, 32, 64) or sample_format not in _TIFF_SAMPLE_FORMATS):
+        return None
+
+    offsets = tags[273]
+    byte_counts = tags[279]
+
+    # the strips have to be one contiguous block
+    for i in range(len(offsets)-1):
+        if offsets[i] + byte_counts[i] != offsets[i+1]:
+            return None
+
+    dtype = np.dtype(symbol + _TIFF_SAMPLE_FORMATS[sample_format] + str(bits//8))
+
+    if sum(byte_counts) < width * height * dtype.itemsize:
+        return None
+
+    return np.memmap(filename, dtype = dtype, mode = 'c', offset = offsets[0], shape = (height, width))
+
+def _readEdfHeader(filename):
+    ''' Reads the first header block of an EDF file. Returns the header
+    dictionary, the offset of the data and the file size. '''
+
+    with open(filename, 'rb') as f:
+        header = b''
+        while header.find(b'}') == -1:
+            block = f.read(512)
+            if len(block) == 0 or len(header) > 10000:
+                raise ValueError('No EDF header end found')
+            header = header + block
+
+        f.seek(0, 2)
+        file_size = f.tell()
+
+    hdr_size = header.find(b'}') + 1
+    if header[hdr_size:hdr_size+1] == b'\n':
+        hdr_size = hdr_size + 1
+
+    header_dict = {}
+    for each in header[:hdr_size].decode('latin-1').split('\n'):
+        sp_line = each.split('=')
+
+        if sp_line[0].strip() in ('{', '}', ''):
+            continue
+
+        if len(sp_line) == 2:
+            header_dict[sp_line[0].strip()] = sp_line[1].strip()[:-2]
+        elif len(sp_line) > 2:
+            header_dict[sp_line[0].strip()] = each[each.find('=')+2:-2]
+
+    return header_dict, hdr_size, file_size
+
+def _getEdfDataType(header_dict):
+    if header_dict.get('ByteOrder', 'LowByteFirst') == 'HighByteFirst':
+        symbol = '>'
+    else:
+        symbol = '<'
+
+    return np.dtype(symbol + _EDF_DATA_TYPES.get(header_dict.get('DataType', 'FloatValue'), 'f4'))
+
+def _isEdfCompressed(header_dict):
+    return header_dict.get('Compression', 'None') not in ('None', 'NoCompression')
+
+def mapEdfImage(filename):
+    ''' Memory maps the data of a single frame, uncompressed EDF file.
+    Returns the image and the header dictionary, or None if the file
+    can't be mapped (compressed, several frames or header blocks). '''
+
+    header_dict, hdr_size, file_size = _readEdfHeader(filename)
+
+    if _isEdfCompressed(header_dict):
+        return None
+
+    dim1 = int(header_dict['Dim_1'])
+    dim2 = int(header_dict['Dim_2'])
+    dtype = _getEdfDataType(header_dict)
+
+    # Anything after the data (e.g. the header block of a next frame) is not mapped
+    if file_size != hdr_size + dim1 * dim2 * dtype.itemsize:
+        return None
+
+    # Dim_1 is the fast (column) axis
+    img = np.memmap(filename, dtype = dtype, mode = 'c', offset = hdr_size, shape = (dim2, dim1))
+
+    return img, header_dict
+
 def loadFabio(filename):
+    data = mapImage(filename)
+
+    if data is not None:
+        # Only the header is read by fabio, the pixels stay memory mapped
+        try:
+            hdr = fabio.openheader(filename).header
+        except Exception:
+            hdr = fabio.open(filename).getheader()
+
+        return [np.fliplr(data)], [hdr]
+
     fabio_img = fabio.open(filename)
 
     if fabio_img.nframes == 1:
@@ -281,7 +579,7 @@ def loadFabio(filename):
         data = fabio_img.data
         hdr = fabio_img.getheader()
 
-        img[0] = data
+        img[0] = np.fliplr(data)
         img_hdr[0] = hdr
 
         for i in range(1,fabio_img.nframes):
@@ -296,6 +594,12 @@ def loadFabio(filename):
 
 def loadTiffImage(filename):
     ''' Load TIFF image '''
+    img = mapImage(filename)
+
+    # Only unsigned data, the PIL path reads the pixels as unsigned
+    if img is not None and img.dtype.kind == 'u' and img.dtype.itemsize == 2:
+        return img, {}
+
     try:
         im = Image.open(filename)
         if int(PIL.PILLOW_VERSION.split('.')[0])>2:
@@ -303,7 +607,8 @@ def loadTiffImage(filename):
         else:
             img = np.fromstring(im.tostring(), np.uint16)
 
-        img = np.reshape(img, im.size)
+        # PIL's size is (width, height), the array is (rows, columns)
+        img = np.reshape(img, (im.size[1], im.size[0]))
     except IOError:
         return None, {}
 
@@ -313,6 +618,12 @@ def loadTiffImage(filename):
 
 def load32BitTiffImage(filename):
     ''' Load TIFF image '''
+    img = mapImage(filename)
+
+    # Only unsigned data, the PIL path reads the pixels as unsigned
+    if img is not None and img.dtype.kind == 'u' and img.dtype.itemsize == 4:
+        return img, {}
+
     try:
         im = Image.open(filename)
         if int(PIL.PILLOW_VERSION.split('.')[0])>2:
@@ -320,7 +631,8 @@ def load32BitTiffImage(filename):
         else:
             img = np.fromstring(im.tostring(), np.uint32)
 
-        img = np.reshape(img, im.size)
+        # PIL's size is (width, height), the array is (rows, columns)
+        img = np.reshape(img, (im.size[1], im.size[0]))
     #except IOError:
     except Exception as e:
         print(e)
@@ -544,50 +856,31 @@ def loadIllSANSImage(filename):
     return img, hdr
 
 def loadEdfImage(filename):
+    ''' Loads an EDF image, with the data memory mapped if possible.
+    Only the first frame of a multi-frame file is read. '''
 
-    with open(filename, 'rb') as fo:
-
-        ############## FIND HEADER LENGTH AND READ IMAGE ###########
-        fo.seek(0, 2)
-        eof = fo.tell()
-        fo.seek(0)
-
-        hdr_size = 1
-        byte = None
-        while byte != '}' and hdr_size !=eof:
-            byte = fo.read(1)
-            hdr_size = hdr_size + 1
-            if hdr_size > 10000:
-                raise ValueError
-
-        ######################## PARSE HEADER ###################
-        fo.seek(0)
-        header = fo.read(hdr_size)
-        header = header.split('\n')
-
-        header_dict = {}
-        for each in header:
-            sp_line = each.split('=')
+    mapped = mapEdfImage(filename)
 
-            if sp_line[0].strip() == '{' or sp_line[0].strip() == '}' or sp_line[0].strip() == '':
-                continue
+    if mapped is not None:
+        return mapped
 
-            if len(sp_line) == 2:
-                header_dict[sp_line[0].strip()] = sp_line[1].strip()[:-2]
-            elif len>2:
-                header_dict[sp_line[0].strip()] = each[each.find('=')+2:-2]
+    img_hdr, hdr_size, file_size = _readEdfHeader(filename)
 
-        #print(header_dict)
+    if _isEdfCompressed(img_hdr):
+        raise ValueError('Compressed EDF images are not supported: ' + img_hdr['Compression'])
 
-        fo.seek(hdr_size)
+    dim1 = int(img_hdr['Dim_1'])
+    dim2 = int(img_hdr['Dim_2'])
+    dtype = _getEdfDataType(img_hdr)
 
-        dim1 = int(header_dict['Dim_1'])
-        dim2 = int(header_dict['Dim_2'])
+    with open(filename, 'rb') as f:
+        f.seek(hdr_size)
+        img = np.fromfile(f, dtype = dtype, count = dim1 * dim2)
 
-        img = np.fromfile(fo, dtype='<f4')
-        img = np.reshape(img, (dim1, dim2))
+    if img.size != dim1 * dim2:
+        raise ValueError('EDF file is shorter than its header says')
 
-    img_hdr = header_dict
+    img = np.reshape(img, (dim2, dim1))
 
     return img, img_hdr
 
@@ -925,6 +1218,55 @@ def parseQuantumFileHeader(filename):
     return hdr
 
 
+HEADER_FILE_CACHE_SIZE = 64
+
+_header_file_lines = {}
+_header_file_lock = threading.Lock()
+
+# Header files read by the header parser running on this thread, see HeaderStore
+_header_file_reads = threading.local()
+
+def getFileStamp(filename):
+    ''' (mtime, size) of a file, to tell whether it changed '''
+
+    stat = os.stat(filename)
+
+    return (stat.st_mtime, stat.st_size)
+
+def _recordHeaderFile(path, stamp):
+    files = getattr(_header_file_reads, 'files', None)
+
+    if files is not None:
+        files.append((path, stamp))
+
+def readHeaderFileLines(filename):
+    ''' The lines of a header (counter, log) file, as readlines() gives
+    them. The last files read are cached per (path, mtime), so a file
+    shared by many frames is read once. '''
+
+    stamp = getFileStamp(filename)
+    path = os.path.abspath(filename)
+
+    _recordHeaderFile(path, stamp)
+
+    with _header_file_lock:
+        cached = _header_file_lines.get(path)
+
+    if cached is None or cached[0] != stamp:
+        # Read outside the lock, so other files can be read meanwhile
+        with open(filename, 'r') as f:
+            cached = (stamp, tuple(f.readlines()))
+
+        with _header_file_lock:
+            _header_file_lines.pop(path, None)
+
+            if len(_header_file_lines) >= HEADER_FILE_CACHE_SIZE:
+                _header_file_lines.pop(next(iter(_header_file_lines)))
+
+            _header_file_lines[path] = cached
+
+    return cached[1]
+
 def parseCHESSF2CTSfile(filename):
 
     timeMonitorPattern = re.compile('\d*-second\s[a-z]*\s[()A-Z,]*\s\d*\s\d*')
@@ -932,28 +1274,26 @@ def parseCHESSF2CTSfile(filename):
     datePattern = re.compile('#D\s.*\n')
 
 
-    with open(filename[:-3] + 'cts') as f:
-
-        mon1, mon2, exposure_time, closed_shutter_count = None, None, None, None
+    mon1, mon2, exposure_time, closed_shutter_count = None, None, None, None
 
-        for line in f:
-            timeMonitor_match = timeMonitorPattern.search(line)
-            closedShutterCount_match = closedShutterCountPattern.search(line)
-            date_match = datePattern.search(line)
+    for line in readHeaderFileLines(filename[:-3] + 'cts'):
+        timeMonitor_match = timeMonitorPattern.search(line)
+        closedShutterCount_match = closedShutterCountPattern.search(line)
+        date_match = datePattern.search(line)
 
-            if timeMonitor_match:
-                exposure_time = int(timeMonitor_match.group().split('-')[0])
-                mon1 = int(timeMonitor_match.group().split(' ')[3])
-                mon2 = int(timeMonitor_match.group().split(' ')[4])
+        if timeMonitor_match:
+            exposure_time = int(timeMonitor_match.group().split('-')[0])
+            mon1 = int(timeMonitor_match.group().split(' ')[3])
+            mon2 = int(timeMonitor_match.group().split(' ')[4])
 
-            if closedShutterCount_match:
-                closed_shutter_count = int(closedShutterCount_match.group().split(' ')[1])
+        if closedShutterCount_match:
+            closed_shutter_count = int(closedShutterCount_match.group().split(' ')[1])
 
-            if date_match:
-                try:
-                    date = date_match.group()[3:-1]
-                except Exception:
-                    date = 'Error loading date'
+        if date_match:
+            try:
+                date = date_match.group()[3:-1]
+            except Exception:
+                date = 'Error loading date'
 
     background = closed_shutter_count * exposure_time
 
@@ -966,75 +1306,251 @@ def parseCHESSF2CTSfile(filename):
 
     return counters
 
-def parseCHESSG1CountFile(filename):
-    ''' Loads information from the counter file at CHESS, G1 from
-    the image filename '''
-    dir, file = os.path.split(filename)
-    underscores = file.split('_')
+class SpecFileIndex():
+    ''' Index of a spec style counter file: the byte offset of every line
+    and, for every scan number, the line numbers of its #S, #D and #L
+    lines. The counter rows of a scan are read and split the first time a
+    frame of it is asked for, then kept. When the file grows (scans are
+    appended during a measurement) only the new part is indexed, see update.
+    '''
 
-    countFile = underscores[0]
+    # Bytes before the indexed end that have to be unchanged for the file
+    # to count as appended to
+    CHECK_SIZE = 256
 
-    filenumber = int(underscores[-2].strip('scan'))
+    def __init__(self, filename):
+        self.filename = filename
 
-    try:
-        frame_number = int(underscores[-1].split('.')[0])
-    except Exception:
-        frame_number = 0
+        self.line_starts = np.zeros(0, dtype = np.int64)
 
+        # scan number -> {'S': line, 'D': line, 'L': line}
+        self.scans = {}
 
-    if len(underscores)>3:
-        for each in underscores[1:-2]:
-            countFile += '_' + each
+        # scan number -> (labels, rows, date, complete), see _getScanRows
+        self._scan_rows = {}
 
-    countFilename = os.path.join(dir, countFile)
+        # Line numbers of all #S lines, in order
+        self._scan_starts = []
 
-    with open(countFilename,'r') as f:
-        allLines = f.readlines()
+        # Scans whose #L line wasn't found yet (as parseCHESSG1CountFile
+        # used to scan the file, the #D and #L lines are the ones following
+        # the first #S line of a scan)
+        self._pending = []
 
-    line_num = 0
-    start_found = False
-    start_idx = None
-    label_idx = None
-    date_idx = None
+        # End of the last complete line indexed, and the bytes before it
+        self._indexed_size = 0
+        self._check_bytes = b''
 
-    for eachLine in allLines:
-        splitline = eachLine.split()
+        self._lock = threading.Lock()
 
-        if len(splitline) > 1:
-            if splitline[0] == '#S' and splitline[1] == str(filenumber):
-                start_found = True
-                start_idx = line_num
+        self.update()
 
-            if splitline[0] == '#D' and start_found:
-                date_idx = line_num
+    def isAppendedTo(self):
+        ''' Whether the file only grew since it was indexed, so update can
+        index the new part instead of the file being indexed again '''
 
-            if splitline[0] == '#L' and start_found:
-                label_idx = line_num
-                break
+        with self._lock:
+            indexed_size = self._indexed_size
+            check_bytes = self._check_bytes
 
-        line_num = line_num + 1
+        try:
+            with open(self.filename, 'rb') as f:
+                f.seek(0, os.SEEK_END)
 
-    counters = {}
-    try:
-        if start_idx and label_idx:
-            labels = allLines[label_idx].split()
-            vals = allLines[label_idx+1+frame_number].split()
+                if f.tell() < indexed_size:
+                    return False
 
-        for idx in range(0,len(vals)):
-            counters[labels[idx+1]] = vals[idx]
+                f.seek(indexed_size - len(check_bytes))
 
-        if date_idx:
-            counters['date'] = allLines[date_idx][3:-1]
+                return f.read(len(check_bytes)) == check_bytes
 
-    except:
-        print('Error loading G1 header')
+        except (IOError, OSError):
+            return False
 
-    return counters
+    def update(self):
+        ''' Indexes the part of the file after the last complete line that
+        was indexed. A header line without a line ending (still being
+        written) is indexed once it is complete. '''
 
-def parseCHESSG1CountFileWAXS(filename):
+        with self._lock:
+            with open(self.filename, 'rb') as f:
+                f.seek(self._indexed_size)
+                data = f.read()
+
+            offset = self._indexed_size
+
+            buf = np.frombuffer(data, dtype = np.uint8)
+
+            line_ends = np.flatnonzero(buf == ord('\n')) + 1
+            new_starts = np.concatenate(([0], line_ends))
+            if new_starts[-1] == len(data):
+                new_starts = new_starts[:-1]
+
+            first_line = len(self.line_starts)
+
+            # The unfinished last line is read again from its start
+            if first_line > 0 and self.line_starts[-1] >= offset:
+                first_line -= 1
+
+            self.line_starts = np.concatenate((self.line_starts[:first_line], new_starts + offset))
+
+            complete = new_starts[:len(line_ends)]
+
+            for line in np.flatnonzero(buf[complete] == ord('#')):
+                text = self._decode(data[complete[line]:line_ends[line]])
+                self._indexLine(first_line + int(line), text.split())
+
+            if len(line_ends) > 0:
+                self._indexed_size = offset + int(line_ends[-1])
+                self._check_bytes = (self._check_bytes + data[:int(line_ends[-1])])[-self.CHECK_SIZE:]
+
+            # The rows of the last scan may have grown
+            for scan in [scan for scan, rows in self._scan_rows.items() if not rows[3]]:
+                del self._scan_rows[scan]
+
+    def _indexLine(self, line_num, splitline):
+        if len(splitline) < 2:
+            return
+
+        if splitline[0] == '#S':
+            self._scan_starts.append(line_num)
+
+            if splitline[1] not in self.scans:
+                self.scans[splitline[1]] = {'S': line_num, 'D': None, 'L': None}
+                self._pending.append(splitline[1])
+
+        elif splitline[0] == '#D':
+            for scan in self._pending:
+                self.scans[scan]['D'] = line_num
+
+        elif splitline[0] == '#L':
+            for scan in self._pending:
+                self.scans[scan]['L'] = line_num
+            self._pending = []
+
+    def _decode(self, line):
+        return line.decode('utf-8', 'replace').replace('\r\n', '\n')
+
+    def readLine(self, f, line_num):
+        ''' Line line_num (with its line ending) of the open file f '''
+
+        if line_num >= len(self.line_starts):
+            raise IndexError('Line %i is past the end of %s' %(line_num, self.filename))
+
+        f.seek(self.line_starts[line_num])
+
+        return self._decode(f.readline())
+
+    def _getScanRows(self, scan):
+        ''' The labels of the #L line of a scan, the split lines after it
+        (up to the next #S line) and the date of its #D line. Kept once
+        read, until the file grows if the rows run to the end of the file.
+        '''
+
+        cached = self._scan_rows.get(scan)
+
+        if cached is None:
+            scan_lines = self.scans[scan]
+
+            first = scan_lines['L']
+
+            if first is None:
+                raise KeyError('No #L line for scan %s' %(scan))
+
+            next_scan = bisect.bisect_right(self._scan_starts, first)
+
+            if next_scan < len(self._scan_starts):
+                last = self._scan_starts[next_scan]
+                complete = True
+            else:
+                last = len(self.line_starts)
+                complete = False
+
+            with open(self.filename, 'rb') as f:
+                f.seek(self.line_starts[first])
+
+                if last < len(self.line_starts):
+                    data = f.read(self.line_starts[last] - self.line_starts[first])
+                else:
+                    data = f.read()
+
+                if scan_lines['D'] is not None:
+                    date = self.readLine(f, scan_lines['D'])[3:-1]
+                else:
+                    date = None
+
+            lines = [self._decode(line).split() for line in data.split(b'\n')[:last-first]]
+
+            cached = (lines[0], lines[1:], date, complete)
+            self._scan_rows[scan] = cached
+
+        return cached
+
+    def getCounters(self, scan, frame_number):
+        ''' Counters of a frame of a scan, by the labels of the #L line, and
+        the date of the #D line '''
+
+        counters = {}
+
+        try:
+            with self._lock:
+                labels, rows, date, complete = self._getScanRows(str(scan))
+
+            vals = rows[frame_number]
+
+            for idx in range(0,len(vals)):
+                counters[labels[idx+1]] = vals[idx]
+
+            if date is not None:
+                counters['date'] = date
+
+        except (KeyError, IndexError, ValueError) as error:
+            raise SASExceptions.HeaderLoadError('Error loading G1 header for scan %s frame %s of %s: %s'
+                                                %(scan, frame_number, self.filename, error))
+
+        return counters
+
+
+SPEC_FILE_INDEX_CACHE_SIZE = 16
+
+_spec_file_indexes = {}
+_spec_file_index_lock = threading.Lock()
+
+def getSpecFileIndex(filename):
+    ''' The SpecFileIndex of a counter file, cached per (path, mtime), so
+    a counter file is only read again when it changes. A file that was
+    only appended to is updated instead of indexed again. '''
+
+    stamp = getFileStamp(filename)
+    path = os.path.abspath(filename)
+
+    _recordHeaderFile(path, stamp)
+
+    with _spec_file_index_lock:
+        cached = _spec_file_indexes.get(path)
+
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    if cached is not None and cached[1].isAppendedTo():
+        index = cached[1]
+        index.update()
+    else:
+        index = SpecFileIndex(filename)
+
+    with _spec_file_index_lock:
+        _spec_file_indexes.pop(path, None)
+
+        if len(_spec_file_indexes) >= SPEC_FILE_INDEX_CACHE_SIZE:
+            _spec_file_indexes.pop(next(iter(_spec_file_indexes)))
+
+        _spec_file_indexes[path] = (stamp, index)
+
+    return index
+
+def parseCHESSG1CountFile(filename):
     ''' Loads information from the counter file at CHESS, G1 from
     the image filename '''
-
     dir, file = os.path.split(filename)
     underscores = file.split('_')
 
@@ -1049,54 +1565,37 @@ def parseCHESSG1CountFileWAXS(filename):
 
 
     if len(underscores)>3:
-        for each in underscores[1:-3]:
+        for each in underscores[1:-2]:
             countFile += '_' + each
 
     countFilename = os.path.join(dir, countFile)
 
-    with open(countFilename,'r') as f:
-        allLines = f.readlines()
+    return getSpecFileIndex(countFilename).getCounters(filenumber, frame_number)
 
-    line_num = 0
-    start_found = False
-    start_idx = None
-    label_idx = None
-    date_idx = None
-
-    for eachLine in allLines:
-        splitline = eachLine.split()
-
-        if len(splitline) > 1:
-            if splitline[0] == '#S' and splitline[1] == str(filenumber):
-                start_found = True
-                start_idx = line_num
+def parseCHESSG1CountFileWAXS(filename):
+    ''' Loads information from the counter file at CHESS, G1 from
+    the image filename '''
 
-            if splitline[0] == '#D' and start_found:
-                date_idx = line_num
+    dir, file = os.path.split(filename)
+    underscores = file.split('_')
 
-            if splitline[0] == '#L' and start_found:
-                label_idx = line_num
-                break
+    countFile = underscores[0]
 
-        line_num = line_num + 1
+    filenumber = int(underscores[-2].strip('scan'))
 
-    counters = {}
     try:
-        if start_idx and label_idx:
-            labels = allLines[label_idx].split()
-            vals = allLines[label_idx+1+frame_number].split()
-
-        for idx in range(0,len(vals)):
-            counters[labels[idx+1]] = vals[idx]
+        frame_number = int(underscores[-1].split('.')[0])
+    except Exception:
+        frame_number = 0
 
-        if date_idx:
-            counters['date'] = allLines[date_idx][3:-1]
 
-    except:
-        print('Error loading G1 header')
+    if len(underscores)>3:
+        for each in underscores[1:-3]:
+            countFile += '_' + each
 
+    countFilename = os.path.join(dir, countFile)
 
-    return counters
+    return getSpecFileIndex(countFilename).getCounters(filenumber, frame_number)
 
 def parseCHESSG1CountFileEiger(filename):
     ''' Loads information from the counter file at CHESS, G1 from
@@ -1123,57 +1622,14 @@ def parseCHESSG1CountFileEiger(filename):
 
     countFilename = os.path.join(dir, countFile)
 
-    with open(countFilename,'r') as f:
-        allLines = f.readlines()
-
-    line_num = 0
-    start_found = False
-    start_idx = None
-    label_idx = None
-    date_idx = None
-
-    for eachLine in allLines:
-        splitline = eachLine.split()
-
-        if len(splitline) > 1:
-            if splitline[0] == '#S' and splitline[1] == str(filenumber):
-                start_found = True
-                start_idx = line_num
-
-            if splitline[0] == '#D' and start_found:
-                date_idx = line_num
-
-            if splitline[0] == '#L' and start_found:
-                label_idx = line_num
-                break
-
-        line_num = line_num + 1
-
-    counters = {}
-
-    try:
-        if start_idx and label_idx:
-            labels = allLines[label_idx].split()
-            vals = allLines[label_idx+1+frame_number].split()
-
-        for idx in range(0,len(vals)):
-            counters[labels[idx+1]] = vals[idx]
-
-        if date_idx:
-            counters['date'] = allLines[date_idx][3:-1]
-
-    except:
-        print('Error loading G1 header')
-
-    return counters
+    return getSpecFileIndex(countFilename).getCounters(filenumber, frame_number)
 
 def parseMAXLABI911HeaderFile(filename):
 
     filepath, ext = os.path.splitext(filename)
     hdr_file = filename + '.hdr'
 
-    with open(hdr_file,'r') as f:
-        all_lines = f.readlines()
+    all_lines = readHeaderFileLines(hdr_file)
 
     counters = {}
 
@@ -1190,8 +1646,7 @@ def parseMAXLABI77HeaderFile(filename):
     filepath, ext = os.path.splitext(filename)
     hdr_file = filename + '.hdr'
 
-    with open(hdr_file,'r') as f:
-        all_lines = f.readlines()
+    all_lines = readHeaderFileLines(hdr_file)
 
     counters = {}
 
@@ -1242,8 +1697,7 @@ def parseBioCATlogfile(filename):
 
     countFilename=os.path.join(datadir, '_'.join(fname.split('_')[:-1])+'.log')
 
-    with open(countFilename,'r') as f:
-        allLines=f.readlines()
+    allLines = readHeaderFileLines(countFilename)
 
     searchName='.'.join(fname.split('.')[:-1])
 
@@ -1301,11 +1755,10 @@ def parseBL19U2HeaderFile(filename):
 
     counters = {}
 
-    with open(countFilename, 'r') as f:
-        for line in f:
-            name = line.split(':')[0]
-            value = ':'.join(line.split(':')[1:])
-            counters[name.strip()] = value.strip()
+    for line in readHeaderFileLines(countFilename):
+        name = line.split(':')[0]
+        value = ':'.join(line.split(':')[1:])
+        counters[name.strip()] = value.strip()
 
     return counters
 
@@ -1326,11 +1779,10 @@ def parsePetraIIIP12EigerFile(filename, new_filename = None):
 
     counters = {}
 
-    with open(countFilename, 'r') as f:
-        for line in f:
-            name = line.split(':')[0]
-            value = ':'.join(line.split(':')[1:])
-            counters[name.strip()] = value.strip()
+    for line in readHeaderFileLines(countFilename):
+        name = line.split(':')[0]
+        value = ':'.join(line.split(':')[1:])
+        counters[name.strip()] = value.strip()
 
     return counters
 
@@ -1355,79 +1807,108 @@ all_header_types = {'None'                  : None,
                     'BL19U2, SSRF'          : parseBL19U2HeaderFile,
                     'P12 Eiger, Petra III'  : parsePetraIIIP12EigerFile}
 
+# Image formats are registered with registerImageFormat below, with the
+# magic numbers and extensions checkFileType uses to recognize them.
+# all_image_types (format name -> loader) is the list of formats in the
+# options.
+
+all_image_types = {}
+
+# (offset, magic bytes, format name) of the registered formats
+image_magic_numbers = []
+
+# file extension -> names of the formats using it
+image_extensions = {}
+
+TIFF_MAGIC = [(0, b'II*\x00'), (0, b'MM\x00*')]
+EDF_MAGIC = [(0, b'{\n'), (0, b'{\r\n')]
+CBF_MAGIC = [(0, b'###CBF')]
+HDF5_MAGIC = [(0, b'\x89HDF\r\n\x1a\n')]
+MAR345_MAGIC = [(0, b'\xd2\x04\x00\x00'), (0, b'\x00\x00\x04\xd2')]
+NUMPY_MAGIC = [(0, b'\x93NUMPY')]
+BRUKER_MAGIC = [(0, b'FORMAT :')]
+
+def registerImageFormat(name, loader, magic = (), extensions = ()):
+    ''' Registers the loader of an image format. magic is a list of
+    (offset, bytes) signatures of the files, extensions the file extensions
+    of the format. '''
+
+    all_image_types[name] = loader
+
+    for offset, magic_bytes in magic:
+        image_magic_numbers.append((offset, magic_bytes, name))
+
+    for ext in extensions:
+        image_extensions.setdefault(ext.lower(), []).append(name)
+
+def sniffImageFormats(header_bytes):
+    ''' Names of the registered formats whose magic numbers match the first
+    bytes of a file '''
+
+    return [name for offset, magic_bytes, name in image_magic_numbers
+            if header_bytes[offset:offset+len(magic_bytes)] == magic_bytes]
+
 if use_fabio:
-    all_image_types = {
-                       'Pilatus'       : loadFabio,
-                       'CBF'                : loadFabio,
-                       'SAXSLab300'         : loadSAXSLAB300Image,
-                       'ADSC Quantum'       : loadFabio,
-                       'Bruker'             : loadFabio,
-                       'Gatan Digital Micrograph' : loadFabio,
-                       'EDNA-XML'           : loadFabio,
-                       'ESRF EDF'           : loadFabio,
-                       'FReLoN'             : loadFrelonImage,
-                       'Nonius KappaCCD'    : loadFabio,
-                       'Fit2D spreadsheet'  : loadFabio,
-                       'FLICAM'             : loadTiffImage,
-                       'General Electric'   : loadFabio,
-                       'Hamamatsu CCD'      : loadFabio,
-                       'HDF5 (Hierarchical data format)'  : loadFabio,
-                       'ILL SANS D11'       : loadIllSANSImage,
-                       'MarCCD 165'         : loadFabio,
-                       'Mar345'             : loadFabio,
-                       'Medoptics'          : loadTiffImage,
-                       'Numpy 2D Array'     : loadFabio,
-                       'Oxford Diffraction' : loadFabio,
-                       'Pixi'               : loadFabio,
-                       'Portable aNy Map'   : loadFabio,
-                       'Rigaku SAXS format' : loadFabio,
-                       '16 bit TIF'         : loadFabio,
-                       '32 bit TIF'         : load32BitTiffImage,
-                       'MPA (multiwire)'    : loadMPAFile
-                       # 'NeXus'           : loadNeXusFile,
-                                          }
+    registerImageFormat('Pilatus',                  loadFabio,              TIFF_MAGIC + CBF_MAGIC, ['.tif', '.tiff', '.cbf'])
+    registerImageFormat('CBF',                      loadFabio,              CBF_MAGIC,              ['.cbf'])
+    registerImageFormat('SAXSLab300',               loadSAXSLAB300Image,    TIFF_MAGIC,             ['.tif', '.tiff'])
+    registerImageFormat('ADSC Quantum',             loadFabio,              EDF_MAGIC,              ['.img'])
+    registerImageFormat('Bruker',                   loadFabio,              BRUKER_MAGIC,           ['.sfrm'])
+    registerImageFormat('Gatan Digital Micrograph', loadFabio,              [],                     ['.dm3'])
+    registerImageFormat('EDNA-XML',                 loadFabio,              [],                     ['.xml'])
+    registerImageFormat('ESRF EDF',                 loadFabio,              EDF_MAGIC,              ['.edf'])
+    registerImageFormat('FReLoN',                   loadFrelonImage,        EDF_MAGIC,              ['.edf'])
+    registerImageFormat('Nonius KappaCCD',          loadFabio,              [],                     ['.kccd'])
+    registerImageFormat('Fit2D spreadsheet',        loadFabio,              [],                     ['.spr'])
+    registerImageFormat('FLICAM',                   loadTiffImage,          TIFF_MAGIC,             ['.tif', '.tiff'])
+    registerImageFormat('General Electric',         loadFabio,              [],                     [])
+    registerImageFormat('Hamamatsu CCD',            loadFabio,              [],                     [])
+    registerImageFormat('HDF5 (Hierarchical data format)', loadFabio,       HDF5_MAGIC,             ['.h5', '.nxs'])
+    registerImageFormat('ILL SANS D11',             loadIllSANSImage,       [],                     [])
+    registerImageFormat('MarCCD 165',               loadFabio,              TIFF_MAGIC,             ['.mccd'])
+    registerImageFormat('Mar345',                   loadFabio,              MAR345_MAGIC,           ['.mar1200', '.mar2300', '.mar2400', '.mar3450', '.mar3600'])
+    registerImageFormat('Medoptics',                loadTiffImage,          TIFF_MAGIC,             ['.tif', '.tiff'])
+    registerImageFormat('Numpy 2D Array',           loadFabio,              NUMPY_MAGIC,            ['.npy'])
+    registerImageFormat('Oxford Diffraction',       loadFabio,              [],                     ['.img'])
+    registerImageFormat('Pixi',                     loadFabio,              [],                     [])
+    registerImageFormat('Portable aNy Map',         loadFabio,              [],                     ['.pnm'])
+    registerImageFormat('Rigaku SAXS format',       loadFabio,              [],                     [])
+    registerImageFormat('16 bit TIF',               loadFabio,              TIFF_MAGIC,             ['.tif', '.tiff'])
+    registerImageFormat('32 bit TIF',               load32BitTiffImage,     TIFF_MAGIC,             ['.tif', '.tiff'])
+    registerImageFormat('MPA (multiwire)',          loadMPAFile,            [],                     ['.mpa'])
+    # registerImageFormat('NeXus',                  loadNeXusFile,          HDF5_MAGIC,             ['.nxs'])
 
     if use_eiger:
-        # all_image_types['Eiger'] =  loadEiger
-        all_image_types['Eiger'] = loadFabio
+        # registerImageFormat('Eiger',              loadEiger,              HDF5_MAGIC,             ['.h5'])
+        registerImageFormat('Eiger',                loadFabio,              HDF5_MAGIC,             ['.h5'])
 
 else:
-    all_image_types = {'Quantum'            : loadQuantumImage,
-                       'MarCCD 165'             : loadMarCCD165Image,
-                       'Medoptics'              : loadTiffImage,
-                       'FLICAM'                 : loadTiffImage,
-                       'Pilatus'                : loadPilatusImage,
-                       'SAXSLab300'             : loadSAXSLAB300Image,
-                       'ESRF EDF'               : loadEdfImage,
-                       'FReLoN'                 : loadFrelonImage,
-                       '16 bit TIF'             : loadTiffImage,
-                       '32 bit TIF'             : load32BitTiffImage,
-                       # 'NeXus'                : loadNeXusFile,
-                       'ILL SANS D11'           : loadIllSANSImage,
-                       'MPA (multiwire)'        : loadMPAFile
-                       }
+    registerImageFormat('Quantum',                  loadQuantumImage,       EDF_MAGIC,              ['.img'])
+    registerImageFormat('MarCCD 165',               loadMarCCD165Image,     TIFF_MAGIC,             ['.mccd'])
+    registerImageFormat('Medoptics',                loadTiffImage,          TIFF_MAGIC,             ['.tif', '.tiff'])
+    registerImageFormat('FLICAM',                   loadTiffImage,          TIFF_MAGIC,             ['.tif', '.tiff'])
+    registerImageFormat('Pilatus',                  loadPilatusImage,       TIFF_MAGIC,             ['.tif', '.tiff'])
+    registerImageFormat('SAXSLab300',               loadSAXSLAB300Image,    TIFF_MAGIC,             ['.tif', '.tiff'])
+    registerImageFormat('ESRF EDF',                 loadEdfImage,           EDF_MAGIC,              ['.edf'])
+    registerImageFormat('FReLoN',                   loadFrelonImage,        EDF_MAGIC,              ['.edf'])
+    registerImageFormat('16 bit TIF',               loadTiffImage,          TIFF_MAGIC,             ['.tif', '.tiff'])
+    registerImageFormat('32 bit TIF',               load32BitTiffImage,     TIFF_MAGIC,             ['.tif', '.tiff'])
+    # registerImageFormat('NeXus',                  loadNeXusFile,          HDF5_MAGIC,             ['.nxs'])
+    registerImageFormat('ILL SANS D11',             loadIllSANSImage,       [],                     [])
+    registerImageFormat('MPA (multiwire)',          loadMPAFile,            [],                     ['.mpa'])
 
     if read_mar345:
-        all_image_types['Mar345'] = loadMar345Image
+        registerImageFormat('Mar345',               loadMar345Image,        MAR345_MAGIC,           ['.mar1200', '.mar2300', '.mar2400', '.mar3450', '.mar3600'])
 
 def loadAllHeaders(filename, image_type, header_type, raw_settings):
     ''' returns the image header and the info from the header file only. '''
 
     img, imghdr = loadImage(filename, image_type)
 
-    if len(img) > 1:
-        temp_filename = os.path.split(filename)[1].split('.')
-        if len(temp_filename) > 1:
-            temp_filename[-2] = temp_filename[-2] + '_%05i' %(0)
-        else:
-            temp_filename[0] = temp_filename[0] + '_%05i' %(0)
-
-        new_filename = '.'.join(temp_filename)
-    else:
-        new_filename = os.path.split(filename)[1]
+    new_filename = getFrameFilename(filename, 0, len(img))
 
     if header_type != 'None':
-        hdr = loadHeader(filename, new_filename, header_type)
+        hdr = dict(header_store.load(filename, new_filename, header_type))
     else:
         hdr = None
 
@@ -1447,6 +1928,24 @@ def loadAllHeaders(filename, image_type, header_type, raw_settings):
 
     return imghdr, hdr
 
+def cleanHeader(hdr):
+    ''' Clean up headers by removing spaces in header names and non-unicode characters '''
+
+    try:  # python 2
+        hdr = {key.replace(' ', '_').translate(None, '()[]') : hdr[key] for key in hdr}
+        hdr = { key : unicode(hdr[key], errors='ignore') if type(hdr[key]) == str else hdr[key] for key in hdr}
+    except TypeError:  # python 3
+        hdr = {key.replace(' ', '_').translate(''.maketrans('', '', '()[]')) : 
+               hdr[key].decode('utf-8') if isinstance(hdr[key], bytes) else hdr[key]
+               for key in hdr}
+
+    try:
+        json.dumps(hdr)
+    except UnicodeDecodeError as e:
+        hdr = { key : unicode(hdr[key], errors='ignore') if type(hdr[key]) == str else hdr[key] for key in hdr}
+
+    return hdr
+
 def loadHeader(filename, new_filename, header_type):
     ''' returns header information based on the *image* filename
      and the type of headerfile     '''
@@ -1465,21 +1964,88 @@ def loadHeader(filename, new_filename, header_type):
     else:
         hdr = {}
 
-    #Clean up headers by removing spaces in header names and non-unicode characters)
-    try:  # python 2
-        hdr = {key.replace(' ', '_').translate(None, '()[]') : hdr[key] for key in hdr}
-        hdr = { key : unicode(hdr[key], errors='ignore') if type(hdr[key]) == str else hdr[key] for key in hdr}
-    except TypeError:  # python 3
-        hdr = {key.replace(' ', '_').translate(''.maketrans('', '', '()[]')) : 
-               hdr[key].decode('utf-8') if isinstance(hdr[key], bytes) else hdr[key]
-               for key in hdr}
+    return cleanHeader(hdr)
 
-    try:
-        json.dumps(hdr)
-    except UnicodeDecodeError as e:
-        hdr = { key : unicode(hdr[key], errors='ignore') if type(hdr[key]) == str else hdr[key] for key in hdr}
 
-    return hdr
+class FrozenHeader(dict):
+    ''' Read-only header dictionary, as kept by the HeaderStore and shared
+    by everything that loads the same header. Copy it (dict(hdr)) to make
+    changes. Copies and pickles of it are normal dictionaries. '''
+
+    def _readOnly(self, *args, **kwargs):
+        raise TypeError('Header from the header store is read-only, copy it to make changes')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readOnly
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+class HeaderStore():
+    ''' Cache of cleaned headers (loadHeader) as FrozenHeaders, by header
+    type, image filename and frame filename. A header is parsed again only
+    when one of the header files its parser read (readHeaderFileLines,
+    getSpecFileIndex) changed, found by their (mtime, size). Headers are
+    parsed outside the lock, so loadMany parses them in parallel. '''
+
+    MAX_ENTRIES = 100000
+
+    def __init__(self):
+        self._headers = {}
+        self._lock = threading.Lock()
+
+    def load(self, filename, new_filename, header_type):
+        ''' The header of a frame, see loadHeader '''
+
+        key = (header_type, os.path.abspath(filename), new_filename)
+
+        with self._lock:
+            cached = self._headers.get(key)
+
+        if cached is not None and self._isCurrent(cached[0]):
+            return cached[1]
+
+        _header_file_reads.files = []
+
+        try:
+            hdr = FrozenHeader(loadHeader(filename, new_filename, header_type))
+        finally:
+            header_files = _header_file_reads.files
+            _header_file_reads.files = None
+
+        with self._lock:
+            if len(self._headers) >= self.MAX_ENTRIES:
+                self._headers.clear()
+
+            self._headers[key] = (header_files, hdr)
+
+        return hdr
+
+    def loadMany(self, filename_list, header_type, threads = 4):
+        ''' Headers of (single frame) image files, loaded on a thread pool.
+        Returns them in the order of filename_list, or raises the first
+        error. '''
+
+        def load(filename):
+            return self.load(filename, os.path.split(filename)[1], header_type)
+
+        if threads <= 1 or len(filename_list) <= 1:
+            return [load(filename) for filename in filename_list]
+
+        with ThreadPoolExecutor(max_workers = threads) as pool:
+            return list(pool.map(load, filename_list))
+
+    def clear(self):
+        with self._lock:
+            self._headers.clear()
+
+    def _isCurrent(self, header_files):
+        try:
+            return all(getFileStamp(path) == stamp for path, stamp in header_files)
+        except OSError:
+            return False
+
+# The header store of this process
+header_store = HeaderStore()
 
 def loadImage(filename, image_type):
     ''' returns the loaded image based on the image filename
@@ -1496,34 +2062,19 @@ def loadImage(filename, image_type):
     if type(imghdr) != list:
         imghdr = [imghdr]
 
-
-    #Clean up headers by removing spaces in header names and non-unicode characters)
-    for hdr in imghdr:
-        try:  # python 2
-            hdr = {key.replace(' ', '_').translate(None, '()[]') : hdr[key] for key in hdr}
-            hdr = { key : unicode(hdr[key], errors='ignore') if type(hdr[key]) == str else hdr[key] for key in hdr}
-        except TypeError:  # python 3
-            hdr = {key.replace(' ', '_').translate(''.maketrans('', '', '()[]')) : 
-                   hdr[key].decode('utf-8') if isinstance(hdr[key], bytes) else hdr[key]
-                   for key in hdr}
-
-        try:
-            json.dumps(hdr)
-        except UnicodeDecodeError:
-            hdr = { key : unicode(hdr[key], errors='ignore') if type(hdr[key]) == str else hdr[key] for key in hdr}
-
     return img, imghdr
 
 #################################
 #--- ** MAIN LOADING FUNCTION **
 #################################
 
-def loadFile(filename, raw_settings, no_processing = False):
-    ''' Loads a file an returns a SAS Measurement Object (SASM) and the full image if the
-        selected file was an Image file
+def preloadFile(filename, raw_settings, read_pixels = True):
+    ''' Does the file reading part of loadFile: finds out the file type and
+    reads the image frames and their headers, or parses an ascii file. The
+    returned dictionary can be given to loadFile as preloaded, so the next
+    files can be read on other threads while one is integrated. If
+    read_pixels, memory mapped images are read into memory here. '''
 
-         NB: This is the function used to load any type of file in RAW
-    '''
     try:
         file_type = checkFileType(filename)
         print(file_type)
@@ -1533,9 +2084,34 @@ def loadFile(filename, raw_settings, no_processing = False):
         print(str(msg), file=sys.stderr)
         file_type = None
 
+    preloaded = {'file_type' : file_type}
+
+    if file_type == 'image':
+        try:
+            preloaded.update(readImageFile(filename, raw_settings, read_pixels))
+        except (ValueError, AttributeError) as msg:
+            print('SASFileIO.loadFile : ' + str(msg))
+            raise SASExceptions.UnrecognizedDataFormat('No data could be retrieved from the file, unknown format.')
+    else:
+        preloaded['sasm'] = loadAsciiFile(filename, file_type)
+
+    return preloaded
+
+def loadFile(filename, raw_settings, no_processing = False, preloaded = None):
+    ''' Loads a file an returns a SAS Measurement Object (SASM) and the full image if the
+        selected file was an Image file. preloaded is the result of
+        preloadFile for the file, if it was already read.
+
+         NB: This is the function used to load any type of file in RAW
+    '''
+    if preloaded is None:
+        preloaded = preloadFile(filename, raw_settings, read_pixels = False)
+
+    file_type = preloaded['file_type']
+
     if file_type == 'image':
         try:
-            sasm, img = loadImageFile(filename, raw_settings)
+            sasm, img = loadImageFile(filename, raw_settings, preloaded)
         except (ValueError, AttributeError) as msg:
             print('SASFileIO.loadFile : ' + str(msg))
             raise SASExceptions.UnrecognizedDataFormat('No data could be retrieved from the file, unknown format.')
@@ -1565,7 +2141,7 @@ def loadFile(filename, raw_settings, no_processing = False):
                 SASM.postProcessImageSasm(sasm, raw_settings)
 
     else:
-        sasm = loadAsciiFile(filename, file_type)
+        sasm = preloaded['sasm']
         img = None
 
         #If you don't want to post process asci files, return them as a list
@@ -1618,43 +2194,153 @@ def loadAsciiFile(filename, file_type):
     return sasm
 
 
-def loadImageFile(filename, raw_settings):
+def getFrameFilename(filename, frame, nframes):
+    ''' Name of a frame of a (multi-frame) image file, as used for the
+    loaded curves and their header files '''
+
+    if nframes > 1:
+        temp_filename = os.path.split(filename)[1].split('.')
+        if len(temp_filename) > 1:
+            temp_filename[-2] = temp_filename[-2] + '_%05i' %(frame)
+        else:
+            temp_filename[0] = temp_filename[0] + '_%05i' %(frame)
+
+        return '.'.join(temp_filename)
+    else:
+        return os.path.split(filename)[1]
+
+def readImageFile(filename, raw_settings, read_pixels = False):
+    ''' Reads the frames of an image file, their image headers and their
+    header (counter) files, everything loadImageFile needs from disk. '''
 
     img_fmt = raw_settings.get('ImageFormat')
     hdr_fmt = raw_settings.get('ImageHdrFormat')
 
     loaded_data, loaded_hdr = loadImage(filename, img_fmt)
 
+    if read_pixels:
+        loaded_data = [np.array(img) if isinstance(img, np.memmap) else img for img in loaded_data]
+
+    filenames = [getFrameFilename(filename, i, len(loaded_data)) for i in range(len(loaded_data))]
+
+    counters = [header_store.load(filename, new_filename, hdr_fmt) for new_filename in filenames]
+
+    return {'img'       : loaded_data,
+            'img_hdr'   : loaded_hdr,
+            'filenames' : filenames,
+            'counters'  : counters}
+
+CORRECTION_IMAGE_CACHE_SIZE = 4
+
+_correction_image_cache = []
+
+def loadCorrectionImage(filename, img_fmt, hdr_fmt):
+    ''' Loads a correction (flatfield or dark) image, averaged over its
+    frames, and its header file info. They are cached for the process by
+    (path, mtime, size, image and header format), so a correction image is
+    read once per run instead of once per loaded file, and again only if
+    the file changes. Returns the cache entry, a dictionary with the
+    (read-only) 'img' and 'hdr' and room for values derived from them. '''
+
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_mtime, stat.st_size, img_fmt, hdr_fmt)
+
+    for entry in _correction_image_cache:
+        if entry['key'] == key:
+            return entry
+
+    img, img_hdr = loadImage(filename, img_fmt)
+
+    # Some loaders return no image instead of raising
+    if any(each is None for each in img):
+        raise SASExceptions.WrongImageFormat('Error loading image, no image data in ' + filename)
+
+    img = np.average(img, axis=0)
+    img.flags.writeable = False
+
+    entry = {'key' : key,
+             'img' : img,
+             'hdr' : header_store.load(filename, os.path.split(filename)[1], hdr_fmt)}
+
+    _correction_image_cache.insert(0, entry)
+    del _correction_image_cache[CORRECTION_IMAGE_CACHE_SIZE:]
+
+    return entry
+
+def clearCorrectionImageCache():
+    del _correction_image_cache[:]
+
+def getFlatfield(raw_settings):
+    ''' The reciprocal of the flatfield image (see
+    SASImage.calcReciprocalFlatfield) and the flatfield header file info '''
+
+    entry = loadCorrectionImage(raw_settings.get('NormFlatfieldFile'), raw_settings.get('ImageFormat'),
+                                raw_settings.get('ImageHdrFormat'))
+
+    if 'reciprocal' not in entry:
+        reciprocal = SASImage.calcReciprocalFlatfield(entry['img'])
+        reciprocal.flags.writeable = False
+        entry['reciprocal'] = reciprocal
+
+    return entry['reciprocal'], entry['hdr']
+
+def getDarkImage(raw_settings):
+    ''' The dark current image and its header file info '''
+
+    entry = loadCorrectionImage(raw_settings.get('DarkCorrFilename'), raw_settings.get('ImageFormat'),
+                                raw_settings.get('ImageHdrFormat'))
+
+    return entry['img'], entry['hdr']
+
+def loadImageFile(filename, raw_settings, preloaded = None):
+
+    img_fmt = raw_settings.get('ImageFormat')
+    hdr_fmt = raw_settings.get('ImageHdrFormat')
+
+    if preloaded is None or 'img' not in preloaded:
+        preloaded = readImageFile(filename, raw_settings)
+
+    loaded_data = preloaded['img']
+    loaded_hdr = preloaded['img_hdr']
+
     sasm_list = [None for i in range(len(loaded_data))]
 
-    #Pre-load the flatfield file, so it's not loaded every time
+    #The correction images are cached, so they're not loaded every time
     if raw_settings.get('NormFlatfieldEnabled'):
         flatfield_filename = raw_settings.get('NormFlatfieldFile')
         if flatfield_filename is not None:
-            flatfield_img, flatfield_img_hdr = loadImage(flatfield_filename, img_fmt)
-            flatfield_hdr = loadHeader(flatfield_filename, flatfield_filename, hdr_fmt)
-            flatfield_img = np.average(flatfield_img, axis=0)
+            if preloaded.get('flatfield') is not None:
+                flatfield_img, flatfield_hdr = preloaded['flatfield']
+            else:
+                flatfield_img, flatfield_hdr = getFlatfield(raw_settings)
+
+    do_dark = raw_settings.get('DarkCorrEnabled') and raw_settings.get('DarkCorrFilename') is not None
+    if do_dark:
+        if preloaded.get('dark') is not None:
+            dark_img, dark_hdr = preloaded['dark']
+        else:
+            dark_img, dark_hdr = getDarkImage(raw_settings)
+
+    # Multi-frame files with one geometry for all frames are integrated as a stack
+    use_stack = (len(loaded_data) > 1
+                 and not RAWGlobals.usepyFAI_integration
+                 and SASImage.getRadialAverageBackend() in ('numpy', 'csr')
+                 and not raw_settings.get('UseHeaderForCalib')
+                 and not (raw_settings.get('UseHeaderForMask') and img_fmt == 'SAXSLab300')
+                 and not raw_settings.get('PixelSplitting'))
+
+    stack_parameters = []
 
     #Process all loaded images into sasms
     for i in range(len(loaded_data)):
         img = loaded_data[i]
         img_hdr = loaded_hdr[i]
 
-        if len(loaded_data) > 1:
-            temp_filename = os.path.split(filename)[1].split('.')
-            if len(temp_filename) > 1:
-                temp_filename[-2] = temp_filename[-2] + '_%05i' %(i)
-            else:
-                temp_filename[0] = temp_filename[0] + '_%05i' %(i)
-
-            new_filename = '.'.join(temp_filename)
-        else:
-            new_filename = os.path.split(filename)[1]
-
-        hdrfile_info = loadHeader(filename, new_filename, hdr_fmt)
+        new_filename = preloaded['filenames'][i]
+        hdrfile_info = preloaded['counters'][i]
 
         parameters = {'imageHeader' : img_hdr,
-                      'counters'    : hdrfile_info,
+                      'counters'    : dict(hdrfile_info),
                       'filename'    : new_filename,
                       'load_path'   : filename}
 
@@ -1719,25 +2405,58 @@ def loadImageFile(filename, raw_settings):
         #####################################################
         y_c = img.shape[0]-y_c
 
+        if use_stack:
+            stack_parameters.append(parameters)
+            continue
+
         if not RAWGlobals.usepyFAI_integration:
             # print('Using standard RAW integration')
-            ## Flatfield correction.. this part gets moved to a image correction function later
+            ## Dark and flatfield correction.. this part gets moved to a image correction function later
+            if do_dark:
+                img = SASImage.doDarkBackgroundCorrection(img, img_hdr, dark_img, dark_hdr)
+
             if raw_settings.get('NormFlatfieldEnabled'):
                 if flatfield_filename is not None:
-                    img, img_hdr = SASImage.doFlatfieldCorrection(img, img_hdr, flatfield_img, flatfield_hdr)
+                    img = SASImage.doFlatfieldCorrection(img, img_hdr, flatfield_img, flatfield_hdr,
+                                                         raw_settings.get('IntegrationThreads'), reciprocal = True)
                 else:
                     pass #Raise some error
 
             dezingering = raw_settings.get('ZingerRemovalRadAvg')
             dezing_sensitivity = raw_settings.get('ZingerRemovalRadAvgStd')
 
-            sasm = createSASMFromImage(img, parameters, x_c, y_c, bs_mask, dc_mask, tbs_mask, dezingering, dezing_sensitivity)
+            if raw_settings.get('PixelSplitting'):
+                oversampling = raw_settings.get('PixelSplittingOversampling')
+                bin_width = raw_settings.get('PixelSplittingBinWidth')
+            else:
+                oversampling = 0
+                bin_width = 1.0
+
+            sasm = createSASMFromImage(img, parameters, x_c, y_c, bs_mask, dc_mask, tbs_mask, dezingering, dezing_sensitivity,
+                                       oversampling, bin_width, getPixelSplittingCache(raw_settings),
+                                       raw_settings.get('IntegrationThreads'),
+                                       getPixelCorrection(raw_settings, img.shape, x_c, y_c, img_hdr, hdrfile_info))
 
         else:
             sasm = SASImage.pyFAIIntegrateCalibrateNormalize(img, parameters, x_c, y_c, raw_settings, bs_mask, tbs_mask)
 
         sasm_list[i] = sasm
 
+    if use_stack:
+        def stackImages():
+            for img in loaded_data:
+                if do_dark:
+                    img = SASImage.doDarkBackgroundCorrection(img, None, dark_img, dark_hdr)
+                if raw_settings.get('NormFlatfieldEnabled') and flatfield_filename is not None:
+                    img = SASImage.doFlatfieldCorrection(img, None, flatfield_img, flatfield_hdr,
+                                                         raw_settings.get('IntegrationThreads'), reciprocal = True)
+                yield img
+
+        sasm_list, roi_counters = createSASMsFromImageStack(stackImages(), stack_parameters, None, x_c, y_c,
+                                                            bs_mask, dc_mask, tbs_mask,
+                                                            raw_settings.get('ZingerRemovalRadAvg'),
+                                                            raw_settings.get('ZingerRemovalRadAvgStd'),
+                                                            getPixelCorrection(raw_settings, loaded_data[0].shape, x_c, y_c))
 
     return sasm_list, loaded_data
 
@@ -3267,66 +3986,81 @@ def writeOutFile(m, filename):
 
 
 
+# Non image files RAW reads, by extension
+data_file_extensions = {'.fit'  : 'fit',
+                        '.fir'  : 'fir',
+                        '.out'  : 'out',
+                        '.int'  : 'int',
+                        '.dat'  : 'primus',
+                        '.sub'  : 'primus',
+                        '.ift'  : 'ift',
+                        '.csv'  : 'csv'}
+
+# Image extensions that aren't in the registered formats (formats that need
+# fabio, or that fabio reads without them being in the image format list)
+other_image_extensions = ['.ccdraw', '.imx_0', '.dkx_0', '.dkx_1', '.png', '.msk', '.No',
+                          '.cbf', '.sfrm', '.dm3', '.xml', '.kccd', '.spr', '.h5', '.nxs',
+                          '.npy', '.pnm', '.mar1200', '.mar2300', '.mar2400', '.mar3450',
+                          '.mar3600']
+
+FILE_TYPE_SNIFF_BYTES = 512
+FILE_TYPE_CACHE_SIZE = 100000
+
+_file_type_cache = {}
+
 def checkFileType(filename):
-    ''' Tries to find out what file type it is and reports it back '''
+    ''' Tries to find out what file type it is and reports it back. Images
+    are recognized by the magic numbers of the registered image formats,
+    from the first bytes of the file; the extension is only used when those
+    don't tell. Results are cached per (path, modification time). '''
+
+    try:
+        mtime = os.stat(filename).st_mtime
+    except OSError:
+        # Let the loader report the missing file
+        return _checkFileTypeFromBytes(filename, b'')
+
+    key = (os.path.abspath(filename), mtime)
+
+    file_type = _file_type_cache.get(key)
 
-    # try:
-    #     with open(filename, "rb") as f:           # Open in binary mode for portability
-    #         try:
-    #             type_tst = SASMarHeaderReader.stringvar(SASMarHeaderReader.fread(f,'cc'))
-    #         except:
-    #             raise Exception('Reading a byte of file ' + filename + ' failed..')
-    # except IOError:
-    #     raise Exception('Reading file ' + filename + ' failed..')
+    if file_type is None:
+        with open(filename, 'rb') as f:
+            header_bytes = f.read(FILE_TYPE_SNIFF_BYTES)
+
+        file_type = _checkFileTypeFromBytes(filename, header_bytes)
+
+        if len(_file_type_cache) >= FILE_TYPE_CACHE_SIZE:
+            _file_type_cache.clear()
+
+        _file_type_cache[key] = file_type
 
-    type_tst = None
+    return file_type
 
+def _checkFileTypeFromBytes(filename, header_bytes):
     path, ext = os.path.splitext(filename)
 
-    if type_tst == 'RR':
-        return 'image'
-    elif type_tst == 'II':   # Test if file is a TIFF file (first two bytes are "II")
-        return 'image'
-    elif ext == '.fit':
-        return 'fit'
-    elif ext == '.fir':
-        return 'fir'
-    elif ext == '.out':
-        return 'out'
-    elif ext == '.nxs': #Nexus file
-        return 'image'
-    elif ext == '.edf':
+    if sniffImageFormats(header_bytes):
         return 'image'
-    elif ext == '.ccdraw':
+    elif ext in data_file_extensions:
+        return data_file_extensions[ext]
+    elif ext.lower() in image_extensions or ext in other_image_extensions:
         return 'image'
-    elif ext == '.int':
-        return 'int'
-    elif ext == '.img' or ext == '.imx_0' or ext == '.dkx_0' or ext == '.dkx_1' or ext == '.png' or ext == '.mpa':
-        return 'image'
-    #elif type_tst == 'BI':
-    #    return 'bift'
-    elif ext == '.dat' or ext == '.sub':
-        return 'primus'
-    elif ext == '.mar1200' or ext == '.mar2400' or ext == '.mar2300' or ext == '.mar3600':
-        return 'image'
-    elif (ext == '.img' or ext == '.sfrm' or ext == '.dm3' or ext == '.edf' or ext == '.xml' or ext == '.cbf' or ext == '.kccd' or
-        ext == '.msk' or ext == '.spr' or ext == '.tif' or ext == '.h5' or ext == '.mccd' or ext == '.mar3450' or ext =='.npy' or
-        ext == '.pnm' or ext == '.No'):
-        return 'image'
-    elif ext == '.ift':
-        return 'ift'
-    elif ext == '.csv':
-        return 'csv'
-    else:
+
+    # Unknown binary files may still be something fabio can read, but only
+    # its header is read to find out. Text files are never images.
+    if use_fabio and b'\x00' in header_bytes:
         try:
-            fabio.open(filename)
+            fabio.openheader(filename)
             return 'image'
-        except:
-            try:
-                float(ext.strip('.'))
-            except Exception:
-                return 'rad'
-            return 'csv'
+        except Exception:
+            pass
+
+    try:
+        float(ext.strip('.'))
+    except Exception:
+        return 'rad'
+    return 'csv'
 
 
 
@@ -25,13 +25,14 @@ Created on Jul 7, 2010
 from __future__ import print_function, division  # TODO: check whether true division is right?
 
 import numpy as np
-from scipy import optimize
-import os, sys, math  # wx
+from scipy import optimize, sparse, ndimage
+import os, sys, math, itertools, threading  # wx
+from concurrent.futures import ThreadPoolExecutor
 
 RAW_DIR = os.path.dirname(os.path.abspath(__file__))
 if RAW_DIR not in sys.path:
     sys.path.append(RAW_DIR)
-import SASExceptions, SASParser, SASCalib, SASM, RAWGlobals
+import SASExceptions, SASParser, SASCalib, SASM, RAWGlobals, SASBinStats, SASMaskCache
 import polygonMasking as polymask
 
 try:
@@ -95,6 +96,22 @@ class Mask:
     def getFillPoints(self):
         pass    # overridden when inherited
 
+    def getFillMatrix(self, img_dim):
+        ''' Boolean array of size img_dim that is True where the mask is
+        (in the same, unflipped, orientation as the fill points). Overridden
+        with direct rasterization in the mask types, this is the fallback
+        using the fill points. '''
+
+        fill = np.zeros(img_dim, dtype = bool)
+
+        points = np.array(self.getFillPoints(), dtype = np.float64).reshape(-1, 2).astype(int)
+
+        inside = (points[:,0] >= 0) & (points[:,0] < img_dim[0]) & (points[:,1] >= 0) & (points[:,1] < img_dim[1])
+
+        fill[points[inside,0], points[inside,1]] = True
+
+        return fill
+
 class CircleMask(Mask):
     ''' Create a circular mask '''
 
@@ -171,6 +188,38 @@ class CircleMask(Mask):
 
         return fillPoints
 
+    def getFillMatrix(self, img_dim):
+        ''' The pixels of getFillPoints, filled in as one span per
+        Bresenham point instead of one pixel at a time. '''
+
+        radiusC = abs(self._points[1][0] - self._points[0][0])
+
+        P = calcBresenhamCirclePoints(radiusC, self._points[0][1], self._points[0][0])
+
+        fill = np.zeros(img_dim, dtype = bool)
+        maxx, maxy = fill.shape
+
+        for i in range(0, int(len(P)/8) ):
+            Pp = P[i*8 : i*8 + 8]
+
+            # Spans of getFillPoints, they all have the length of the first
+            length = int(Pp[0][1]+1) - int(Pp[1][1])
+
+            ud_start, lr_start = int(Pp[1][1]), int(Pp[6][0])
+            ud_stop = min(ud_start + length, int(Pp[0][1]+1))
+            lr_stop = min(lr_start + length, int(Pp[4][0]+1))
+
+            # Rows with a span of columns, then columns with a span of rows
+            for row in (Pp[0][0], Pp[2][0]):
+                if row >= 0 and row < maxx:
+                    fill[int(row), max(ud_start, 0):max(ud_stop, 0)] = True
+
+            for col in (Pp[4][1], Pp[5][1]):
+                if col >= 0 and col < maxy:
+                    fill[max(lr_start, 0):max(lr_stop, 0), int(col)] = True
+
+        return fill
+
 class RectangleMask(Mask):
     ''' create a retangular mask '''
 
@@ -245,6 +294,20 @@ class RectangleMask(Mask):
 
         return fillPoints
 
+    def getFillMatrix(self, img_dim):
+        ''' Slice assignment of the (inclusive) rectangle, clipped to the image '''
+
+        (x1, y1), (x2, y2) = self._points
+
+        rows = sorted([int(y1), int(y2)])
+        cols = sorted([int(x1), int(x2)])
+
+        fill = np.zeros(img_dim, dtype = bool)
+
+        fill[max(rows[0], 0):max(rows[1] + 1, 0), max(cols[0], 0):max(cols[1] + 1, 0)] = True
+
+        return fill
+
 class PolygonMask(Mask):
     ''' create a polygon mask '''
 
@@ -276,6 +339,71 @@ class PolygonMask(Mask):
 
         return coords
 
+    def getFillMatrix(self, img_dim):
+        ''' Even-odd scanline fill. A pixel (row y, column x) is inside if a
+        ray from it towards -x crosses an odd number of edges, the same test
+        as polymask.npnpoly. Each edge toggles the columns left of its
+        crossing on every row it spans, so the loop is over the edges only. '''
+
+        ylen, xlen = int(img_dim[0]), int(img_dim[1])
+
+        verts = np.array([list(each) for each in self._points], dtype = np.float64)
+
+        xpi, ypi = verts[:,0], verts[:,1]
+        xpj, ypj = np.roll(xpi, 1), np.roll(ypi, 1)
+
+        # crossings[y, k] counts the edges crossing row y to the right of column k-1
+        crossings = np.zeros((ylen, xlen + 1), dtype = np.int32)
+
+        rows = np.arange(ylen, dtype = np.float64)
+
+        for i in range(len(verts)):
+            spans = ((ypi[i] <= rows) & (rows < ypj[i])) | ((ypj[i] <= rows) & (rows < ypi[i]))
+            y = rows[spans]
+
+            if len(y) == 0:
+                continue
+
+            x_cross = (xpj[i] - xpi[i]) * (y - ypi[i]) / (ypj[i] - ypi[i]) + xpi[i]
+
+            # columns x < x_cross are toggled
+            n_cols = np.clip(np.ceil(x_cross), 0, xlen).astype(int)
+
+            crossings[spans.nonzero()[0], 0] += 1
+            np.subtract.at(crossings, (spans.nonzero()[0], n_cols), 1)
+
+        return (np.cumsum(crossings[:, :xlen], axis = 1) % 2).astype(bool)
+
+
+class PixelMask(Mask):
+    ''' Mask of single pixels, e.g. the hot and dead pixels found by
+    SASPixelStats.findBadPixels. points is a list of (x, y) pixels. '''
+
+    def __init__(self, points, id, img_dim, negative = False):
+
+        Mask.__init__(self, id, img_dim, 'pixels', negative)
+
+        self._points = points
+
+    def getFillPoints(self):
+        return [(int(y), int(x)) for x, y in self._points]
+
+    def getFillMatrix(self, img_dim):
+
+        fill = np.zeros(img_dim, dtype = bool)
+
+        if len(self._points) == 0:
+            return fill
+
+        points = np.array(self._points, dtype = int).reshape(-1, 2)
+        x, y = points[:,0], points[:,1]
+
+        inside = (y >= 0) & (y < img_dim[0]) & (x >= 0) & (x < img_dim[1])
+
+        fill[y[inside], x[inside]] = True
+
+        return fill
+
 
 def calcExpression(expr, img_hdr, file_hdr):
 
@@ -336,17 +464,47 @@ def getBindListDataFromHeader(raw_settings, img_hdr, file_hdr, keys):
     return result
 
 
-def calibrateAndNormalize(sasm_list, img_list, raw_settings):
-    # Calibrate Q
+def getCalibrationParameters(raw_settings, img_hdr = None, file_hdr = None):
+    ''' Returns the sample detector distance, pixel size (in mm) and
+    wavelength, from the header if UseHeaderForCalib is set. '''
+
     sd_distance = raw_settings.get('SampleDistance')
-    pixel_size = raw_settings.get('DetectorPixelSize')
+    pixel_size = raw_settings.get('DetectorPixelSize') / 1000.0
     wavelength = raw_settings.get('WaveLength')
+
+    if raw_settings.get('UseHeaderForCalib'):
+        result = getBindListDataFromHeader(raw_settings, img_hdr, file_hdr, keys = ['Sample Detector Distance', 'Detector Pixel Size', 'Wavelength'])
+        if result[0] is not None: sd_distance = result[0]
+        if result[1] is not None: pixel_size = result[1]
+        if result[2] is not None: wavelength = result[2]
+
+    return sd_distance, pixel_size, wavelength
+
+def getDetectorCorrection(raw_settings, img_dim, x_cin, y_cin, img_hdr = None, file_hdr = None):
+    ''' Returns the (cached) SASCalib.DetectorCorrection for the solid angle
+    and polarization corrections in raw_settings, or None if both are off. '''
+
+    solid_angle = raw_settings.get('DoSolidAngleCorrection')
+
+    if raw_settings.get('DoPolarizationCorrection'):
+        polarization = raw_settings.get('PolarizationFactor')
+    else:
+        polarization = None
+
+    if not solid_angle and polarization is None:
+        return None
+
+    sd_distance, pixel_size, wavelength = getCalibrationParameters(raw_settings, img_hdr, file_hdr)
+
+    return SASCalib.getDetectorCorrection(sd_distance, pixel_size, wavelength, img_dim, x_cin, y_cin,
+                                          solid_angle, polarization)
+
+def calibrateAndNormalize(sasm_list, img_list, raw_settings):
+    # Calibrate Q
     bin_size = raw_settings.get('Binsize')
     calibrate_check = raw_settings.get('CalibrateMan')
     enable_normalization = raw_settings.get('EnableNormalization')
 
-    pixel_size = pixel_size / 1000.0
-
     if type(sasm_list) != list:
         sasm_list = [sasm_list]
         img_list = [img_list]
@@ -355,19 +513,20 @@ def calibrateAndNormalize(sasm_list, img_list, raw_settings):
         sasm = sasm_list[i]
         img = img_list[i]
 
-        if raw_settings.get('UseHeaderForCalib'):
-            img_hdr = sasm.getParameter('imageHeader')
-            file_hdr = sasm.getParameter('counters')
+        img_hdr = sasm.getParameter('imageHeader')
+        file_hdr = sasm.getParameter('counters')
+
+        sd_distance, pixel_size, wavelength = getCalibrationParameters(raw_settings, img_hdr, file_hdr)
 
-            result = getBindListDataFromHeader(raw_settings, img_hdr, file_hdr, keys = ['Sample Detector Distance', 'Detector Pixel Size', 'Wavelength'])
-            if result[0] is not None: sd_distance = result[0]
-            if result[1] is not None: pixel_size = result[1]
-            if result[2] is not None: wavelength = result[2]
+        # With PixelLevelCorrection the corrections were already done in the radial average
+        if not raw_settings.get('PixelLevelCorrection'):
+            correction = getDetectorCorrection(raw_settings, np.shape(img), raw_settings.get('Xcenter'),
+                                               np.shape(img)[0] - raw_settings.get('Ycenter'), img_hdr, file_hdr)
 
-        if raw_settings.get('DoSolidAngleCorrection'):
-            sc = SASCalib.calcSolidAngleCorrection(sasm, sd_distance, pixel_size)
+            if correction is not None:
+                sc = correction.getFactors(sasm.q)
 
-            sasm.scaleRawIntensity(1.0/sc)
+                sasm.scaleRawIntensity(1.0/sc)
 
         sasm.setBinning(bin_size)
 
@@ -389,6 +548,14 @@ def calibrateAndNormalize(sasm_list, img_list, raw_settings):
 
                 sasm.setParameter('normalizations', norm_parameter)
 
+            if raw_settings.get('DoPolarizationCorrection'):
+
+                norm_parameter = sasm.getParameter('normalizations')
+
+                norm_parameter['Polarization_Correction'] = raw_settings.get('PolarizationFactor')
+
+                sasm.setParameter('normalizations', norm_parameter)
+
             for each in normlist:
                 op, expr = each
 
@@ -436,6 +603,14 @@ def calibrateAndNormalize(sasm_list, img_list, raw_settings):
 
                 sasm.setParameter('normalizations', norm_parameter)
 
+            if raw_settings.get('DoPolarizationCorrection'):
+
+                norm_parameter = sasm.getParameter('normalizations')
+
+                norm_parameter['Polarization_Correction'] = raw_settings.get('PolarizationFactor')
+
+                sasm.setParameter('normalizations', norm_parameter)
+
     return sasm_list
 
 
@@ -684,51 +859,80 @@ def calcBresenhamCirclePoints(radius, xOffset = 0, yOffset = 0):
     return points
 
 def createMaskMatrix(img_dim, masks):
-    ''' creates a 2D binary matrix of the same size as the image,
-    corresponding to the mask pattern '''
+    ''' creates a 2D boolean matrix of the same size as the image,
+    corresponding to the mask pattern (True = use pixel) '''
 
     negmasks = []
     posmasks = []
-    neg = False
 
     for each in masks:
         if each.isNegativeMask() == True:
-            neg = True
             negmasks.append(each)
         else:
             posmasks.append(each)
 
-    if neg:
-        for each in posmasks:
-            negmasks.append(each)
-
-            masks = negmasks
-        mask = np.zeros(img_dim)
+    # With negative masks everything starts masked, the negative masks open
+    # up their areas and the positive masks are then applied on top.
+    if len(negmasks) > 0:
+        masks = negmasks + posmasks
+        mask = np.zeros(img_dim, dtype = bool)
     else:
-        mask = np.ones(img_dim)
-
-    maxy = mask.shape[1]
-    maxx = mask.shape[0]
+        mask = np.ones(img_dim, dtype = bool)
 
     for each in masks:
-        fillPoints = each.getFillPoints()
+        fill = each.getFillMatrix(mask.shape)
 
         if each.isNegativeMask() == True:
-            for eachp in fillPoints:
-                if eachp[0] < maxx and eachp[0] >= 0 and eachp[1] < maxy and eachp[1] >= 0:
-                    eachp = tuple([int(x) for x in eachp])  # check int
-                    mask[eachp] = 1
+            mask |= fill
         else:
-            for eachp in fillPoints:
-                if eachp[0] < maxx and eachp[0] >= 0 and eachp[1] < maxy and eachp[1] >= 0:
-                    eachp = tuple([int(x) for x in eachp])  # check int
-                    mask[eachp] = 0
+            mask &= ~fill
 
     #Mask is flipped (older RAW versions had flipped image)
-    mask = np.flipud(mask)
+    mask = np.ascontiguousarray(np.flipud(mask))
 
     return mask
 
+def growMaskMatrix(mask, pixels, mask_cache = None):
+    ''' Grows the masked out (False) area of a mask matrix by a number of
+    pixels, so every pixel within that (euclidean) distance of a masked
+    pixel is masked too. A negative number of pixels shrinks it instead.
+    This works on the matrix, so it pads the union of all mask shapes at
+    once, whatever their type.
+
+    mask_cache is an optional SASMaskCache.MaskCache, the result is then
+    cached by the hash of the mask and the number of pixels.
+    '''
+
+    mask = np.asarray(mask) == 1
+
+    if pixels == 0:
+        return mask
+
+    if mask_cache is not None:
+        cache_key = SASMaskCache.getArrayKey(mask, 'grow', pixels)
+        cached = mask_cache.load(cache_key, mask.shape)
+
+        if cached is not None:
+            return cached
+
+    if pixels > 0:
+        if mask.all():
+            grown = mask.copy()
+        else:
+            # distance of every used pixel to the nearest masked pixel
+            grown = ndimage.distance_transform_edt(mask) > pixels
+    else:
+        if not mask.any():
+            grown = mask.copy()
+        else:
+            # distance of every masked pixel to the nearest used pixel
+            grown = ndimage.distance_transform_edt(~mask) <= -pixels
+
+    if mask_cache is not None:
+        mask_cache.save(cache_key, grown)
+
+    return grown
+
 def createMaskFromHdr(img, img_hdr, flipped = False):
 
     try:
@@ -797,16 +1001,74 @@ def applyMaskToImage(in_image, mask):
     pass
 
 
-def doFlatfieldCorrection(img, img_hdr, flatfield_img, flatfield_hdr):
+_thread_pool = None
+_thread_pool_size = 0
+_thread_pool_lock = threading.Lock()
+
+def getThreadPool(threads):
+    ''' Returns the shared thread pool for the chunked integration and image
+    corrections. It is made once, with threads or (if more) the number of
+    cpus as workers, and kept: with a smaller pool the blocks of a call
+    just wait for a free worker. '''
+
+    global _thread_pool, _thread_pool_size
+
+    with _thread_pool_lock:
+        if _thread_pool is None:
+            _thread_pool_size = max(threads, os.cpu_count() or 1)
+            _thread_pool = ThreadPoolExecutor(max_workers = _thread_pool_size)
+
+        return _thread_pool
+
+def getRowBlocks(n_rows, threads):
+    ''' Splits n_rows image rows into (at most) threads blocks of slices '''
+
+    bounds = np.linspace(0, n_rows, min(threads, n_rows) + 1).astype(int)
+
+    return [slice(bounds[i], bounds[i+1]) for i in range(len(bounds)-1)]
+
+def calcReciprocalFlatfield(flatfield_img):
+    ''' 1/flatfield, so the flatfield correction of every image is a
+    multiplication (doFlatfieldCorrection with reciprocal = True) '''
+
+    if type(flatfield_img) == list:
+        flatfield_img = np.average(flatfield_img, axis=0)
+
+    with np.errstate(divide = 'ignore'):
+        return 1.0 / np.asarray(flatfield_img, dtype = np.float64)
+
+def doFlatfieldCorrection(img, img_hdr, flatfield_img, flatfield_hdr, threads = 1, reciprocal = False):
+    ''' Divides img by the flatfield. If reciprocal, flatfield_img is the
+    reciprocal flatfield (calcReciprocalFlatfield) and img is multiplied
+    by it. '''
+
     if type(flatfield_img) == list:
         flatfield_img = np.average(flatfield_img, axis=0)
 
-    cor_img = img / flatfield_img   #flat field is often water.
+    if reciprocal:
+        correct = np.multiply
+    else:
+        correct = np.divide
+
+    if threads > 1:
+        cor_img = np.empty(np.broadcast(img, flatfield_img).shape, dtype = np.result_type(img, flatfield_img, np.float64))
+
+        def correctRows(rows):
+            correct(img[rows], flatfield_img[rows], out = cor_img[rows])
+
+        list(getThreadPool(threads).map(correctRows, getRowBlocks(cor_img.shape[0], threads)))
+    else:
+        cor_img = correct(img, flatfield_img, dtype = np.result_type(img, flatfield_img, np.float64))   #flat field is often water.
 
     return cor_img
 
 def doDarkBackgroundCorrection(img, img_hdr, dark_img, dark_hdr):
-    pass
+    ''' Subtracts the dark current image (averaged over its frames) '''
+
+    if type(dark_img) == list:
+        dark_img = np.average(dark_img, axis=0)
+
+    return np.subtract(img, dark_img, dtype = np.result_type(img, dark_img, np.float64))
 
 def removeZingers(intensityArray, startIdx = 0, averagingWindowLength = 10, stds = 4):
     ''' Removes spikes from the radial averaged data
@@ -885,7 +1147,268 @@ def getIntensityFromQmatrix(qmatrix):
 
     return I2, err
 
-def radialAverage(in_image, x_cin, y_cin, mask = None, readoutNoise_mask = None, dezingering = 0, dezing_sensitivity = 4.0):
+def getIntensityFromBinnedPixels(geometry, in_image, dezing_sensitivity):
+    ''' Dezingered intensity and errorbars of every bin. The pixel values are
+    grouped per bin (getBinnedPixelIndex) and sigma clipped around the bin
+    median with dezing_sensitivity as threshold, for all bins at once (see
+    SASBinStats.binnedSigmaClip).
+    '''
+
+    index, offsets = geometry.getBinnedPixelIndex()
+
+    values = in_image.ravel()[index]
+
+    I2, err, count = SASBinStats.binnedSigmaClip(values, offsets, dezing_sensitivity)
+
+    return I2, err
+
+
+class RadialAverageGeometry:
+    ''' Pixel-to-bin geometry of the radial average for a fixed image shape,
+    beam center and mask. Everything here depends only on the setup of
+    the run, not on the frame, so it is calculated once and reused for
+    every image integrated with the same geometry.
+
+    img_dim :           (ylen, xlen) of the image
+    x_cin, y_cin :      Center coordinate in the image (Pixels), as passed to radialAverage
+    mask :              Beamstop mask (1/True = use pixel), or None
+    readoutNoise_mask : Readout noise mask (0/False = readout pixel), or None
+    arrays :            The arrays of getArrays() of an identical geometry
+                        (e.g. in shared memory), used instead of calculating them
+
+    The masks are kept as boolean arrays, the backends use the flat indices
+    of the valid pixels (pixel_index) instead of the masks themselves.
+    '''
+
+    ARRAY_NAMES = ('radius', 'pixel_index', 'bin_index', 'bin_count', 'readout_index')
+
+    def __init__(self, img_dim, x_cin, y_cin, mask = None, readoutNoise_mask = None, arrays = None):
+
+        ylen, xlen = int(img_dim[0]), int(img_dim[1])
+
+        self.img_dim = (ylen, xlen)
+        self.x_cin = x_cin
+        self.y_cin = y_cin
+
+        # Find the maximum distance to the edge in the image:
+        maxlen1 = int(max(xlen - x_cin, ylen - y_cin, xlen - (xlen - x_cin), ylen - (ylen - y_cin)))
+
+        diag1 = int(np.sqrt((xlen-x_cin)**2 + y_cin**2))
+        diag2 = int(np.sqrt((x_cin**2 + y_cin**2)))
+        diag3 = int(np.sqrt((x_cin**2 + (ylen-y_cin)**2)))
+        diag4 = int(np.sqrt((xlen-x_cin)**2 + (ylen-y_cin)**2))
+
+        self.maxlen = int(max(diag1, diag2, diag3, diag4, maxlen1))
+
+        # This code is faulty.. x has been switched with y (kept identical to the ravg kernel)
+        self.x_c = float(y_cin)
+        self.y_c = float(x_cin)
+
+        # The masks are kept so the cache can tell whether the same mask objects are used
+        self.mask_ref = mask
+        self.readoutNoise_mask_ref = readoutNoise_mask
+
+        if mask is None:
+            mask = np.ones(self.img_dim, dtype = bool)
+
+        if readoutNoise_mask is None:
+            self.readoutNoiseFound = 0
+            readoutNoise_mask = np.zeros(self.img_dim, dtype = bool)
+        else:
+            self.readoutNoiseFound = 1
+
+        self.mask = np.asarray(mask) == 1
+        self.readoutNoise_mask = np.asarray(readoutNoise_mask) != 0
+
+        if arrays is not None:
+            for name in self.ARRAY_NAMES:
+                setattr(self, name, arrays[name])
+        else:
+            self._calcArrays()
+
+        #the center is not included in the radial average, so it is set manually
+        if self.x_c > 0 and self.x_c < xlen and self.y_c > 0 and self.y_c < ylen:
+            self.center_pixel = (int(round(self.x_c)), int(round(self.y_c)))
+        else:
+            self.center_pixel = None
+
+        self._binned_pixel_index = None
+        self._bin_offsets = None
+        self._float_masks = None
+        self._sparse_matrix = None
+        self._split_matrices = {}
+        self._pixel_blocks = {}
+
+    def _calcArrays(self):
+        ylen, xlen = self.img_dim
+
+        # Distance (in whole pixels) of every pixel to the center, as int(r) in the ravg kernel
+        rel_x = np.arange(ylen, dtype = np.float64) - self.x_c
+        rel_y = self.y_c - np.arange(xlen, dtype = np.float64)
+        self.radius = np.sqrt(rel_y[np.newaxis, :]**2 + rel_x[:, np.newaxis]**2).astype(np.intp)
+
+        low_q, high_q = 0, self.maxlen
+
+        valid = (self.radius < high_q) & (self.radius > low_q) & self.mask
+
+        # Flat indices of the pixels going into the average and the bin each one belongs to
+        self.pixel_index = np.flatnonzero(valid)
+        self.bin_index = self.radius.ravel()[self.pixel_index]
+        self.bin_count = np.bincount(self.bin_index, minlength = self.maxlen).astype(np.float64)
+
+        if self.readoutNoiseFound:
+            readout = (self.radius < high_q-1) & (self.radius > low_q) & ~self.readoutNoise_mask
+            self.readout_index = np.flatnonzero(readout)
+        else:
+            self.readout_index = np.zeros(0, dtype = np.intp)
+
+    def getArrays(self):
+        ''' The arrays the geometry is made of (everything but the masks), to
+        share it with other processes (see the arrays argument) '''
+
+        return dict((name, getattr(self, name)) for name in self.ARRAY_NAMES)
+
+    def getFloatMasks(self):
+        ''' The mask and readout noise mask as float64 arrays, for the
+        ravg_ext and ravg_python kernels '''
+
+        if self._float_masks is None:
+            self._float_masks = (self.mask.astype(np.float64), self.readoutNoise_mask.astype(np.float64))
+
+        return self._float_masks
+
+    def getBinnedPixelIndex(self):
+        ''' Returns the flat pixel indices of the averaged pixels sorted by
+        bin (row major order within a bin, as the ravg kernel stores them in
+        the qmatrix) and the offsets of every bin in it, so the pixels of bin
+        i are image.ravel()[index[offsets[i]:offsets[i+1]]].
+        '''
+
+        if self._binned_pixel_index is None:
+            order = np.argsort(self.bin_index, kind = 'mergesort')
+
+            self._binned_pixel_index = self.pixel_index[order]
+            self._bin_offsets = np.concatenate(([0], np.cumsum(self.bin_count))).astype(np.intp)
+
+        return self._binned_pixel_index, self._bin_offsets
+
+    def getPixelBlocks(self, threads):
+        ''' Splits the averaged pixels into row blocks of the image, given as
+        slices into pixel_index/bin_index (pixel_index is in row major order,
+        so every row block is a contiguous part of it). '''
+
+        if threads not in self._pixel_blocks:
+            row_starts = [rows.start for rows in getRowBlocks(self.img_dim[0], threads)]
+            bounds = np.searchsorted(self.pixel_index, np.array(row_starts) * self.img_dim[1])
+            bounds = list(bounds) + [len(self.pixel_index)]
+
+            self._pixel_blocks[threads] = [slice(bounds[i], bounds[i+1]) for i in range(len(bounds)-1)]
+
+        return self._pixel_blocks[threads]
+
+    def getSparseMatrix(self):
+        ''' Returns the (maxlen, pixels) CSR matrix that maps the flattened
+        image onto the radial bins, with the mask weight of every pixel as
+        matrix element. Multiplying it with an image gives the bin sums,
+        with a stack of flattened images (pixels, N) the sums of all frames.
+        '''
+
+        if self._sparse_matrix is None:
+            weights = self.mask.ravel()[self.pixel_index].astype(np.float64)
+
+            self._sparse_matrix = sparse.csr_matrix((weights, (self.bin_index, self.pixel_index)),
+                                                    shape = (self.maxlen, self.radius.size))
+
+        return self._sparse_matrix
+
+    def getSplitMatrix(self, oversampling, bin_width = 1.0, mask_cache = None):
+        ''' Returns the pixel splitting weights as a (bins, pixels) CSR
+        matrix, see calcPixelSplittingMatrix. The table is kept for the
+        lifetime of the geometry and, if a SASMaskCache.MaskCache is given,
+        stored there so later runs with the same geometry only have to load it.
+        '''
+
+        key = (int(oversampling), float(bin_width))
+
+        if key not in self._split_matrices:
+            matrix = None
+
+            if mask_cache is not None:
+                matrix = loadPixelSplittingMatrix(mask_cache, self.getSplitKey(*key))
+
+            if matrix is None:
+                matrix = calcPixelSplittingMatrix(self, *key)
+
+                if mask_cache is not None:
+                    savePixelSplittingMatrix(mask_cache, self.getSplitKey(*key), matrix)
+
+            self._split_matrices[key] = matrix
+
+        return self._split_matrices[key]
+
+    def getSplitKey(self, oversampling, bin_width):
+        ''' Mask cache key of the pixel splitting weights, made from
+        everything they depend on. The weights are in pixels, so the sample
+        detector distance and pixel size don't change them. '''
+
+        return SASMaskCache.getArrayKey(self.mask, 'split', self.img_dim, self.x_cin, self.y_cin,
+                                        oversampling, bin_width)
+
+    def matches(self, img_dim, x_cin, y_cin, mask, readoutNoise_mask):
+        return (self.img_dim == (int(img_dim[0]), int(img_dim[1]))
+                and self.x_cin == x_cin and self.y_cin == y_cin
+                and self.mask_ref is mask
+                and self.readoutNoise_mask_ref is readoutNoise_mask)
+
+
+_radial_geometry_cache = []
+_RADIAL_GEOMETRY_CACHE_SIZE = 4
+
+def getRadialAverageGeometry(img_dim, x_cin, y_cin, mask = None, readoutNoise_mask = None, arrays = None):
+    ''' Returns the cached RadialAverageGeometry for the given image
+    dimension, center and masks, creating it (from arrays, if given) if
+    needed. Masks are
+    compared by identity, so a mask that is changed in place must be
+    followed by clearRadialAverageGeometryCache() (RAWSettings does this
+    when the center or masks are set).
+    '''
+
+    for geometry in _radial_geometry_cache:
+        if geometry.matches(img_dim, x_cin, y_cin, mask, readoutNoise_mask):
+            return geometry
+
+    geometry = RadialAverageGeometry(img_dim, x_cin, y_cin, mask, readoutNoise_mask, arrays)
+
+    _radial_geometry_cache.insert(0, geometry)
+    del _radial_geometry_cache[_RADIAL_GEOMETRY_CACHE_SIZE:]
+
+    return geometry
+
+def clearRadialAverageGeometryCache():
+    del _radial_geometry_cache[:]
+
+
+def getRadialAverageBackend():
+    ''' Returns the radial averaging backend to use: 'weave' (compiled
+    ravg_ext), 'numpy' (vectorized), 'csr' (sparse matrix) or 'python'
+    (pure python loop). Set
+    by RAWGlobals.ravg_backend, if None the compiled extension is used when
+    available and the numpy backend otherwise.
+    '''
+
+    backend = RAWGlobals.ravg_backend
+
+    if backend is None or (backend == 'weave' and not RAWGlobals.compiled_extensions):
+        if RAWGlobals.compiled_extensions:
+            backend = 'weave'
+        else:
+            backend = 'numpy'
+
+    return backend
+
+
+def radialAverage(in_image, x_cin, y_cin, mask = None, readoutNoise_mask = None, dezingering = 0, dezing_sensitivity = 4.0, geometry = None,
+                  oversampling = 0, bin_width = 1.0, split_cache = None, threads = 1, correction = None):
     ''' Radial averaging. and calculation of readout noise from a readout noise mask.
         It also returns the errorbars assuming possion distributed data
 
@@ -893,39 +1416,41 @@ def radialAverage(in_image, x_cin, y_cin, mask = None, readoutNoise_mask = None,
         dim:           Image dimentions
         x_c, y_c :     (x_c, y_c) Center coordinate in the image (Pixels)
         q_range :      q_range specifying [low_q high_q]
+        geometry :     Precomputed RadialAverageGeometry, looked up in the cache if None
+        oversampling : If > 0, use pixel splitting with this oversampling (see radialAverageSplit).
+                       Pixel splitting does no dezingering and ignores threads.
+        bin_width :    Bin width in pixels for pixel splitting
+        split_cache :  SASMaskCache.MaskCache the pixel splitting weights are cached in
+        threads :      Number of threads for the numpy backend
+        correction :   Per-pixel factors the image is multiplied with before averaging,
+                       e.g. the solid angle correction (see SASCalib.DetectorCorrection.getPixelCorrection)
 
     '''
 
-    in_image = np.float64(in_image)
+    if correction is not None:
+        in_image = np.multiply(in_image, correction, dtype = np.float64)
+    else:
+        in_image = np.float64(in_image)
 
     ylen, xlen = in_image.shape
 
-    xlen = np.int(xlen)
-    ylen = np.int(ylen)
+    xlen = int(xlen)
+    ylen = int(ylen)
 
-    # If no mask is given, the mask is pure ones
-    if mask is None:
-        mask = np.ones(in_image.shape)
+    if geometry is None:
+        geometry = getRadialAverageGeometry(in_image.shape, x_cin, y_cin, mask, readoutNoise_mask)
 
-    if readoutNoise_mask is None:
-        readoutNoiseFound = 0
-        readoutNoise_mask = np.zeros(in_image.shape, dtype = np.float64)
-    else:
-        readoutNoiseFound = 1
+    if oversampling > 0:
+        if dezingering:
+            print('WARNING: Zinger removal is not done with pixel splitting, the radial average is not dezingered!')
 
-    readoutN = np.zeros((1,4), dtype = np.float64)
+        return radialAverageSplit(in_image, geometry, oversampling, bin_width, split_cache) + [None]
 
-    # Find the maximum distance to the edge in the image:
-    maxlen1 = int(max(xlen - x_cin, ylen - y_cin, xlen - (xlen - x_cin), ylen - (ylen - y_cin)))
-
-    diag1 = int(np.sqrt((xlen-x_cin)**2 + y_cin**2))
-    diag2 = int(np.sqrt((x_cin**2 + y_cin**2)))
-    diag3 = int(np.sqrt((x_cin**2 + (ylen-y_cin)**2)))
-    diag4 = int(np.sqrt((xlen-x_cin)**2 + (ylen-y_cin)**2))
+    readoutNoiseFound = geometry.readoutNoiseFound
 
-    maxlen = int(max(diag1, diag2, diag3, diag4, maxlen1))
+    readoutN = np.zeros((1,4), dtype = np.float64)
 
-    #print(diag1, diag2, diag3, diag4, maxlen1)
+    maxlen = geometry.maxlen
 
     # we set the "q_limits" (in pixels) so that it does radial avg on entire image (maximum qrange possible).
     q_range = (0, maxlen)
@@ -936,7 +1461,13 @@ def radialAverage(in_image, x_cin, y_cin, mask = None, readoutNoise_mask = None,
     hist = np.zeros(q_range[1], dtype = np.float64)
     hist_count = np.zeros((3,q_range[1]), dtype = np.float64)  # -----" --------- for number of pixels in a circle at a certain q
 
-    qmatrix = np.zeros((q_range[1], 4*xlen), dtype = np.float64)
+    backend = getRadialAverageBackend()
+
+    # The numpy and csr backends dezinger on the pixels grouped per bin instead
+    if backend in ('numpy', 'csr'):
+        qmatrix = None
+    else:
+        qmatrix = np.zeros((q_range[1], 4*xlen), dtype = np.float64)
 
     low_q = q_range[0]
     high_q = q_range[1]
@@ -953,7 +1484,10 @@ def radialAverage(in_image, x_cin, y_cin, mask = None, readoutNoise_mask = None,
 
     print('Radial averaging in progress...',)
 
-    if RAWGlobals.compiled_extensions:
+    if backend in ('weave', 'python'):
+        mask, readoutNoise_mask = geometry.getFloatMasks()
+
+    if backend == 'weave':
         ravg_ext.ravg(readoutNoiseFound,
                        readoutN,
                        readoutNoise_mask,
@@ -963,6 +1497,12 @@ def radialAverage(in_image, x_cin, y_cin, mask = None, readoutNoise_mask = None,
                        low_q, high_q,
                        in_image,
                        hist_count, mask, qmatrix, dezingering, dezing_sensitivity)
+    elif backend == 'numpy':
+        ravg_numpy(geometry, in_image, hist, hist_count, readoutN, qmatrix,
+                   dezingering, dezing_sensitivity, threads)
+    elif backend == 'csr':
+        ravg_csr(geometry, in_image, hist, hist_count, readoutN, qmatrix,
+                 dezingering, dezing_sensitivity)
     else:
         ravg_python(readoutNoiseFound,
                        readoutN,
@@ -991,8 +1531,8 @@ def radialAverage(in_image, x_cin, y_cin, mask = None, readoutNoise_mask = None,
 
     # print(iq)
 
-    if x_c > 0 and x_c < xlen and y_c > 0 and y_c < ylen:
-        iq[0] = in_image[round(x_c), round(y_c)]  #the center is not included in the radial average, so it is set manually her
+    if geometry.center_pixel is not None:
+        iq[0] = in_image[geometry.center_pixel]  #the center is not included in the radial average, so it is set manually her
 
 
     #Estimated Standard deviation   - equal to the std of pixels in the area / sqrt(N)
@@ -1021,7 +1561,10 @@ def radialAverage(in_image, x_cin, y_cin, mask = None, readoutNoise_mask = None,
     q = np.linspace(0, len(iq)-1, len(iq))
 
     if dezingering == 1:
-        iq, errorbars = getIntensityFromQmatrix(qmatrix)
+        if qmatrix is None:
+            iq, errorbars = getIntensityFromBinnedPixels(geometry, in_image, dezing_sensitivity)
+        else:
+            iq, errorbars = getIntensityFromQmatrix(qmatrix)
         iq[np.where(np.isnan(iq))] = 0
         errorbars[np.where(np.isnan(errorbars))] = 1e-10
 
@@ -1035,6 +1578,295 @@ def radialAverage(in_image, x_cin, y_cin, mask = None, readoutNoise_mask = None,
     return [iq, q, errorbars, qmatrix]
 
 
+def ravg_numpy(geometry, in_image, hist, hist_count, readoutN, qmatrix,
+               dezingering, dezing_sensitivity, threads = 1):
+    ''' Vectorized version of the ravg kernel. Fills hist, hist_count and
+    readoutN in place exactly as ravg_ext/ravg_python do, using the pixel
+    to bin map of the RadialAverageGeometry. hist_count[2] holds the sum of
+    squared deviations from the bin mean (what the running Welford update
+    accumulates), calculated here in two passes.
+
+    With threads > 1 the image is split in row blocks whose partial bin sums,
+    and then partial sums of squared deviations from the bin means, are
+    accumulated on a thread pool and added, so the result is the same as
+    with one thread.
+
+    No qmatrix is used, dezingering is done afterwards on the pixels
+    grouped per bin (see getIntensityFromBinnedPixels).
+    '''
+
+    maxlen = geometry.maxlen
+    bins = geometry.bin_index
+    count = geometry.bin_count
+
+    if threads > 1:
+        flat_image = in_image.ravel()
+
+        blocks = geometry.getPixelBlocks(threads)
+
+        def blockSums(block):
+            values = flat_image[geometry.pixel_index[block]]
+            return np.bincount(bins[block], weights = values, minlength = maxlen)
+
+        hist[:] = np.sum(list(getThreadPool(threads).map(blockSums, blocks)), axis = 0)
+
+        mean = np.zeros(maxlen, dtype = np.float64)
+        np.divide(hist, count, out = mean, where = count > 0)
+
+        # Second pass, as with one thread
+        def blockDeviations(block):
+            values = flat_image[geometry.pixel_index[block]]
+            return np.bincount(bins[block], weights = (values - mean[bins[block]])**2, minlength = maxlen)
+
+        hist_count[2, :] = np.sum(list(getThreadPool(threads).map(blockDeviations, blocks)), axis = 0)
+    else:
+        values = in_image.ravel()[geometry.pixel_index]
+
+        hist[:] = np.bincount(bins, weights = values, minlength = maxlen)
+
+        mean = np.zeros(maxlen, dtype = np.float64)
+        np.divide(hist, count, out = mean, where = count > 0)
+
+        hist_count[2, :] = np.bincount(bins, weights = (values - mean[bins])**2, minlength = maxlen)
+
+    hist_count[0, :] = count
+    hist_count[1, :] = mean
+
+    _readoutNoiseSums(geometry, in_image, readoutN)
+
+def _readoutNoiseSums(geometry, in_image, readoutN):
+    ''' Fills readoutN with [N, sum, mean, sum of squared deviations] of the
+    readout noise pixels, as the ravg kernel does. '''
+
+    if geometry.readoutNoiseFound and len(geometry.readout_index) > 0:
+        noise = in_image.ravel()[geometry.readout_index]
+        noise_mean = noise.mean()
+
+        readoutN[0,0] = len(noise)
+        readoutN[0,1] = noise.sum()
+        readoutN[0,2] = noise_mean
+        readoutN[0,3] = ((noise - noise_mean)**2).sum()
+
+
+def ravg_csr(geometry, in_image, hist, hist_count, readoutN, qmatrix,
+             dezingering, dezing_sensitivity):
+    ''' Sparse matrix version of the ravg kernel. The bin sums and sums of
+    squared deviations are both taken from the geometry's CSR matrix.
+    '''
+
+    sums, deviations, count = _csrBinSums(geometry.getSparseMatrix(), in_image.reshape(1, -1))
+
+    mean = np.zeros(geometry.maxlen, dtype = np.float64)
+    np.divide(sums[0], count, out = mean, where = count > 0)
+
+    hist[:] = sums[0]
+    hist_count[0, :] = count
+    hist_count[1, :] = mean
+    hist_count[2, :] = deviations[0]
+
+    _readoutNoiseSums(geometry, in_image, readoutN)
+
+def calcPixelSplittingMatrix(geometry, oversampling, bin_width = 1.0):
+    ''' Calculates the pixel splitting weights of a geometry. Every pixel
+    is divided into oversampling x oversampling sub-pixels, and each
+    sub-pixel adds 1/oversampling**2 of the pixel to the bin (of width
+    bin_width pixels) its center falls in. Only unmasked pixels are used.
+
+    Returns a (bins, pixels) CSR matrix, where bins = maxlen / bin_width.
+    '''
+
+    ylen, xlen = geometry.img_dim
+    n_bins = int(geometry.maxlen / bin_width)
+    shape = (n_bins, ylen * xlen)
+
+    pixels = np.flatnonzero(geometry.mask)
+    rows = (pixels // xlen).astype(np.float64)
+    cols = (pixels % xlen).astype(np.float64)
+
+    # Sub-pixel centers relative to the pixel center
+    offsets = (np.arange(oversampling) + 0.5) / oversampling - 0.5
+    weight = 1.0 / oversampling**2
+
+    matrix = sparse.csr_matrix(shape, dtype = np.float64)
+
+    for dy in offsets:
+        rel_x = rows + dy - geometry.x_c
+
+        for dx in offsets:
+            rel_y = geometry.y_c - (cols + dx)
+
+            bins = (np.sqrt(rel_x**2 + rel_y**2) / bin_width).astype(np.intp)
+            inside = bins < n_bins
+
+            matrix = matrix + sparse.csr_matrix((np.full(np.count_nonzero(inside), weight),
+                                                 (bins[inside], pixels[inside])), shape = shape)
+
+    return matrix
+
+def savePixelSplittingMatrix(mask_cache, key, matrix):
+    mask_cache.saveArrays(key, data = matrix.data, indices = matrix.indices,
+                          indptr = matrix.indptr, shape = np.array(matrix.shape))
+
+def loadPixelSplittingMatrix(mask_cache, key):
+    ''' Loads pixel splitting weights saved by savePixelSplittingMatrix.
+    Returns None if they are not in the cache. '''
+
+    saved = mask_cache.loadArrays(key)
+
+    if saved is None:
+        return None
+
+    try:
+        matrix = sparse.csr_matrix((saved['data'], saved['indices'], saved['indptr']),
+                                   shape = tuple(saved['shape']))
+    except (KeyError, ValueError) as error:
+        print('Could not load pixel splitting weights: ' + str(error))
+        return None
+
+    return matrix
+
+def radialAverageSplit(in_image, geometry, oversampling, bin_width = 1.0, mask_cache = None):
+    ''' Radial average with pixel splitting: every pixel is distributed
+    over the bins it overlaps using the weights from calcPixelSplittingMatrix
+    instead of being put in the bin of its center. The center bin is
+    integrated like all others. q is in pixels (lower bin edge), so bins
+    narrower than a pixel can be used.
+
+    Returns [iq, q, errorbars] like radialAverage.
+    '''
+
+    matrix = geometry.getSplitMatrix(oversampling, bin_width, mask_cache)
+
+    frames = np.float64(in_image).reshape(1, -1)
+
+    sums, deviations, count = _csrBinSums(matrix, frames)
+
+    iq, errorbars = _averageFromBinSums(frames, sums, deviations, count, geometry, set_center = False)
+
+    q = np.arange(matrix.shape[0]) * bin_width
+
+    #Last points are usually garbage they're very few pixels
+    trim = len(q) - int(np.ceil(5 / bin_width))
+
+    return [iq[0, :trim], q[:trim], errorbars[0, :trim]]
+
+def _csrBinSums(matrix, frames):
+    ''' Bin sums, (weighted) sums of squared deviations from the bin means
+    (both (N, bins)) and pixel counts of a (N, pixels) array of flattened
+    frames for a (bins, pixels) matrix. The deviations are summed in a
+    second pass over the bin means, like ravg_numpy does, instead of from
+    the sums of squares, which loses precision for high counts. '''
+
+    n_bins = matrix.shape[0]
+
+    sums = matrix.dot(frames.T).T
+    count = np.asarray(matrix.sum(axis = 1)).ravel()
+
+    mean = np.zeros(sums.shape, dtype = np.float64)
+    np.divide(sums, count, out = mean, where = count > 0)
+
+    rows = np.repeat(np.arange(n_bins), np.diff(matrix.indptr))
+
+    deviations = np.empty(sums.shape, dtype = np.float64)
+
+    for i in range(len(frames)):
+        deviation = frames[i, matrix.indices] - mean[i, rows]
+        deviations[i] = np.bincount(rows, weights = matrix.data * deviation**2, minlength = n_bins)
+
+    return sums, deviations, count
+
+
+def _averageFromBinSums(frames, sums, deviations, count, geometry, set_center = True):
+    ''' Turns bin sums and sums of squared deviations (see _csrBinSums)
+    into intensities and errorbars the same way radialAverage does,
+    including the readout noise subtraction. Works on (N, bins) arrays for
+    the (N, pixels) frames.
+    '''
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        iq = sums / count
+        hist_cnt = np.maximum(deviations, 0)  #contains (x-mean)**2
+
+        std_i = np.sqrt(hist_cnt/count)
+        std_i[np.isnan(std_i)] = 0
+
+        errorbars = std_i / np.sqrt(count)
+
+    if set_center and geometry.center_pixel is not None:
+        center_idx = np.ravel_multi_index(geometry.center_pixel, geometry.img_dim)
+        iq[:, 0] = frames[:, center_idx]  #the center is not included in the radial average
+
+    if geometry.readoutNoiseFound:
+        noise = frames[:, geometry.readout_index]
+
+        readoutNoise = noise.mean(axis = 1)
+        errorbarNoise = noise.std(axis = 1) / np.sqrt(noise.shape[1])
+
+        iq = iq - readoutNoise[:, np.newaxis]
+        errorbars = np.sqrt(np.power(errorbars, 2) + np.power(errorbarNoise[:, np.newaxis], 2))
+
+    iq[np.isnan(iq)] = 0
+    errorbars[np.isnan(errorbars)] = 1e-10
+
+    return iq, errorbars
+
+
+RAVG_STACK_CHUNK = 64
+
+def radialAverageStack(images, x_cin, y_cin, mask = None, readoutNoise_mask = None, geometry = None,
+                       dezingering = 0, dezing_sensitivity = 4.0, correction = None):
+    ''' Radial average of a stack of frames with the same geometry using
+    the sparse bin matrix, so a whole chunk of frames is integrated by one
+    sparse matrix product instead of once per frame. Gives the same result
+    as radialAverage (with the numpy or csr backend).
+
+    images :       (N, ylen, xlen) array, or a list or iterator of 2D images
+    x_cin, y_cin : Center coordinate in the image (Pixels)
+    geometry :     Precomputed RadialAverageGeometry, looked up in the cache if None
+    correction :   Per-pixel factors every frame is multiplied with, as in radialAverage
+
+    Returns a list with [iq, q, errorbars] for every frame. Frames are read
+    from images one chunk at a time, so an iterator never needs to hold the
+    whole stack in memory.
+    '''
+
+    images = iter(images)
+    chunk = list(itertools.islice(images, RAVG_STACK_CHUNK))
+
+    if geometry is None and len(chunk) > 0:
+        geometry = getRadialAverageGeometry(np.shape(chunk[0]), x_cin, y_cin, mask, readoutNoise_mask)
+
+    result = []
+
+    while len(chunk) > 0:
+        frames = np.array([np.ravel(img) for img in chunk], dtype = np.float64)
+        maxlen = geometry.maxlen
+
+        if correction is not None:
+            frames *= np.ravel(correction)
+
+        sums, deviations, count = _csrBinSums(geometry.getSparseMatrix(), frames)
+
+        iq, errorbars = _averageFromBinSums(frames, sums, deviations, count, geometry)
+
+        if dezingering == 1:
+            for i in range(len(frames)):
+                iq[i], errorbars[i] = getIntensityFromBinnedPixels(geometry, frames[i], dezing_sensitivity)
+
+            iq[np.isnan(iq)] = 0
+            errorbars[np.isnan(errorbars)] = 1e-10
+
+        #Last points are usually garbage they're very few pixels
+        q = np.linspace(0, maxlen-1, maxlen)[:-5]
+
+        for i in range(len(frames)):
+            result.append([iq[i, :-5], q, errorbars[i, :-5]])
+
+        chunk = list(itertools.islice(images, RAVG_STACK_CHUNK))
+
+    return result
+
+
 def pyFAIIntegrateCalibrateNormalize(img, parameters, x_cin, y_cin, raw_settings, mask = None, tbs_mask = None):
     print('using pyfai!!!!')
     # Get appropriate settings
@@ -1048,6 +1880,10 @@ def pyFAIIntegrateCalibrateNormalize(img, parameters, x_cin, y_cin, raw_settings
     do_normalization = raw_settings.get('EnableNormalization')
     do_flatfield = raw_settings.get('NormFlatfieldEnabled')
     do_solidangle = raw_settings.get('DoSolidAngleCorrection')
+    if raw_settings.get('DoPolarizationCorrection'):
+        polarization = raw_settings.get('PolarizationFactor')
+    else:
+        polarization = None
     do_useheaderforcalib = raw_settings.get('UseHeaderForCalib')
 
     #Put everything in appropriate units
@@ -1073,7 +1909,7 @@ def pyFAIIntegrateCalibrateNormalize(img, parameters, x_cin, y_cin, raw_settings
 
     # If no mask is given, the mask is pure zeroes
     if mask is None:
-        mask = np.zeroes(img.shape)
+        mask = np.zeros(img.shape, dtype = bool)
 
     else:
         mask = np.logical_not(mask)
@@ -1111,6 +1947,9 @@ def pyFAIIntegrateCalibrateNormalize(img, parameters, x_cin, y_cin, raw_settings
         flatfield_filename = raw_settings.get('NormFlatfieldFile')
         ai.set_flatfiles(flatfield_filename)
 
+    if raw_settings.get('DarkCorrEnabled') and raw_settings.get('DarkCorrFilename') is not None:
+        ai.set_darkfiles(raw_settings.get('DarkCorrFilename'))
+
     print(ai)
     qmin_theta = SASCalib.calcTheta(sd_distance*1e-3, pixel_size, 0)
     qmin = ((4 * math.pi * math.sin(qmin_theta)) / (wavelength*1e10))
@@ -1121,7 +1960,7 @@ def pyFAIIntegrateCalibrateNormalize(img, parameters, x_cin, y_cin, raw_settings
     q_range = (qmin, qmax)
 
     #Carry out the integration
-    q, iq, errorbars = ai.integrate1d(img, maxlen, mask = mask, correctSolidAngle = do_solidangle, error_model = 'poisson', unit = 'q_A^-1', radial_range = q_range, method = 'nosplit_csr')
+    q, iq, errorbars = ai.integrate1d(img, maxlen, mask = mask, correctSolidAngle = do_solidangle, polarization_factor = polarization, error_model = 'poisson', unit = 'q_A^-1', radial_range = q_range, method = 'nosplit_csr')
 
     i_raw = iq[:-5]        #Last points are usually garbage they're very few pixels
                         #Cutting the last 5 points here.
@@ -1256,7 +2095,7 @@ def ravg_python(readoutNoiseFound, readoutN, readoutNoise_mask, xlen, ylen, x_c,
 
                         # //printf("median: %f\\n", median);
 
-                        half_win_len = point_idx - half_window_size
+                        half_win_len = int(point_idx - half_window_size)
 
 
                         if qmatrix[q_idx, half_win_len] > (median + (dezing_sensitivity * std)): #{
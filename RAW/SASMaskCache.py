@@ -0,0 +1,217 @@
+"""
+#******************************************************************************
+# This file is part of RAW.
+#
+#    RAW is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    RAW is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with RAW.  If not, see <http://www.gnu.org/licenses/>.
+#
+#******************************************************************************
+
+Content-addressed cache of mask matrices.
+
+A mask is stored under a hash of what it is made from (the serialized mask
+shapes and the image dimension, see getMaskKey), so configs with the same
+masks share one entry and a changed mask never picks up a stale one. The
+masks are bit-packed (np.packbits), one .npy file per mask in the cache
+directory, and memory mapped when loaded. The key already depends on the
+shape of the mask, which the caller passes to load. There is no index, so
+several processes can share the cache without locking: files are written
+to a temporary file and renamed, loading a mask touches its file, and when
+there are too many files the least recently used (oldest modification
+time) are removed.
+
+Other arrays derived from the masks (e.g. the pixel splitting weights) are
+stored the same way with saveArrays/loadArrays, as uncompressed .npz files
+that share the eviction with the masks.
+"""
+from __future__ import print_function, division
+
+import os
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.raw', 'mask_cache')
+MAX_ENTRIES = 64
+
+MASK_EXTENSION = '.npy'
+ARRAYS_EXTENSION = '.npz'
+
+
+def serializeMasks(masks):
+    ''' Stable text representation of a list of mask objects (type,
+    negative flag and points of every mask, in order) '''
+
+    def toFloats(points):
+        if isinstance(points, (list, tuple, np.ndarray)):
+            return [toFloats(each) for each in points]
+        return float(points)
+
+    return json.dumps([[each.getType(), bool(each.isNegativeMask()), toFloats(each.getPoints())]
+                       for each in masks], sort_keys = True)
+
+def getMaskKey(img_dim, masks, *extra):
+    ''' Cache key of the mask matrix made from masks for an image of size
+    img_dim. Anything else the matrix depends on can be passed in extra. '''
+
+    text = json.dumps([[int(n) for n in img_dim], serializeMasks(masks), [str(each) for each in extra]])
+
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def getArrayKey(array, *extra):
+    ''' Cache key of something derived from a mask matrix (or other array) '''
+
+    array = np.ascontiguousarray(array)
+
+    digest = hashlib.sha1(str(array.shape).encode('utf-8'))
+    digest.update(str(array.dtype).encode('utf-8'))
+    digest.update(array.tobytes())
+    digest.update(json.dumps([str(each) for each in extra]).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+class MaskCache():
+    ''' Cache of mask matrices (and arrays made from them) in cache_dir, see
+    the module docstring.
+    Errors writing the cache are printed and ignored, the cache is only an
+    optimization. '''
+
+    def __init__(self, cache_dir = None, max_entries = MAX_ENTRIES):
+
+        if cache_dir is None:
+            cache_dir = DEFAULT_CACHE_DIR
+
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+
+    def load(self, key, shape, dtype = bool):
+        ''' Returns the cached mask of the given shape for key (as dtype), or
+        None if it isn't cached. The packed bits are memory mapped, only the
+        unpacked mask is made in memory. '''
+
+        path = self._path(key)
+        size = int(np.prod(shape))
+
+        try:
+            packed = np.load(path, mmap_mode = 'r')
+
+            # Marks the entry as used for the eviction
+            os.utime(path, None)
+
+        except (IOError, OSError, ValueError):
+            return None
+
+        if packed.ndim != 1 or packed.size != (size + 7) // 8:
+            return None
+
+        mask = np.unpackbits(packed, count = size).reshape(shape)
+
+        if np.dtype(dtype) == np.bool_:
+            return mask.view(np.bool_)
+
+        return mask.astype(dtype)
+
+    def save(self, key, mask):
+        ''' Stores a mask (nonzero is 1) under key and evicts old entries '''
+
+        mask = np.asarray(mask)
+
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+
+            self._atomicSave(self._path(key), np.save, np.packbits(mask.ravel() != 0))
+
+            self._evict()
+
+        except (IOError, OSError) as msg:
+            print('Could not write mask cache: ' + str(msg))
+
+    def loadArrays(self, key):
+        ''' Returns the dict of arrays stored under key with saveArrays, or
+        None if it isn't cached '''
+
+        path = self._path(key, ARRAYS_EXTENSION)
+
+        try:
+            with np.load(path) as saved:
+                arrays = {name : saved[name] for name in saved.files}
+
+            os.utime(path, None)
+
+        except (IOError, OSError, ValueError):
+            return None
+
+        return arrays
+
+    def saveArrays(self, key, **arrays):
+        ''' Stores the named arrays under key and evicts old entries '''
+
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+
+            self._atomicSave(self._path(key, ARRAYS_EXTENSION), np.savez, **arrays)
+
+            self._evict()
+
+        except (IOError, OSError) as msg:
+            print('Could not write mask cache: ' + str(msg))
+
+    def _evict(self):
+        entries = []
+
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith((MASK_EXTENSION, ARRAYS_EXTENSION)):
+                path = os.path.join(self.cache_dir, filename)
+
+                try:
+                    entries.append((os.path.getmtime(path), path))
+                except OSError:
+                    # Removed by another process
+                    pass
+
+        if len(entries) <= self.max_entries:
+            return
+
+        entries.sort()
+
+        for used, path in entries[:len(entries) - self.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _path(self, key, extension = MASK_EXTENSION):
+        return os.path.join(self.cache_dir, key + extension)
+
+    def _atomicSave(self, path, save_function, *args, **kwargs):
+        # Written to a temporary file and renamed, so other processes never read half a file
+        fd, tmp_path = tempfile.mkstemp(dir = self.cache_dir, suffix = '.tmp')
+
+        try:
+            with os.fdopen(fd, 'wb') as array_file:
+                save_function(array_file, *args, **kwargs)
+
+            os.replace(tmp_path, path)
+
+        except:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
@@ -0,0 +1,157 @@
+"""
+#******************************************************************************
+# This file is part of RAW.
+#
+#    RAW is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    RAW is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with RAW.  If not, see <http://www.gnu.org/licenses/>.
+#
+#******************************************************************************
+
+Per-pixel statistics of a stack of (dark or flat) frames, and detection of
+hot, dead and saturated pixels from them.
+
+The frames are streamed through a running (Welford) mean and variance, so
+only a few image sized arrays are kept however many frames there are.
+"""
+from __future__ import print_function, division
+
+import numpy as np
+
+
+class PixelStatistics():
+    ''' Running per-pixel count, mean, variance, minimum and maximum of the
+    frames added with add() '''
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.min = None
+        self.max = None
+
+    def add(self, frame):
+        ''' Adds one frame (Welford update) '''
+
+        frame = np.asarray(frame, dtype = np.float64)
+
+        if self.mean is None:
+            self.count = 1
+            self.mean = frame.copy()
+            self.m2 = np.zeros_like(frame)
+            self.min = frame.copy()
+            self.max = frame.copy()
+            return
+
+        if frame.shape != self.mean.shape:
+            raise ValueError('Frame shape %s does not match %s' %(str(frame.shape), str(self.mean.shape)))
+
+        self.count += 1
+
+        delta = frame - self.mean
+        self.mean += delta / self.count
+        delta *= frame - self.mean
+        self.m2 += delta
+
+        np.minimum(self.min, frame, out = self.min)
+        np.maximum(self.max, frame, out = self.max)
+
+    def addFrames(self, frames):
+        ''' Adds every frame of an iterable (e.g. a generator reading files) '''
+
+        for frame in frames:
+            self.add(frame)
+
+        return self
+
+    def getVariance(self):
+        ''' Sample variance of every pixel (0 with less than two frames) '''
+
+        if self.count < 2:
+            return np.zeros_like(self.mean)
+
+        return self.m2 / (self.count - 1)
+
+    def getStd(self):
+        return np.sqrt(self.getVariance())
+
+
+def robustOutliers(values, sensitivity, valid = None):
+    ''' True where values are further than sensitivity robust standard
+    deviations (1.4826 * MAD) from the median of the valid values. If more
+    than half the values are the same (MAD is 0, common for low count
+    integer frames), the mean absolute deviation (times 1.2533, the factor
+    for normally distributed values) is used instead, and if all values
+    are the same nothing is flagged. '''
+
+    if valid is None:
+        sample = values.ravel()
+    else:
+        sample = values[valid]
+
+    if sample.size == 0:
+        return np.zeros(values.shape, dtype = bool)
+
+    median = np.median(sample)
+    deviation = np.abs(sample - median)
+    sigma = 1.4826 * np.median(deviation)
+
+    if sigma == 0:
+        sigma = 1.2533 * np.mean(deviation)
+
+    if sigma == 0:
+        return np.zeros(values.shape, dtype = bool)
+
+    return np.abs(values - median) > sensitivity * sigma
+
+def findBadPixels(stats, sensitivity = 6.0, saturation = None, flag_zero = True, check_variance = True):
+    ''' Returns a boolean mask (True = good pixel, as the mask matrices) of a
+    PixelStatistics. A pixel is bad if
+
+    - it never read anything but zero (only if flag_zero),
+    - it reached the saturation value (if given),
+    - its mean is an outlier (hot or dead) compared to the other pixels,
+    - its standard deviation is an outlier (noisy or stuck), if
+      check_variance and there are at least two frames.
+
+    Outliers are more than sensitivity robust standard deviations from
+    the median of the pixels that are not already flagged.
+    '''
+
+    if stats.mean is None:
+        raise ValueError('No frames in the pixel statistics.')
+
+    bad = np.zeros(stats.mean.shape, dtype = bool)
+
+    if flag_zero:
+        bad |= (stats.min == 0) & (stats.max == 0)
+
+    if saturation is not None:
+        bad |= stats.max >= saturation
+
+    bad |= robustOutliers(stats.mean, sensitivity, ~bad)
+
+    if check_variance and stats.count > 1:
+        bad |= robustOutliers(stats.getStd(), sensitivity, ~bad)
+
+    return ~bad
+
+def badPixelCoordinates(good_mask):
+    ''' (x, y) coordinates of the bad pixels of a mask matrix, in the
+    orientation of the mask objects (createMaskMatrix flips the matrix
+    upside down), for a SASImage.PixelMask '''
+
+    good_mask = np.asarray(good_mask)
+
+    rows, cols = np.nonzero(good_mask == 0)
+
+    return [(int(col), int(good_mask.shape[0] - 1 - row)) for row, col in zip(rows, cols)]
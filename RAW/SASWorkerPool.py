@@ -0,0 +1,260 @@
+"""
+#******************************************************************************
+# This file is part of RAW.
+#
+#    RAW is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    RAW is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with RAW.  If not, see <http://www.gnu.org/licenses/>.
+#
+#******************************************************************************
+
+Pool of worker processes loading and integrating image files.
+
+What is large and the same for every file (the mask matrices, the
+flatfield and dark images and the radial average geometry) is copied
+once into shared memory by the parent, and the workers use read-only
+views of it.
+The settings, without the mask matrices, are sent once to every worker
+when the pool starts. The workers return the curves as SASM.extractAll()
+dictionaries, from which the parent rebuilds the SASM objects.
+"""
+from __future__ import print_function, division
+
+import multiprocessing
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+    use_shared_memory = True
+except ImportError:
+    use_shared_memory = False
+
+import RAWGlobals
+import RAWSettings
+import SASFileIO
+import SASImage
+import SASM
+
+
+MASK_KEYS = ('BeamStopMask', 'ReadOutNoiseMask', 'TransparentBSMask')
+
+GEOMETRY_PREFIX = 'geometry_'
+
+
+class SharedArrays():
+    ''' Copies of numpy arrays in shared memory blocks, owned (and unlinked
+    by close()) by the process that made them. getDescriptions() is what
+    other processes need to attach to them, see attachArrays. '''
+
+    def __init__(self):
+        self._blocks = []
+        self._descriptions = {}
+
+    def add(self, name, array):
+        array = np.ascontiguousarray(array)
+
+        block = shared_memory.SharedMemory(create = True, size = max(1, array.nbytes))
+        self._blocks.append(block)
+
+        shared = np.ndarray(array.shape, dtype = array.dtype, buffer = block.buf)
+        shared[...] = array
+        del shared
+
+        self._descriptions[name] = (block.name, array.shape, array.dtype.str)
+
+    def getDescriptions(self):
+        return self._descriptions
+
+    def close(self):
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+
+        self._blocks = []
+        self._descriptions = {}
+
+def attachArrays(descriptions):
+    ''' Read-only arrays of the shared memory blocks of
+    SharedArrays.getDescriptions(). Returns the blocks, which have to be
+    kept as long as the arrays are used, and the arrays by name. '''
+
+    blocks = []
+    arrays = {}
+
+    for name, (block_name, shape, dtype) in descriptions.items():
+        block = shared_memory.SharedMemory(name = block_name)
+        blocks.append(block)
+
+        array = np.ndarray(shape, dtype = np.dtype(dtype), buffer = block.buf)
+        array.flags.writeable = False
+
+        arrays[name] = array
+
+    return blocks, arrays
+
+def getGeometryArgs(raw_settings):
+    ''' Image dimension and center of the radial average geometry of the
+    masks in raw_settings (as SASFileIO.loadImageFile calculates them), or
+    None if the geometry depends on the image or its header. '''
+
+    if (raw_settings.get('Masks')['BeamStopMask'][0] is None
+        or raw_settings.get('UseHeaderForCalib')
+        or raw_settings.get('UseHeaderForMask')
+        or RAWGlobals.usepyFAI_integration):
+        return None
+
+    img_dim = raw_settings.get('Masks')['BeamStopMask'][0].shape
+
+    x_c = raw_settings.get('Xcenter')
+    y_c = img_dim[0] - raw_settings.get('Ycenter')
+
+    return (img_dim, x_c, y_c)
+
+def rebuildSASM(sasm_data):
+    ''' SASM of the dictionary of SASM.extractAll() '''
+
+    new_sasm = SASM.SASM(sasm_data['i_raw'], sasm_data['q_raw'], sasm_data['err_raw'], sasm_data['parameters'])
+    new_sasm.setBinnedI(sasm_data['i_binned'])
+    new_sasm.setBinnedQ(sasm_data['q_binned'])
+    new_sasm.setBinnedErr(sasm_data['err_binned'])
+
+    new_sasm.setScaleValues(sasm_data['scale_factor'], sasm_data['offset_value'],
+                            sasm_data['norm_factor'], sasm_data['q_scale_factor'],
+                            sasm_data['bin_size'])
+
+    new_sasm.setQrange(sasm_data['selected_qrange'])
+
+    new_sasm._update()
+
+    return new_sasm
+
+
+class WorkerPool():
+    ''' Pool of workers processes loading files (SASFileIO.loadFile) with
+    the settings of raw_settings. Use imap() to load files and close()
+    when done. '''
+
+    def __init__(self, raw_settings, workers):
+        self._shared = SharedArrays()
+
+        try:
+            masks = raw_settings.get('Masks')
+
+            for key in MASK_KEYS:
+                if masks[key][0] is not None:
+                    self._shared.add(key, masks[key][0])
+
+            correction_hdrs = {}
+            if raw_settings.get('NormFlatfieldEnabled') and raw_settings.get('NormFlatfieldFile') is not None:
+                flatfield_img, correction_hdrs['flatfield'] = SASFileIO.getFlatfield(raw_settings)
+                self._shared.add('flatfield', flatfield_img)
+
+            if raw_settings.get('DarkCorrEnabled') and raw_settings.get('DarkCorrFilename') is not None:
+                dark_img, correction_hdrs['dark'] = SASFileIO.getDarkImage(raw_settings)
+                self._shared.add('dark', dark_img)
+
+            geometry_args = getGeometryArgs(raw_settings)
+            if geometry_args is not None:
+                geometry = SASImage.getRadialAverageGeometry(geometry_args[0], geometry_args[1], geometry_args[2],
+                                                             masks['BeamStopMask'][0], masks['ReadOutNoiseMask'][0])
+
+                for name, array in geometry.getArrays().items():
+                    self._shared.add(GEOMETRY_PREFIX + name, array)
+
+            self._pool = multiprocessing.Pool(workers, _initWorker,
+                                              (_getWorkerParams(raw_settings), self._shared.getDescriptions(),
+                                               correction_hdrs, geometry_args))
+        except:
+            self._shared.close()
+            raise
+
+    def imap(self, filename_list):
+        ''' Loads the files on the workers. Yields the SASM(s) of every file
+        and whether it was an image, in the order of filename_list. Errors
+        are raised when the file they happened for comes up. '''
+
+        for data, is_image in self._pool.imap(_loadFile, filename_list):
+            if isinstance(data, list):
+                yield [rebuildSASM(each) if isinstance(each, dict) else each for each in data], is_image
+            elif isinstance(data, dict):
+                yield rebuildSASM(data), is_image
+            else:
+                yield data, is_image
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+        self._shared.close()
+
+def _getWorkerParams(raw_settings):
+    ''' The settings parameters without the mask matrices (they are shared) '''
+
+    params = dict(raw_settings.getAllParams())
+
+    for key in MASK_KEYS:
+        params[key] = [None] + list(params[key][1:])
+
+    masks = params['Masks'][0]
+    params['Masks'] = [dict((key, [None, masks[key][1]]) for key in masks)] + list(params['Masks'][1:])
+
+    # Every worker is one integration thread
+    params['IntegrationThreads'] = [1] + list(params['IntegrationThreads'][1:])
+
+    return params
+
+
+_worker_state = {}
+
+def _initWorker(params, descriptions, correction_hdrs, geometry_args):
+    blocks, arrays = attachArrays(descriptions)
+
+    raw_settings = RAWSettings.RawGuiSettings(params)
+
+    masks = raw_settings.get('Masks')
+    for key in MASK_KEYS:
+        if key in arrays:
+            masks[key][0] = arrays[key]
+            raw_settings.set(key, arrays[key])
+
+    # The (reciprocal) flatfield and the dark image, with their headers
+    corrections = dict((name, (arrays[name], correction_hdrs[name])) for name in correction_hdrs)
+
+    # The geometry is looked up by the mask arrays, which are the same objects here
+    if geometry_args is not None:
+        geometry_arrays = dict((name, arrays[GEOMETRY_PREFIX + name]) for name in SASImage.RadialAverageGeometry.ARRAY_NAMES)
+
+        SASImage.getRadialAverageGeometry(geometry_args[0], geometry_args[1], geometry_args[2],
+                                          masks['BeamStopMask'][0], masks['ReadOutNoiseMask'][0],
+                                          geometry_arrays)
+
+    _worker_state['blocks'] = blocks
+    _worker_state['raw_settings'] = raw_settings
+    _worker_state['corrections'] = corrections
+
+def _loadFile(filename):
+    raw_settings = _worker_state['raw_settings']
+
+    preloaded = SASFileIO.preloadFile(filename, raw_settings, read_pixels = False)
+    preloaded.update(_worker_state['corrections'])
+
+    sasm, img = SASFileIO.loadFile(filename, raw_settings, preloaded = preloaded)
+
+    # Only the curves go back, not the image
+    if isinstance(sasm, list):
+        data = [each.extractAll() if isinstance(each, SASM.SASM) else each for each in sasm]
+    elif isinstance(sasm, SASM.SASM):
+        data = sasm.extractAll()
+    else:
+        data = sasm
+
+    return data, img is not None
@@ -132,7 +132,7 @@ def boxslice(array, center, radius=100):
             np.minimum(curr_center + radius, max_len, dtype=int),
         ) for curr_center, max_len in zip(center, array.shape)
     ]
-    return array[slicer]
+    return array[tuple(slicer)]
 
 
 def subtract_radial_average(img, center, mask=None):
@@ -145,7 +145,7 @@ def subtract_radial_average(img, center, mask=None):
     center : tuple of int
         center of image
     mask : numpy.ndarray, optional
-        mask for image. 1 means valid area, 0 means masked area.
+        mask for image. 1 (True) means valid area, 0 (False) means masked area.
         (the default is None, which is no mask.)
     
     Returns
@@ -155,28 +155,29 @@ def subtract_radial_average(img, center, mask=None):
     """
     assert img.ndim == 2, 'Wrong dimension for image.'
     assert len(center) == 2, 'Wrong dimension for center.'
-    if mask is not None:
-        masked_img = img * mask
-    else:
-        masked_img = img
     center = np.round(center)
     meshgrids = np.indices(img.shape)  # return (xx, yy)
     # eq: r = sqrt( (x - x_center)**2 + (y - y_center)**2 + (z - z_center)**2 )
     r = np.sqrt(sum(((grid - c)**2 for grid, c in zip(meshgrids, center))))
-    r = np.round(r).astype(np.int)
+    r = np.round(r).astype(int)
 
-    total_bin = np.bincount(r.ravel(), masked_img.ravel())
-    nr = np.bincount(r.ravel())  # count for each r
+    r_flat = r.ravel()
+    img_flat = img.ravel()
     if mask is not None:
-        r_mask = np.zeros(r.shape)
-        r_mask[np.where(mask == 0.0)] = 1
-        nr_mask = np.bincount(r.ravel(), r_mask.ravel())
-        nr = nr - nr_mask
-    radialprofile = np.zeros_like(nr)
-    # r_pixel = np.unique(r.ravel())  # sorted
+        # only the valid pixels are binned
+        mask = np.asarray(mask, dtype=bool)
+        valid = np.flatnonzero(mask)
+        r_flat = r_flat[valid]
+        img_flat = img_flat[valid]
+    total_bin = np.bincount(r_flat, img_flat, minlength=r.max() + 1)
+    nr = np.bincount(r_flat, minlength=r.max() + 1)  # count for each r
+    radialprofile = np.zeros(len(nr))
     nomaskr = np.where(nr > 0)
     radialprofile[nomaskr] = total_bin[nomaskr] / nr[nomaskr]
-    residual_img = masked_img - radialprofile[r]  # subtract mean matrix
+    if mask is None:
+        residual_img = img - radialprofile[r]  # subtract mean matrix
+    else:
+        residual_img = np.where(mask, img, 0.) - radialprofile[r]
     return residual_img
 
 
@@ -230,7 +231,9 @@ class Simulator():
         if mask is None:
             mask = self._raw_simulator.get_raw_settings_value('Masks')[
                 'BeamStopMask']
-        self.boxed_mask = boxslice(mask, self.center, self.radius)
+        # boolean, so it can index images instead of being multiplied in
+        self.boxed_mask = boxslice(np.asarray(mask, dtype=bool), self.center,
+                                   self.radius)
 
     def get_gnom(self, exp):
         if exp not in self._warehouse['gnom']:
@@ -252,7 +255,8 @@ class Simulator():
                 np.fliplr(np.asarray(opened_image, dtype=float)),
                 self.center,
                 self.radius,
-            ) * self.boxed_mask
+            )
+        image[~self.boxed_mask] = 0.
         return image
 
     def get_sasimage(self, exp, image_fname):
@@ -51,7 +51,7 @@ def subtract_radial_average(img, center, mask=None):
     center : tuple of int
         center of image (sequence in row and column)
     mask : numpy.ndarray, optional
-        mask for image. 1 means valid area, 0 means masked area.
+        mask for image. 1 (True) means valid area, 0 (False) means masked area.
         (Default is None, which is no mask.)
 
     Returns
@@ -61,31 +61,28 @@ def subtract_radial_average(img, center, mask=None):
     """
     assert img.ndim == 2, 'Wrong dimension for image.'
     assert len(center) == 2, 'Wrong dimension for center.'
-    if mask is not None:
-        masked_img = img * mask
-    else:
-        masked_img = img
     center = np.round(center)
     meshgrids = np.indices(img.shape)  # return (xx, yy)
     # eq: r = sqrt( (x - x_center)**2 + (y - y_center)**2 + (z - z_center)**2 )
     r = np.sqrt(sum(((grid - c)**2 for grid, c in zip(meshgrids, center))))
-    r = np.round(r).astype(np.int)
+    r = np.round(r).astype(int)
 
-    total_bin = np.bincount(r.ravel(), masked_img.ravel())
-    nr = np.bincount(r.ravel())  # count for each r
+    r_flat = r.ravel()
+    img_flat = img.ravel()
     if mask is not None:
-        r_mask = np.zeros(r.shape)
-        r_mask[np.where(mask == 0.0)] = 1
-        nr_mask = np.bincount(r.ravel(), r_mask.ravel())
-        nr = nr - nr_mask
-    radialprofile = np.zeros_like(nr)
-    # r_pixel = np.unique(r.ravel())  # sorted
+        # only the valid pixels are binned
+        mask = np.asarray(mask, dtype=bool)
+        valid = np.flatnonzero(mask)
+        r_flat = r_flat[valid]
+        img_flat = img_flat[valid]
+    total_bin = np.bincount(r_flat, img_flat, minlength=r.max() + 1)
+    nr = np.bincount(r_flat, minlength=r.max() + 1)  # count for each r
+    radialprofile = np.zeros(len(nr))
     nomaskr = np.where(nr > 0)
     radialprofile[nomaskr] = total_bin[nomaskr] / nr[nomaskr]
-    if mask is None:
-        residual_img = masked_img - radialprofile[r]  # subtract mean matrix
-    else:
-        residual_img = masked_img - radialprofile[r] * mask
+    residual_img = img - radialprofile[r]  # subtract mean matrix
+    if mask is not None:
+        residual_img[~mask] = 0.
     return residual_img
 
 
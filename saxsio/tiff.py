@@ -1,5 +1,6 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
-import time
 
 import numpy as np
 from PIL import Image
@@ -7,18 +8,77 @@ from PIL import Image
 import dat
 
 
-def average_tiff_imgs(filelist, mask, output_filename=None):
-    mask = np.asarray(mask, dtype=float)
-    xlen, ylen = mask.shape
-    imgs = np.zeros([xlen, ylen, len(filelist)], dtype=float)
-    for i, filename in enumerate(filelist):
-        with Image.open(filename) as img:
-            imgs[:, :, i] = np.array(img)
+def _read_tiff(filename):
+    with Image.open(filename) as img:
+        return np.asarray(img, dtype=np.float64)
+
+
+def iter_tiff_imgs(filelist, prefetch=2):
+    """Yield the images of filelist one at a time as float64 arrays.
+
+    The next `prefetch` files are read in a background thread while the
+    current image is used, so only a few images are in memory at a time.
+    """
+    if prefetch < 1:
+        for filename in filelist:
+            yield _read_tiff(filename)
+        return
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = deque()
+        for filename in filelist:
+            pending.append(executor.submit(_read_tiff, filename))
+            if len(pending) > prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def average_tiff_imgs(filelist, mask, output_filename=None, sigma_clip=None, prefetch=2):
+    """Average of tiff images, read one at a time.
+
+    Parameters
+    ----------
+    filelist : list of str
+        Tiff files to average.
+    mask : 2d array
+        Mask multiplied to the average. 1 means valid while 0 not.
+    output_filename : str, optional
+        Save the average to this tiff file.
+    sigma_clip : float, optional
+        If given, a second pass over the files averages only the values
+        within sigma_clip standard deviations of the mean of each pixel.
+    prefetch : int, optional
+        Number of files read ahead in a background thread.
 
-    # mean = np.mean(aver_img)
-    # std = np.std(aver_img)
-    # aver_img[aver_img > mean + 3 * std] = 0
-    aver_img = np.average(imgs, axis=2) * mask
+    Returns
+    -------
+    Averaged image: 2d array
+    """
+    mask = np.asarray(mask)
+    count = 0
+    img_sum = np.zeros(mask.shape, dtype=np.float64)
+    img_sum_sq = np.zeros(mask.shape, dtype=np.float64)
+    for img in iter_tiff_imgs(filelist, prefetch):
+        img_sum += img
+        img_sum_sq += img**2
+        count += 1
+    if count == 0:
+        raise ValueError('No images to average.')
+    aver_img = img_sum / count
+
+    if sigma_clip is not None:
+        std = np.sqrt(np.maximum(img_sum_sq / count - aver_img**2, 0.))
+        limit = sigma_clip * std
+        img_sum[:] = 0.
+        kept = np.zeros(mask.shape, dtype=np.float64)
+        for img in iter_tiff_imgs(filelist, prefetch):
+            keep = np.abs(img - aver_img) <= limit
+            img_sum[keep] += img[keep]
+            kept += keep
+        with np.errstate(divide='ignore', invalid='ignore'):
+            aver_img = np.where(kept > 0, img_sum / kept, aver_img)
+
+    aver_img[~(mask > 0.5)] = 0.
 
     if output_filename is None:
         pass
@@ -66,6 +126,174 @@ def calc_block_radial_profile(image, center, mask_list, binsize=1., mode='sum'):
                             for block_mask in mask_list]
     return block_radial_profile
 
+
+class PolarGeometry(object):
+    """Polar coordinate maps of an image with given shape and center.
+
+    The maps only depend on the geometry, so they are calculated once and
+    shared by all frames (use `get_polar_geometry` to get a cached one).
+    Bin maps are flattened and cached per bin size.
+
+    Parameters
+    ----------
+    shape : tuple of 2 ints
+        Shape of the image.
+    center : array_like with 2 elements
+        Center (x, y) of the image.
+    """
+
+    def __init__(self, shape, center):
+        self.shape = tuple(int(n) for n in shape)
+        self.center = tuple(float(c) for c in center)
+        y, x = np.indices(self.shape)
+        self.rho = np.sqrt((x - self.center[0])**2. + (y - self.center[1])**2.)
+        theta = np.arctan2(y - self.center[1], x - self.center[0])
+        theta[theta < 0] += 2 * np.pi
+        self.theta = theta  # in range of [0, 2*pi)
+        self._rho_bins = {}
+        self._theta_bins = {}
+        self._cake_bins = {}
+        self._line_samples = {}
+
+    def rho_bins(self, binsize=1.):
+        """Flattened radial bin index of every pixel, as in `calc_radial_profile`."""
+        binsize = float(binsize)
+        if binsize not in self._rho_bins:
+            self._rho_bins[binsize] = np.round(self.rho / binsize).astype(int).ravel()
+        return self._rho_bins[binsize]
+
+    def cake_bins(self, binsize=1., block_num=8):
+        """Flattened combined (chi, rho) bin index of every pixel.
+
+        Returns
+        -------
+        cake_bins: 1d array
+            chi_index * n_rho + rho_index for every pixel, chi blocks as in
+            `create_block_masks`.
+        n_rho: int
+            Number of radial bins.
+        """
+        key = (float(binsize), int(block_num))
+        if key not in self._cake_bins:
+            bin_r = self.rho_bins(binsize)
+            n_rho = bin_r.max() + 1
+            step = 2 * np.pi / block_num
+            bin_chi = np.minimum(self.theta.ravel() // step, block_num - 1).astype(int)
+            self._cake_bins[key] = (bin_chi * n_rho + bin_r, n_rho)
+        return self._cake_bins[key]
+
+    def theta_bins(self, binsize=1.):
+        """Flattened angular bin index (binsize in degree, angles folded into
+        0 to 180 deg) of every pixel, as in `calc_angular_profile`."""
+        binsize = float(binsize)
+        if binsize not in self._theta_bins:
+            theta = np.rad2deg(self.theta)
+            theta[theta > 180.] -= 180.
+            self._theta_bins[binsize] = np.round(theta / binsize).astype(int).ravel()
+        return self._theta_bins[binsize]
+
+    def line_samples(self, angle=0., width=1):
+        """Pixels sampled by a line of given width through the center.
+
+        The line runs at `angle` (in degree, same convention as theta) and
+        every sample is taken from the nearest pixel; samples outside of the
+        image are dropped.
+
+        Returns
+        -------
+        pixel_index: 1d array
+            Flattened image index of every sample.
+        line_bins: 1d array
+            Distance of every sample to the center along the line, in pixels.
+        n_bins: int
+            Length of the line profile.
+        """
+        key = (float(angle), int(width))
+        if key not in self._line_samples:
+            if len(self._line_samples) >= 32:
+                self._line_samples.clear()
+            sy, sx = self.shape
+            n_bins = int(np.ceil(self.rho.max())) + 1
+            t = np.arange(-(n_bins - 1), n_bins)
+            w = np.arange(width) - width // 2
+            phi = np.deg2rad(angle)
+            x = self.center[0] + t[None, :] * np.cos(phi) - w[:, None] * np.sin(phi)
+            y = self.center[1] + t[None, :] * np.sin(phi) + w[:, None] * np.cos(phi)
+            x = np.round(x).astype(int).ravel()
+            y = np.round(y).astype(int).ravel()
+            line_bins = np.broadcast_to(np.abs(t), (width, t.size)).ravel()
+            inside = (x >= 0) & (x < sx) & (y >= 0) & (y < sy)
+            pixel_index = y[inside] * sx + x[inside]
+            self._line_samples[key] = (pixel_index, line_bins[inside], n_bins)
+        return self._line_samples[key]
+
+
+_polar_geometry_cache = {}
+
+
+def get_polar_geometry(shape, center):
+    """Return the cached `PolarGeometry` for shape and center."""
+    key = (tuple(int(n) for n in shape), tuple(float(c) for c in center))
+    if key not in _polar_geometry_cache:
+        if len(_polar_geometry_cache) >= 8:
+            _polar_geometry_cache.clear()
+        _polar_geometry_cache[key] = PolarGeometry(*key)
+    return _polar_geometry_cache[key]
+
+
+def calc_cake_profile(image, center, binsize=1., block_num=8, mask=None, geometry=None):
+    """Radial profiles of all angular sectors (a q-chi cake) in one pass.
+
+    Every pixel is binned into (chi, rho) with a precomputed combined bin
+    index, so this replaces `create_block_masks` plus one
+    `calc_block_radial_profile` call per sector.
+
+    Parameters
+    ----------
+    image : 2d array
+        Input image.
+    center : array_like with 2 elements
+        Center of input image.
+    binsize : float, optional
+        Radial binsize in pixel. By default, the binsize is 1.
+    block_num : int, optional
+        Number of angular sectors. The default is 8.
+    mask : 2d array, optional
+        Binary 2d array with the same shape as image. 1 means valid while 0 not.
+    geometry : PolarGeometry, optional
+        Precomputed geometry, looked up in the cache if not given.
+
+    Returns
+    -------
+    sums, counts, errors: 2d arrays with shape (block_num, n_rho)
+        Summation, number of valid pixels and standard error of the mean of
+        each (sector, ring). `sums[i]` equals the 'sum' radial profile of the
+        i-th block mask of `create_block_masks`.
+    """
+    image = np.asarray(image, dtype=np.float64)
+    assert len(image.shape) == 2
+    if geometry is None:
+        geometry = get_polar_geometry(image.shape, center)
+    cake_bins, n_rho = geometry.cake_bins(binsize, block_num)
+    values = image.ravel()
+    if mask is not None:
+        mask = np.asarray(mask)
+        assert mask.shape == image.shape
+        valid = mask.ravel() > 0.5
+        cake_bins = cake_bins[valid]
+        values = values[valid]
+    length = int(block_num * n_rho)
+    sums = np.bincount(cake_bins, values, minlength=length)
+    sums_sq = np.bincount(cake_bins, values**2, minlength=length)
+    counts = np.bincount(cake_bins, minlength=length).astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = sums / counts
+        variance = np.maximum(sums_sq / counts - mean**2, 0.)
+        errors = np.sqrt(variance / counts)
+    errors[counts == 0] = 0.
+    shape = (int(block_num), int(n_rho))
+    return sums.reshape(shape), counts.reshape(shape), errors.reshape(shape)
+
 def cart2pol(x, y):
     """Summary
 
@@ -112,7 +340,7 @@ def pol2cart(rho, theta):
     return x, y
 
 # Calculate profiles
-def calc_radial_profile(image, center, binsize=1., mask=None, mode='sum'):
+def calc_radial_profile(image, center, binsize=1., mask=None, mode='sum', geometry=None):
     """Summary
 
     Parameters
@@ -125,13 +353,25 @@ def calc_radial_profile(image, center, binsize=1., mask=None, mode='sum'):
         By default, the binsize is 1 in pixel.
     mask : 2d array, optional
         Binary 2d array used in radial profile calculation. The shape must be same with image. 1 means valid while 0 not.
-    mode : {'sum', 'mean'}, optional
+    mode : {'sum', 'mean', 'std', 'rstd', 'all'}, optional
         'sum'
         By default, mode is 'sum'. This returns the summation of each ring.
 
         'mean'
         Mode 'mean' returns the average value of each ring.
 
+        'std'
+        Mode 'std' returns the standard deviation of each ring.
+
+        'rstd'
+        Mode 'rstd' returns the relative standard deviation (std / mean) of each ring.
+
+        'all'
+        Mode 'all' returns a dict with all of the above, which are
+        calculated together anyway.
+    geometry : PolarGeometry, optional
+        Precomputed geometry (radius map), looked up in the cache if not given.
+
     Returns
     -------
     Radial profile: 1d array
@@ -142,48 +382,42 @@ def calc_radial_profile(image, center, binsize=1., mask=None, mode='sum'):
     ValueError
         Description
     """
-    t1 = time.time()
+    if mode not in ('sum', 'mean', 'std', 'rstd', 'all'):
+        raise ValueError('Wrong mode: %s' %mode)
     image = np.asarray(image, dtype=np.float64)
     assert len(image.shape) == 2
     center = np.asarray(center, dtype=np.float64)
     assert center.size == 2
+    if geometry is None:
+        geometry = get_polar_geometry(image.shape, center)
+    bin_r = geometry.rho_bins(binsize)
+    length = bin_r.max() + 1
+    values = image.ravel()
     if mask is not None:
-        mask = np.asarray(mask, dtype=np.float64)
+        mask = np.asarray(mask)
         assert mask.shape == image.shape
         assert mask.min() >= 0. and mask.max() <= 1.
-        mask = (mask > 0.5).astype(np.float64)
-    else:
-        mask = np.ones_like(image)
-    image = image * mask
-    y, x = np.indices((image.shape))
-    r = np.sqrt((x - center[0])**2. + (y - center[1])**2.)
-    bin_r = r / binsize
-    bin_r = np.round(bin_r).astype(int)
-    radial_sum = np.bincount(bin_r.ravel(), image.ravel())  # summation of each ring
-
-    radial_std = np.zeros_like(radial_sum)
-    for x in range(bin_r.max()):
-        radial_std[x] = image[bin_r == x].std()
-    nr = np.bincount(bin_r.ravel(), mask.ravel())
-    radial_mean = radial_sum / nr
-    radial_mean[np.isinf(radial_mean)] = 0.
-    radial_mean[np.isnan(radial_mean)] = 0.
-    radial_rstd = radial_std / radial_mean
-    radial_rstd[np.isinf(radial_rstd)] = 0.
-    radial_rstd[np.isnan(radial_rstd)] = 0.
-    print('time is ', time.time()-t1)
-    if mode == 'sum':
-        return radial_sum
-    elif mode == 'mean':
-        return radial_mean
-    elif mode == 'std':
-        return radial_std
-    elif mode == 'rstd':
-        return radial_rstd
-    else:
-        raise ValueError('Wrong mode: %s' %mode)
-
-def calc_angular_profile(image, center, binsize=1., mask=None, mode='sum'):
+        valid = np.flatnonzero(mask > 0.5)  # only the valid pixels are binned
+        bin_r = bin_r[valid]
+        values = values[valid]
+    nr = np.bincount(bin_r, minlength=length).astype(np.float64)
+    # one pass of sum and sum of squares gives all statistics
+    radial_sum = np.bincount(bin_r, values, minlength=length)  # summation of each ring
+    radial_sum_sq = np.bincount(bin_r, values**2, minlength=length)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        radial_mean = radial_sum / nr
+        radial_std = np.sqrt(np.maximum(radial_sum_sq / nr - radial_mean**2, 0.))
+        radial_mean[~np.isfinite(radial_mean)] = 0.
+        radial_std[~np.isfinite(radial_std)] = 0.
+        radial_rstd = radial_std / radial_mean
+        radial_rstd[~np.isfinite(radial_rstd)] = 0.
+    profiles = {'sum': radial_sum, 'mean': radial_mean,
+                'std': radial_std, 'rstd': radial_rstd}
+    if mode == 'all':
+        return profiles
+    return profiles[mode]
+
+def calc_angular_profile(image, center, binsize=1., mask=None, mode='sum', geometry=None):
     """Summary
 
     Parameters
@@ -202,44 +436,44 @@ def calc_angular_profile(image, center, binsize=1., mask=None, mode='sum'):
 
         'mean'
         Mode 'mean' returns the average value of each ring.
+    geometry : PolarGeometry, optional
+        Precomputed geometry (angle map), looked up in the cache if not given.
 
     Returns
     -------
     Angular profile: 1d array
         Output array, contains summation or mean value of each ring with binsize of 1 along rho axis.
     """
+    if mode not in ('sum', 'mean'):
+        raise ValueError('Wrong mode: %s' %mode)
     image = np.asarray(image, dtype=np.float64)
     assert len(image.shape) == 2
     center = np.asarray(center, dtype=np.float64)
     assert center.size == 2
+    if geometry is None:
+        geometry = get_polar_geometry(image.shape, center)
+    bin_theta = geometry.theta_bins(binsize)
+    values = image.ravel()
+    length = bin_theta.max() + 1
     if mask is not None:
-        mask = np.asarray(mask, dtype=np.float64)
+        mask = np.asarray(mask)
         assert mask.shape == image.shape
         assert mask.min() >= 0. and mask.max() <= 1.
-        mask = (mask > 0.5).astype(np.float64)
-    else:
-        mask = np.ones_like(image)
-    image = image * mask
-    y, x = np.indices((image.shape))
-    theta = np.rad2deg(np.arctan2(y-center[1], x-center[0]))
-    bin_theta = theta.copy()
-    bin_theta[bin_theta<0.] += 180.
-    bin_theta = bin_theta / binsize
-    bin_theta = np.round(bin_theta).astype(int)
-    angular_sum = np.bincount(bin_theta.ravel(), image.ravel())  # summation of each ring
+        valid = np.flatnonzero(mask > 0.5)  # only the valid pixels are binned
+        bin_theta = bin_theta[valid]
+        values = values[valid]
+    angular_sum = np.bincount(bin_theta, values, minlength=length)  # summation of each ring
 
     if mode == 'sum':
         return angular_sum
-    elif mode == 'mean':
-        ntheta = np.bincount(bin_theta.ravel(), mask.ravel())
+    ntheta = np.bincount(bin_theta, minlength=length)
+    with np.errstate(divide='ignore', invalid='ignore'):
         angular_mean = angular_sum / ntheta
-        angular_mean[np.isinf(angular_mean)] = 0.
-        return angular_mean
-    else:
-        raise ValueError('Wrong mode: %s' %mode)
+    angular_mean[~np.isfinite(angular_mean)] = 0.
+    return angular_mean
 
 
-def calc_across_center_line_profile(image, center, angle=0., width=1, mask=None, mode='sum'):
+def calc_across_center_line_profile(image, center, angle=0., width=1, mask=None, mode='sum', geometry=None):
     """Summary
 
     Parameters
@@ -260,66 +494,32 @@ def calc_across_center_line_profile(image, center, angle=0., width=1, mask=None,
 
         'mean'
         Mode 'mean' returns the average value of each ring.
+    geometry : PolarGeometry, optional
+        Precomputed geometry (line sample indices), looked up in the cache if not given.
 
     Returns
     -------
-    Across center line profile with given width at specified angle: 2d array
-        Output array, contains summation or mean value alone the across center line and its indices with respect to the center.
+    Across center line profile with given width at specified angle: 1d array
+        Output array, contains summation or mean value along the across center line, indexed by the distance to the center.
     """
+    if mode not in ('sum', 'mean'):
+        raise ValueError('Wrong mode: %s' %mode)
     image = np.asarray(image, dtype=np.float64)
     assert len(image.shape) == 2
     center = np.asarray(center, dtype=np.float64)
     assert center.size == 2
+    if geometry is None:
+        geometry = get_polar_geometry(image.shape, center)
+    pixel_index, line_bins, n_bins = geometry.line_samples(angle, width)
+    values = image.ravel()[pixel_index]
     if mask is not None:
-        mask = np.asarray(mask, dtype=np.float64)
+        mask = np.asarray(mask)
         assert mask.shape == image.shape
         assert mask.min() >= 0. and mask.max() <= 1.
-        mask = (mask > 0.5).astype(np.float64)
-    else:
-        mask = np.ones_like(image)
-    image = image * mask 
-    # generate a larger image if the given center is not the center of the image.
-    sy, sx = image.shape
-    if sy % 2 == 0:
-        # print('padding along first axis')
-        image = np.pad(image, ((0,1), (0,0)), 'constant', constant_values=0)
-    if sx % 2 == 0:
-        # print('padding along second axis')
-        image = np.pad(image, ((0,0), (0,1)), 'constant', constant_values=0)
-    sy, sx = image.shape
-    if center[0] < sx//2 and center[1] < sy//2:
-        # print('case1')
-        sx_p = int((sx - center[0]) * 2 - 1)
-        sy_p = int((sy - center[1]) * 2 - 1)
-        ex_img = np.zeros((sy_p, sx_p))
-        ex_img[sy_p-sy:sy_p, sx_p-sx:sx_p] = image
-    elif center[0] < sx//2 and center[1] > sy//2:
-        # print('case2')
-        sx_p = int((sx - center[0]) * 2 - 1)
-        sy_p = int((center[1]) * 2 - 1)
-        ex_img = np.zeros((sy_p, sx_p))
-        ex_img[0:sy, sx_p-sx:sx_p] = image
-    elif center[0] > sx//2 and center[1] < sy//2:
-        sx_p = int((center[0]) * 2 - 1)
-        sy_p = int((sy - center[1]) * 2 - 1)
-        ex_img = np.zeros((sy_p, sx_p))
-        ex_img[sy_p-sy:sy_p, 0:sx] = image
-    else:
-        # print('case4')
-        sx_p = int((center[0]) * 2 + 1)
-        sy_p = int((center[1]) * 2 + 1)
-        ex_img = np.zeros((sy_p, sx_p))
-        ex_img[0:sy, 0:sx] = image
-    rot_img = rotate(ex_img, angle)
-    rot_sy, rot_sx = rot_img.shape
-    across_line = rot_img[rot_sy//2-width//2:rot_sy//2-width//2+width, :].copy()
-    across_line_sum = np.sum(across_line, axis=0)
-    line_indices = np.indices(across_line_sum.shape)[0] - rot_sx//2
-    line_sum = np.bincount(np.abs(line_indices).ravel(), across_line_sum.ravel())
+        valid = mask.ravel()[pixel_index] > 0.5
+        line_bins = line_bins[valid]
+        values = values[valid]
+    line_sum = np.bincount(line_bins, values, minlength=n_bins)
     if mode == 'sum':
         return line_sum
-    elif mode == 'mean':
-        line_mean = line_sum.astype(np.float) / width
-        return line_mean
-    else:
-        raise ValueError('Wrong mode: %s' %mode)
+    return line_sum / width
@@ -0,0 +1,59 @@
+from __future__ import print_function, division
+
+import os
+import sys
+import glob
+import argparse
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.append(ROOT_DIR)
+from RAW import RAWSimulator
+from RAW import RAWSettings
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Find hot, dead and saturated pixels in dark or flat '
+        'frames and add them to the beamstop mask of a RAW config.')
+    parser.add_argument('raw_cfg_path', help='RAW config file')
+    parser.add_argument(
+        'frames', nargs='+', help='Image files (or glob patterns) of the frames')
+    parser.add_argument(
+        '--sensitivity',
+        help='Outlier threshold in robust standard deviations (default=6)',
+        type=float,
+        default=6.0)
+    parser.add_argument(
+        '--saturation',
+        help='Pixel value of saturated pixels (default: not checked)',
+        type=float,
+        default=None)
+    parser.add_argument(
+        '--keep_zero',
+        help='Do not flag pixels that only read zero (e.g. darks of counting detectors)',
+        action='store_true')
+    parser.add_argument(
+        '-o', '--output',
+        help='Config file to save to (default: overwrite raw_cfg_path)',
+        default=None)
+    args = parser.parse_args()
+
+    filenames = []
+    for pattern in args.frames:
+        filenames.extend(sorted(glob.glob(pattern)) or [pattern])
+
+    raw_simulator = RAWSimulator(args.raw_cfg_path)
+    raw_simulator.createBadPixelMask(
+        filenames,
+        sensitivity=args.sensitivity,
+        saturation=args.saturation,
+        flag_zero=not args.keep_zero)
+
+    output = args.output if args.output is not None else args.raw_cfg_path
+    RAWSettings.saveSettings(raw_simulator.get_raw_settings(), output)
+    print('Saved config to {}'.format(output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+import SASBinStats
+
+
+@pytest.mark.parametrize('n', [3, 4, 6, 8, 12, 20])
+def test_sigma_clip_rejects_single_zinger_in_small_bins(n):
+    rng = np.random.RandomState(n)
+
+    values = rng.normal(100, 5, n)
+    values[n // 2] = 5000
+    offsets = np.array([0, n])
+
+    mean, err, count = SASBinStats.binnedSigmaClip(values, offsets, 4.0)
+
+    kept = np.delete(values, n // 2)
+    assert count[0] == n - 1
+    assert np.isclose(mean[0], kept.mean())
+    assert np.isclose(err[0], kept.std() / np.sqrt(n - 1))
+
+
+def test_sigma_clip_keeps_low_count_bins():
+    # MAD is 0 here, the ones are not outliers
+    values = np.array([1., 0, 0, 0, 1, 0, 0, 3, 3, 3, 3])
+    offsets = np.array([0, 7, 11])
+
+    mean, err, count = SASBinStats.binnedSigmaClip(values, offsets, 4.0)
+
+    assert np.array_equal(count, [7, 4])
+    assert np.allclose(mean, [2 / 7., 3])
+
+
+def test_median_and_mad_per_bin():
+    values = np.array([5., 1, 3, 2, 8, 4, 4, 100])
+    offsets = np.array([0, 3, 3, 8])
+
+    median = SASBinStats.binnedMedian(values, offsets)
+
+    assert median[0] == 3 and np.isnan(median[1]) and median[2] == 4
+    assert np.allclose(SASBinStats.binnedMAD(values, offsets, median)[[0, 2]], [2, 2])
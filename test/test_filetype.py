@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+import SASFileIO
+
+
+@pytest.mark.parametrize('header, name', [
+    (b'II*\x00' + b'\x00' * 60, 'frame.dat'),
+    (b'MM\x00*' + b'\x00' * 60, 'frame.sub'),
+    (b'{\nHeaderID = EH:000001:000000:000000 ;\n}\n', 'frame.dat'),
+    (b'{\r\nHeaderID = EH:000001:000000:000000 ;\r\n}\r\n', 'frame'),
+    ])
+def test_images_are_found_by_magic_bytes(tmp_path, header, name):
+    # The extensions would say otherwise
+    path = tmp_path / name
+    path.write_bytes(header)
+
+    assert SASFileIO.checkFileType(str(path)) == 'image'
+
+
+@pytest.mark.parametrize('magic, format_name', [
+    (b'\x89HDF\r\n\x1a\n', 'Eiger'),
+    (b'\x93NUMPY', 'Numpy 2D Array'),
+    (b'\xd2\x04\x00\x00', 'Mar345'),
+    ])
+def test_optional_formats_are_found_by_magic_bytes(tmp_path, magic, format_name):
+    if format_name not in SASFileIO.all_image_types:
+        pytest.skip(format_name + ' is not available')
+
+    path = tmp_path / 'frame.dat'
+    path.write_bytes(magic + b'\x00' * 60)
+
+    assert format_name in SASFileIO.sniffImageFormats(magic)
+    assert SASFileIO.checkFileType(str(path)) == 'image'
+
+
+@pytest.mark.parametrize('name, file_type', [
+    ('profile.dat', 'primus'),
+    ('profile.out', 'out'),
+    ('profile.ift', 'ift'),
+    ('profile.rad', 'rad'),
+    ('profile.001', 'csv'),
+    ])
+def test_text_files_are_found_by_extension(tmp_path, name, file_type):
+    path = tmp_path / name
+    path.write_text('# q  I  err\n0.01 1.0 0.1\n')
+
+    assert SASFileIO.checkFileType(str(path)) == file_type
+
+
+def test_changed_file_is_checked_again(tmp_path):
+    path = tmp_path / 'frame.dat'
+    path.write_text('0.01 1.0 0.1\n')
+
+    assert SASFileIO.checkFileType(str(path)) == 'primus'
+
+    path.write_bytes(b'II*\x00' + b'\x00' * 60)
+    stat = os.stat(str(path))
+    os.utime(str(path), (stat.st_atime, stat.st_mtime + 10))
+
+    assert SASFileIO.checkFileType(str(path)) == 'image'
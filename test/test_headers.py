@@ -0,0 +1,39 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import SASFileIO
+
+
+def test_header_file_cache_from_threads(tmp_path, monkeypatch):
+    monkeypatch.setattr(SASFileIO, 'HEADER_FILE_CACHE_SIZE', 4)
+    monkeypatch.setattr(SASFileIO, '_header_file_lines', {})
+
+    paths = []
+    for i in range(16):
+        path = tmp_path / ('header%i.txt' %(i))
+        path.write_text('file %i\nline 2\n' %(i))
+        paths.append(str(path))
+
+    def read(i):
+        return SASFileIO.readHeaderFileLines(paths[i % len(paths)])[0]
+
+    with ThreadPoolExecutor(max_workers = 8) as pool:
+        lines = list(pool.map(read, range(2000)))
+
+    assert lines == ['file %i\n' %(i % len(paths)) for i in range(2000)]
+    assert len(SASFileIO._header_file_lines) <= 4
+
+
+def test_header_store_from_threads(tmp_path):
+    store = SASFileIO.HeaderStore()
+
+    filenames = []
+    for i in range(20):
+        path = tmp_path / ('image%i.tif' %(i))
+        path.write_bytes(b'')
+        filenames.append(str(path))
+
+    headers = store.loadMany(filenames * 5, 'None', threads = 8)
+
+    assert len(headers) == 100
+    assert all(hdr == {} for hdr in headers)
+    assert len(store._headers) == 20
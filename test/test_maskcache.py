@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+
+import SASMaskCache
+
+
+def test_round_trip(tmp_path):
+    cache = SASMaskCache.MaskCache(str(tmp_path))
+
+    mask = np.random.RandomState(0).uniform(size = (37, 53)) > 0.3
+    key = SASMaskCache.getArrayKey(mask, 'test')
+
+    cache.save(key, mask)
+
+    loaded = cache.load(key, mask.shape)
+    assert loaded.dtype == np.bool_
+    assert np.array_equal(loaded, mask)
+
+    as_int = cache.load(key, mask.shape, dtype = np.int32)
+    assert as_int.dtype == np.int32
+    assert np.array_equal(as_int, mask.astype(np.int32))
+
+def test_missing_and_wrong_shape(tmp_path):
+    cache = SASMaskCache.MaskCache(str(tmp_path))
+
+    assert cache.load('missing', (10, 10)) is None
+
+    mask = np.ones((10, 10), dtype = bool)
+    cache.save('key', mask)
+
+    assert cache.load('key', (20, 20)) is None
+    assert cache.load('key', (10, 10)).all()
+
+def test_eviction(tmp_path):
+    cache = SASMaskCache.MaskCache(str(tmp_path), max_entries = 3)
+
+    mask = np.zeros((8, 8), dtype = bool)
+
+    for i in range(3):
+        cache.save('key%i' %(i), mask)
+        os.utime(cache._path('key%i' %(i)), (1000 + i, 1000 + i))
+
+    # Loading marks key0 as the most recently used
+    assert cache.load('key0', mask.shape) is not None
+
+    cache.save('key3', mask)
+
+    assert cache.load('key1', mask.shape) is None
+    for key in ('key0', 'key2', 'key3'):
+        assert cache.load(key, mask.shape) is not None
+
+    assert len(os.listdir(str(tmp_path))) == 3
+
+def test_arrays_round_trip(tmp_path):
+    cache = SASMaskCache.MaskCache(str(tmp_path), max_entries = 1)
+
+    assert cache.loadArrays('arrays') is None
+
+    cache.saveArrays('arrays', data = np.arange(5.), shape = np.array([2, 3]))
+
+    saved = cache.loadArrays('arrays')
+    assert np.array_equal(saved['data'], np.arange(5.))
+    assert np.array_equal(saved['shape'], [2, 3])
+
+    # Arrays and masks share the eviction
+    os.utime(cache._path('arrays', SASMaskCache.ARRAYS_EXTENSION), (1000, 1000))
+    cache.save('mask', np.ones((4, 4), dtype = bool))
+
+    assert cache.loadArrays('arrays') is None
+    assert cache.load('mask', (4, 4)) is not None
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+import SASImage
+
+
+IMG_DIM = (60, 80)
+
+
+def fillFromPoints(mask, img_dim):
+    ''' The mask as the old createMaskMatrix drew it, one fill point at a time '''
+
+    fill = np.zeros(img_dim, dtype = bool)
+
+    for a, b in mask.getFillPoints():
+        if a < img_dim[0] and a >= 0 and b < img_dim[1] and b >= 0:
+            fill[int(a), int(b)] = True
+
+    return fill
+
+
+@pytest.mark.parametrize('radius', [0, 1, 2, 5, 12, 37])
+@pytest.mark.parametrize('center', [(30, 40), (0, 0), (3, 77), (58.5, 20.25), (10.7, 2.2), (-6, 40)])
+def test_circle_fill_matches_fill_points(radius, center):
+    row, col = center
+    mask = SASImage.CircleMask((col, row), (col + radius, row), 0, IMG_DIM)
+
+    assert np.array_equal(mask.getFillMatrix(IMG_DIM), fillFromPoints(mask, IMG_DIM))
+
+
+def test_rectangle_fill_matches_fill_points():
+    rng = np.random.RandomState(0)
+
+    for i in range(50):
+        first = (int(rng.uniform(-5, 85)), int(rng.uniform(-5, 65)))
+        second = (int(rng.uniform(-5, 85)), int(rng.uniform(-5, 65)))
+        mask = SASImage.RectangleMask(first, second, 0, IMG_DIM)
+
+        assert np.array_equal(mask.getFillMatrix(IMG_DIM), fillFromPoints(mask, IMG_DIM))
+
+
+def test_polygon_fill_matches_fill_points():
+    rng = np.random.RandomState(1)
+
+    for i in range(10):
+        points = [(rng.uniform(0, 80), rng.uniform(0, 60)) for j in range(rng.randint(3, 8))]
+        mask = SASImage.PolygonMask(points, 0, IMG_DIM)
+
+        assert np.array_equal(mask.getFillMatrix(IMG_DIM), fillFromPoints(mask, IMG_DIM))
+
+
+def test_create_mask_matrix_combines_masks():
+    circle = SASImage.CircleMask((40, 30), (50, 30), 0, IMG_DIM)
+    rectangle = SASImage.RectangleMask((5, 5), (20, 15), 1, IMG_DIM)
+    opening = SASImage.CircleMask((40, 30), (45, 30), 2, IMG_DIM, negative = True)
+
+    mask = SASImage.createMaskMatrix(IMG_DIM, [circle, rectangle])
+    expected = ~(fillFromPoints(circle, IMG_DIM) | fillFromPoints(rectangle, IMG_DIM))
+    assert np.array_equal(mask, np.flipud(expected))
+
+    mask = SASImage.createMaskMatrix(IMG_DIM, [opening, rectangle])
+    expected = fillFromPoints(opening, IMG_DIM) & ~fillFromPoints(rectangle, IMG_DIM)
+    assert np.array_equal(mask, np.flipud(expected))
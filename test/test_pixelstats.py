@@ -0,0 +1,43 @@
+import numpy as np
+
+import SASPixelStats
+
+
+def test_robust_outliers_finds_hot_pixel():
+    values = np.random.RandomState(0).normal(100, 5, (20, 20))
+    values[3, 4] = 300
+    values[10, 12] = -50
+
+    outliers = SASPixelStats.robustOutliers(values, 6.0)
+
+    assert np.array_equal(np.argwhere(outliers), [[3, 4], [10, 12]])
+
+
+def test_robust_outliers_with_zero_mad():
+    # Low count frames: most pixels read the same value, so the MAD is 0
+    values = np.zeros((20, 20))
+    values[::3, ::2] = 1
+    values[5, 5] = 50
+
+    outliers = SASPixelStats.robustOutliers(values, 6.0)
+
+    assert np.array_equal(np.argwhere(outliers), [[5, 5]])
+
+
+def test_robust_outliers_of_constant_values():
+    values = np.full((10, 10), 7.0)
+
+    assert not SASPixelStats.robustOutliers(values, 6.0).any()
+
+
+def test_robust_outliers_only_use_valid_values():
+    values = np.full((10, 10), 10.0)
+    values[::2] += 1
+    values[0, :5] = 1000
+
+    valid = np.ones(values.shape, dtype = bool)
+    valid[0, :5] = False
+
+    outliers = SASPixelStats.robustOutliers(values, 6.0, valid)
+
+    assert np.array_equal(np.argwhere(outliers), [[0, i] for i in range(5)])
@@ -0,0 +1,124 @@
+import numpy as np
+import pytest
+
+import RAWGlobals
+import SASImage
+
+
+@pytest.fixture
+def backend():
+    old_backend = RAWGlobals.ravg_backend
+
+    def setBackend(name):
+        RAWGlobals.ravg_backend = name
+
+    yield setBackend
+
+    RAWGlobals.ravg_backend = old_backend
+
+
+def makeImage(seed, level = 1e6):
+    rng = np.random.RandomState(seed)
+
+    img = rng.poisson(level, (40, 50)).astype(np.float64)
+
+    mask = np.ones(img.shape, dtype = bool)
+    mask[15:25, 20:30] = False
+
+    noise_mask = np.zeros(img.shape, dtype = bool)
+    noise_mask[:3, :3] = True
+
+    return img, mask, noise_mask
+
+
+def average(img, mask, noise_mask, **kwargs):
+    return SASImage.radialAverage(img, 25, 20, mask, noise_mask, **kwargs)
+
+
+@pytest.mark.parametrize('use_noise_mask', [False, True])
+def test_backends_give_the_same_result(backend, use_noise_mask):
+    img, mask, noise_mask = makeImage(0)
+    if not use_noise_mask:
+        noise_mask = None
+
+    backend('python')
+    iq, q, err = average(img, mask, noise_mask)[:3]
+
+    for name, threads in [('numpy', 1), ('numpy', 3), ('csr', 1)]:
+        backend(name)
+        other_iq, other_q, other_err = average(img, mask, noise_mask, threads = threads)[:3]
+
+        assert np.array_equal(q, other_q)
+        assert np.allclose(iq, other_iq, rtol = 1e-12, atol = 0)
+        assert np.allclose(err, other_err, rtol = 1e-7, atol = 0)
+
+
+def test_threads_give_the_same_result(backend):
+    backend('numpy')
+    img, mask, noise_mask = makeImage(1, level = 1e9)
+
+    iq, q, err = average(img, mask, noise_mask, threads = 1)[:3]
+
+    for threads in (2, 4, 7):
+        other_iq, other_q, other_err = average(img, mask, noise_mask, threads = threads)[:3]
+
+        assert np.allclose(iq, other_iq, rtol = 1e-12, atol = 0)
+        assert np.allclose(err, other_err, rtol = 1e-9, atol = 0)
+
+
+def test_stack_matches_single_frames(backend):
+    backend('numpy')
+    frames = [makeImage(seed)[0] for seed in range(3)]
+    img, mask, noise_mask = makeImage(0)
+
+    stack = SASImage.radialAverageStack(frames, 25, 20, mask, noise_mask)
+
+    for frame, (iq, q, err) in zip(frames, stack):
+        single_iq, single_q, single_err = average(frame, mask, noise_mask)[:3]
+
+        assert np.allclose(iq, single_iq, rtol = 1e-12, atol = 0)
+        assert np.allclose(err, single_err, rtol = 1e-9, atol = 0)
+
+
+def test_numpy_and_csr_dezinger_the_same(backend):
+    img, mask, noise_mask = makeImage(2, level = 100)
+    img[30, 10] = 1e6
+
+    results = []
+    for name in ('numpy', 'csr'):
+        backend(name)
+        results.append(average(img, mask, None, dezingering = 1, dezing_sensitivity = 4.0)[:3])
+
+    assert np.allclose(results[0][0], results[1][0])
+    assert np.allclose(results[0][2], results[1][2])
+    assert np.all(results[0][0] < 1000)
+
+
+def test_split_weights_are_cached_by_content(tmp_path):
+    import SASMaskCache
+
+    cache = SASMaskCache.MaskCache(str(tmp_path))
+    img, mask, noise_mask = makeImage(4)
+
+    first = SASImage.getRadialAverageGeometry(img.shape, 25, 20, mask.copy(), noise_mask)
+    matrix = first.getSplitMatrix(3, 0.5, cache)
+
+    assert len(list(tmp_path.iterdir())) == 1
+
+    # Same content, new arrays: loaded from the cache
+    second = SASImage.getRadialAverageGeometry(img.shape, 25, 20, mask.copy(), noise_mask)
+    assert second is not first
+    assert second.getSplitKey(3, 0.5) == first.getSplitKey(3, 0.5)
+
+    loaded = second.getSplitMatrix(3, 0.5, cache)
+    assert (loaded != matrix).nnz == 0
+
+    changed = mask.copy()
+    changed[0, 0] = False
+    third = SASImage.getRadialAverageGeometry(img.shape, 25, 20, changed, noise_mask)
+    assert third.getSplitKey(3, 0.5) != first.getSplitKey(3, 0.5)
+    assert third.getSplitKey(3, 1.0) != third.getSplitKey(3, 0.5)
+
+    iq, q, err, _ = SASImage.radialAverage(img, 25, 20, mask, noise_mask, oversampling = 3,
+                                           bin_width = 0.5, split_cache = cache)
+    assert len(iq) == len(q) == len(err)
@@ -0,0 +1,65 @@
+import pytest
+
+import SASExceptions
+import SASFileIO
+
+
+def scan(number, rows):
+    lines = ['#S %i  tseries %i 1\n' %(number, rows), '#D Mon Jan 01 00:00:%02i 2018\n' %(number),
+             '#L  Epoch  Seconds  I0  I1\n']
+    lines += ['%i %i.0 %i %i\n' %(number, i, 1000 + number*10 + i, 2000 + i) for i in range(rows)]
+    lines.append('\n')
+
+    return ''.join(lines)
+
+
+def test_counters_of_every_scan(tmp_path):
+    path = tmp_path / 'counters'
+    path.write_text('#F counters\n#E 1\n\n' + scan(1, 3) + scan(2, 5) + scan(3, 2))
+
+    index = SASFileIO.SpecFileIndex(str(path))
+
+    counters = index.getCounters(2, 4)
+    assert counters == {'Epoch' : '2', 'Seconds' : '4.0', 'I0' : '1024', 'I1' : '2004',
+                        'date' : 'Mon Jan 01 00:00:02 2018'}
+
+    assert index.getCounters(3, 0)['I0'] == '1030'
+    assert index.getCounters(1, 2)['Seconds'] == '2.0'
+
+
+def test_missing_counters_raise_header_load_error(tmp_path):
+    path = tmp_path / 'counters'
+    path.write_text(scan(1, 3) + '#S 2  tseries\n')
+
+    index = SASFileIO.SpecFileIndex(str(path))
+
+    for scan_number, frame in [(4, 0), (2, 0), (1, 10)]:
+        with pytest.raises(SASExceptions.HeaderLoadError):
+            index.getCounters(scan_number, frame)
+
+
+def test_appended_file_is_updated(tmp_path):
+    path = tmp_path / 'counters'
+    text = scan(1, 3) + scan(2, 2)
+
+    # The #L line of scan 2 is still being written
+    path.write_text(text[:text.index('#L', text.index('#S 2')) + 5])
+
+    index = SASFileIO.getSpecFileIndex(str(path))
+    assert index.getCounters(1, 2)['I0'] == '1012'
+
+    with pytest.raises(SASExceptions.HeaderLoadError):
+        index.getCounters(2, 1)
+
+    path.write_text(text + scan(3, 2))
+
+    assert SASFileIO.getSpecFileIndex(str(path)) is index
+    assert index.getCounters(2, 1) == SASFileIO.SpecFileIndex(str(path)).getCounters(2, 1)
+    assert index.getCounters(3, 1)['I1'] == '2001'
+
+    # Changed, not appended to: indexed again
+    path.write_text(scan(5, 1) + scan(1, 3))
+
+    new_index = SASFileIO.getSpecFileIndex(str(path))
+    assert new_index is not index
+    assert new_index.getCounters(5, 0)['I0'] == '1050'